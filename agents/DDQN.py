@@ -13,6 +13,13 @@ import gc
 #from torch.utils.tensorboard import SummaryWriter
 import shutil
 from garl_gym import scenarios
+from checkpoint import CheckpointManager, get_rng_state, set_rng_state
+from world_state import world_to_columns, columns_to_world
+from metrics_log import open_log_writer, format_record
+from renderer import FrameRenderer
+from world_trace import TraceWriter
+from timing import PhaseTimer
+from memory import MemoryMonitor
 
 
 class DDQN(nn.Module):
@@ -43,6 +50,10 @@ class DDQN(nn.Module):
         self.opt = opt(self.q_net.parameters(), lr)
         self.target_q_net = deepcopy(q_net).type(self.dtype)
 
+        self.checkpoint_manager = None
+        self.timer = PhaseTimer.from_args(args)
+        self.memory = MemoryMonitor.from_args(args)
+
     def train(self,
               episodes=100,
               episode_step=500,
@@ -50,7 +61,8 @@ class DDQN(nn.Module):
               min_greedy=0.3,
               max_greedy=0.9,
               greedy_step=5000,
-              update_period=20):
+              update_period=20,
+              resume=False):
         if self.args.env_type == 'simple_population_dynamics':
             get_obs = scenarios.simple_population_dynamics.get_obs
         elif self.args.env_type == 'simple_population_dynamics_ga':
@@ -64,19 +76,48 @@ class DDQN(nn.Module):
         #eps_greedy = 0.9
 
         rounds = 0
+        start_episode = 0
         model_dir = os.path.join('results', 'exp_{:d}'.format(self.args.experiment_id), 'models')
-        try:
-            os.makedirs(model_dir)
-        except:
-            shutil.rmtree(model_dir)
+        checkpoint_dir = os.path.join('results', 'exp_{:d}'.format(self.args.experiment_id), 'checkpoints')
+        if not resume:
+            try:
+                os.makedirs(model_dir)
+            except:
+                shutil.rmtree(model_dir)
+                os.makedirs(model_dir)
+            if os.path.exists(checkpoint_dir):
+                shutil.rmtree(checkpoint_dir)
+        elif not os.path.exists(model_dir):
             os.makedirs(model_dir)
-
-        for episode in range(episodes):
+        self.checkpoint_manager = CheckpointManager(checkpoint_dir,
+                                                    keep_last=getattr(self.args, 'checkpoint_keep_last', 3),
+                                                    keep_best=getattr(self.args, 'checkpoint_keep_best', 1))
+
+        log, renderer, trace = None, None, None
+        if resume:
+            state = self.checkpoint_manager.load_latest()
+            if state is not None:
+                start_episode, eps_greedy, rounds, timesteps = self.restore_checkpoint(state)
+                img_dir = os.path.join('results', 'exp_{:d}'.format(self.args.experiment_id), 'images',str(rounds-1))
+                log_dir = os.path.join('results', 'exp_{:d}'.format(self.args.experiment_id), 'logs', str(rounds-1))
+                log = open_log_writer(os.path.join(log_dir, 'log.txt'), 'a', getattr(self.args, 'compress_logs', False))
+                renderer = FrameRenderer.from_args(os.path.join(img_dir, 'video_{:d}.avi'.format(timesteps)), self.args) if self.video_flag else None
+                trace = TraceWriter.from_args(os.path.join(log_dir, 'trace'), self.args, 'a')
+
+        for episode in range(start_episode, episodes):
             loss = 0
             total_reward = 0
             bar = tqdm()
 
-            if episode == 0 or len(self.env.predators) == 0 or len(self.env.preys) == 0 or len(self.env.preys)>10000 or len(self.env.predators)>10000:
+            # log is closed when the population collapsed in the previous episode
+            if episode == 0 or log is None or log.closed or len(self.env.predators) == 0 or len(self.env.preys) == 0 or len(self.env.preys)>10000 or len(self.env.predators)>10000:
+                # writers of the previous round, or of the round resumed with 'a'
+                if renderer is not None:
+                    renderer.close()
+                if trace is not None:
+                    trace.close()
+                if log is not None:
+                    log.close()
                 obs = self.env.reset()
 
                 img_dir = os.path.join('results', 'exp_{:d}'.format(self.args.experiment_id), 'images',str(rounds))
@@ -91,14 +132,19 @@ class DDQN(nn.Module):
                 except:
                     shutil.rmtree(log_dir)
                     os.makedirs(log_dir)
-                log = open(os.path.join(log_dir, 'log.txt'), 'w')
+                log = open_log_writer(os.path.join(log_dir, 'log.txt'), 'w', getattr(self.args, 'compress_logs', False))
+                renderer = FrameRenderer.from_args(os.path.join(img_dir, 'video.avi'), self.args) if self.video_flag else None
+                trace = TraceWriter.from_args(os.path.join(log_dir, 'trace'), self.args)
                 rounds += 1
                 timesteps = 0
 
             for i in range(episode_step):
                 episode_reward = 0
                 if self.video_flag:
-                    self.env.dump_image(os.path.join(img_dir, '{:d}.png'.format(timesteps+1)))
+                    renderer.render(self.env)
+                if trace is not None:
+                    trace.record(self.env, timesteps)
+                self.timer.start()
 
                 eps_greedy += g_step
                 eps_greedy = np.clip(eps_greedy, min_greedy, max_greedy)
@@ -108,6 +154,7 @@ class DDQN(nn.Module):
                 action_batches = []
                 #obs = self.env.render(only_view=True)
                 obs = get_obs(self.env, only_view=True)
+                self.timer.lap('get_obs')
                 view_batches = []
                 view_ids = []
                 view_values_list = []
@@ -128,11 +175,14 @@ class DDQN(nn.Module):
                     view_ids.append(batch_id)
                     view_values_list.append(batch_view)
                 num_batches = j
+                self.timer.lap('forward')
 
                 actions = dict(zip(ids, actions))
                 #next_view_batches, rewards = self.env.step(actions)
                 self.env.take_actions(actions)
+                self.timer.lap('take_actions')
                 next_view_batches, rewards, killed = get_obs(self.env)
+                self.timer.lap('get_obs')
                 self.env.killed = killed
                 episode_reward += np.sum(list(rewards.values()))
                 total_reward += (episode_reward / len(obs))
@@ -172,40 +222,63 @@ class DDQN(nn.Module):
                     #clip_grad_norm(self.q_net.parameters(), 1.)
                     self.opt.step()
                     loss_batch += l.cpu().detach().data.numpy()
+                self.timer.lap('learn')
 
                 killed = self.env.remove_dead_agents()
                 if self.obs_type == 'dense':
                     self.remove_dead_agent_emb(killed)
                 else:
                     self.env.remove_dead_agent_emb(killed)
+                self.timer.lap('remove_dead_agents')
                 view_batches = next_view_batches
                 msg = "episode {:03d} episode step {:03d} loss:{:5.4f} reward:{:5.3f} eps_greedy {:5.3f}".format(episode, i, loss_batch/(j+1), episode_reward/len(obs), eps_greedy)
                 bar.set_description(msg)
                 bar.update(1)
 
                 info = "Episode\t{:03d}\tStep\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}".format(episode, i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators))
+                memory = self.memory.record(self, self.env)
+                if len(memory) > 0:
+                    info += '\t' + format_record(memory)
                 log.write(info+'\n')
                 log.flush()
                 timesteps += 1
+                self.timer.lap('logging')
 
                 if self.args.env_type == 'simple_population_dynamics':
-                    if i % self.args.increase_every == 0:
+                    if i % self.args.increase_every == 0 and not self.memory.throttled:
                         self.env.increase_prey(self.args.prey_increase_prob)
                         self.env.increase_predator(self.args.predator_increase_prob)
                     if len(self.env.predators) < 2 or len(self.env.preys) < 2 or len(self.env.preys) > 10000 or len(self.env.predators) > 10000:
+                        if renderer is not None:
+                            renderer.close()
+                        if trace is not None:
+                            trace.close()
                         log.close()
                         break
-                else:
+                elif not self.memory.throttled:
                     self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob)
                     self.env.crossover_predator(self.args.crossover_scope, crossover_rate=self.args.predator_increase_prob)
+                self.timer.lap('crossover')
 
                 if i % update_period:
                     self.update_params()
+                self.timer.lap('update_params')
+                self.timer.step_end()
 
 
+            self.timer.episode_end(episode, log_dir)
             #images = [os.path.join(img_dir, ("{:d}.png".format(j+1))) for j in range(timesteps)]
             #self.env.make_video(images, outvid=os.path.join(img_dir, 'episode_{:d}.avi'.format(rounds)))
             self.save_model(model_dir, episode)
+            self.checkpoint_manager.save(self.checkpoint_state(episode, eps_greedy, rounds, timesteps), episode, total_reward/(i+1))
+
+        if renderer is not None:
+            renderer.close()
+        if trace is not None:
+            trace.close()
+        if log is not None:
+            log.close()
+        self.checkpoint_manager.close()
 
     def test(self, test_step=200000):
         total_reward = 0
@@ -226,13 +299,17 @@ class DDQN(nn.Module):
         except:
             shutil.rmtree(log_dir)
             os.makedirs(log_dir)
-        log = open(os.path.join(log_dir, 'log.txt'), 'w')
+        log = open_log_writer(os.path.join(log_dir, 'log.txt'), 'w', getattr(self.args, 'compress_logs', False))
+        renderer = FrameRenderer.from_args(os.path.join(img_dir, 'video.avi'), self.args) if self.video_flag else None
+        trace = TraceWriter.from_args(os.path.join(log_dir, 'trace'), self.args)
 
         timesteps = 0
 
         for i in range(test_step):
             if self.video_flag:
-                self.env.dump_image(os.path.join(img_dir, '{:d}.png'.format(timesteps+1)))
+                renderer.render(self.env)
+            if trace is not None:
+                trace.record(self.env, timesteps)
 
             actions = []
             ids = []
@@ -287,12 +364,43 @@ class DDQN(nn.Module):
 
 
             if len(self.env.predators) < 1 or len(self.env.preys) < 1 or len(self.env.predators) > 10000 or len(self.env.preys) > 10000:
-                log.close()
                 break
+        log.close()
+        if renderer is not None:
+            renderer.close()
+        if trace is not None:
+            trace.close()
 
 
     def save_model(self, model_dir, episode):
-        torch.save(self.q_net, os.path.join(model_dir, "model_{:d}.h5".format(episode)))
+        if self.checkpoint_manager is not None:
+            self.checkpoint_manager.save_model(self.q_net, os.path.join(model_dir, "model_{:d}.h5".format(episode)))
+        else:
+            torch.save(self.q_net, os.path.join(model_dir, "model_{:d}.h5".format(episode)))
+
+    def checkpoint_state(self, episode, eps_greedy, rounds, timesteps):
+        '''
+        Everything needed to resume training after the given episode
+        '''
+        return {'episode': episode,
+                'eps_greedy': eps_greedy,
+                'rounds': rounds,
+                'timesteps': timesteps,
+                'q_net': self.q_net.state_dict(),
+                'target_q_net': self.target_q_net.state_dict(),
+                'opt': self.opt.state_dict(),
+                'agent_embeddings': dict(self.agent_embeddings),
+                'world': world_to_columns(self.env),
+                'rng': get_rng_state()}
+
+    def restore_checkpoint(self, state):
+        self.q_net.load_state_dict(state['q_net'])
+        self.target_q_net.load_state_dict(state['target_q_net'])
+        self.opt.load_state_dict(state['opt'])
+        self.agent_embeddings = state['agent_embeddings']
+        columns_to_world(self.env, state['world'])
+        set_rng_state(state['rng'])
+        return state['episode']+1, state['eps_greedy'], state['rounds'], state['timesteps']
 
 
 
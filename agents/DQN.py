@@ -12,8 +12,15 @@ from tqdm import tqdm
 import gc
 #from torch.utils.tensorboard import SummaryWriter
 import shutil
-from utils import plot_dynamics, plot_diversity
+from plot_worker import plot_dynamics, plot_diversity
+from metrics_log import StepLogger, step_record
+from renderer import FrameRenderer
+from world_trace import TraceWriter
+from timing import PhaseTimer
+from memory import MemoryMonitor
 from garl_gym import scenarios
+from checkpoint import CheckpointManager, get_rng_state, set_rng_state
+from world_state import world_to_columns, columns_to_world
 
 
 class DQN(nn.Module):
@@ -44,6 +51,10 @@ class DQN(nn.Module):
         self.opt = opt(self.q_net.parameters(), lr)
         self.target_q_net = deepcopy(q_net).type(self.dtype)
 
+        self.checkpoint_manager = None
+        self.timer = PhaseTimer.from_args(args)
+        self.memory = MemoryMonitor.from_args(args)
+
     def train(self,
               episodes=100,
               episode_step=500,
@@ -51,7 +62,8 @@ class DQN(nn.Module):
               min_greedy=0.3,
               max_greedy=0.9,
               greedy_step=6000,
-              update_period=10):
+              update_period=10,
+              resume=False):
 
         if self.args.env_type == 'simple_population_dynamics':
             get_obs = scenarios.simple_population_dynamics.get_obs
@@ -69,22 +81,51 @@ class DQN(nn.Module):
         #eps_greedy = 0.9
 
         rounds = 0
+        start_episode = 0
         model_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'models')
-        try:
-            os.makedirs(model_dir)
-        except:
-            shutil.rmtree(model_dir)
+        checkpoint_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'checkpoints')
+        if not resume:
+            try:
+                os.makedirs(model_dir)
+            except:
+                shutil.rmtree(model_dir)
+                os.makedirs(model_dir)
+            if os.path.exists(checkpoint_dir):
+                shutil.rmtree(checkpoint_dir)
+        elif not os.path.exists(model_dir):
             os.makedirs(model_dir)
-
-        for episode in range(episodes):
+        self.checkpoint_manager = CheckpointManager(checkpoint_dir,
+                                                    keep_last=getattr(self.args, 'checkpoint_keep_last', 3),
+                                                    keep_best=getattr(self.args, 'checkpoint_keep_best', 1))
+
+        log, renderer, trace = None, None, None
+        if resume:
+            state = self.checkpoint_manager.load_latest()
+            if state is not None:
+                start_episode, eps_greedy, rounds, timesteps = self.restore_checkpoint(state)
+                img_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'images',str(rounds-1))
+                log_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'logs', str(rounds-1))
+                log = StepLogger.from_args(log_dir, self.args, 'a')
+                renderer = FrameRenderer.from_args(os.path.join(img_dir, 'video_{:d}.avi'.format(timesteps)), self.args) if self.video_flag else None
+                trace = TraceWriter.from_args(os.path.join(log_dir, 'trace'), self.args, 'a')
+
+        for episode in range(start_episode, episodes):
             loss = 0
             total_reward = 0
             bar = tqdm()
 
 
             #if episode==0 or len(self.env.predators) < 2 or len(self.env.preys) < 2 or len(self.env.preys) > 15000 or len(self.env.predators) > 15000:
-            if episode==0:
+            # a new round is started when the population collapsed, which closed the writers
+            if episode==0 or log is None or log.closed:
                 #or len(self.env.predators) < 2 or len(self.env.preys) < 2 or len(self.env.preys) > 15000 or len(self.env.predators) > 15000:
+                # writers of the previous round, or of the round resumed with 'a'
+                if renderer is not None:
+                    renderer.close()
+                if trace is not None:
+                    trace.close()
+                if log is not None:
+                    log.close()
                 obs = self.env.reset()
 
                 img_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'images',str(rounds))
@@ -99,14 +140,19 @@ class DQN(nn.Module):
                 except:
                     shutil.rmtree(log_dir)
                     os.makedirs(log_dir)
-                log = open(os.path.join(log_dir, 'log.txt'), 'w')
+                log = StepLogger.from_args(log_dir, self.args)
+                renderer = FrameRenderer.from_args(os.path.join(img_dir, 'video.avi'), self.args) if self.video_flag else None
+                trace = TraceWriter.from_args(os.path.join(log_dir, 'trace'), self.args)
                 rounds += 1
                 timesteps = 0
 
             for i in range(episode_step):
                 episode_reward = 0
                 if self.video_flag:
-                    self.env.dump_image(os.path.join(img_dir, '{:d}.png'.format(timesteps+1)))
+                    renderer.render(self.env)
+                if trace is not None:
+                    trace.record(self.env, timesteps)
+                self.timer.start()
 
                 eps_greedy += g_step
                 eps_greedy = np.clip(eps_greedy, min_greedy, max_greedy)
@@ -117,6 +163,7 @@ class DQN(nn.Module):
                 action_batches = []
                 #obs = self.env.render(only_view=True)
                 obs = get_obs(self.env, only_view=True)
+                self.timer.lap('get_obs')
                 view_batches = []
                 view_ids = []
                 view_values_list = []
@@ -149,12 +196,15 @@ class DQN(nn.Module):
                     view_ids.append(batch_id)
                     view_values_list.append(batch_view)
                 num_batches = j
+                self.timer.lap('forward')
 
                 actions = dict(zip(ids, actions))
                 #next_view_batches, rewards = self.env.step(actions)
 
                 self.env.take_actions(actions)
+                self.timer.lap('take_actions')
                 next_view_batches, rewards, killed = get_obs(self.env)
+                self.timer.lap('get_obs')
                 self.env.killed = killed
                 episode_reward += np.sum(list(rewards.values()))
                 total_reward += (episode_reward / len(obs))
@@ -198,6 +248,7 @@ class DQN(nn.Module):
                     #torch.nn.utils.clip_grad_norm_(self.q_net.parameters(), 1.)
                     self.opt.step()
                     loss_batch += l.cpu().detach().data.numpy()
+                self.timer.lap('learn')
 
                 increase_predators = self.env.increase_predators
                 increase_preys = self.env.increase_preys
@@ -206,6 +257,7 @@ class DQN(nn.Module):
                     self.remove_dead_agent_emb(killed)
                 else:
                     self.env.remove_dead_agent_emb(killed)
+                self.timer.lap('remove_dead_agents')
 
                 loss += (loss_batch/(j+1))
                 view_batches = next_view_batches
@@ -213,20 +265,22 @@ class DQN(nn.Module):
                 bar.set_description(msg)
                 bar.update(1)
 
-                info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators),increase_predators, increase_preys, len(killed))
-                log.write(info+'\n')
-                log.flush()
+                info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed)
+                info.update(self.memory.record(self, self.env))
+                log.write(info)
                 timesteps += 1
+                self.timer.lap('logging')
 
                 if self.args.env_type == 'simple_population_dynamics':
-                    if i % self.args.increase_every == 0:
+                    if i % self.args.increase_every == 0 and not self.memory.throttled:
                         self.env.increase_prey(self.args.prey_increase_prob)
                         self.env.increase_predator(self.args.predator_increase_prob)
                 elif self.args.env_type in ['simple_population_dynamics_ga', 'simple_population_dynamics_ga_utility']:
-                    self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob)
-                    #self.env.increase_prey(self.args.prey_increase_prob)
-                    self.env.crossover_predator(self.args.crossover_scope, crossover_rate=self.args.predator_increase_prob)
-                elif self.args.env_type != 'simple_population_dynamics_ga_action':
+                    if not self.memory.throttled:
+                        self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob)
+                        #self.env.increase_prey(self.args.prey_increase_prob)
+                        self.env.crossover_predator(self.args.crossover_scope, crossover_rate=self.args.predator_increase_prob)
+                elif self.args.env_type != 'simple_population_dynamics_ga_action' and not self.memory.throttled:
                     if len(self.env.preys) < 5000 and len(self.env.preys) >= 100:
                         self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob)
                     if len(self.env.predators) < 5000 and len(self.env.predators)>=100:
@@ -235,7 +289,12 @@ class DQN(nn.Module):
                         self.env.add_preys(100-len(self.env.preys))
                     if len(self.env.predators) < 100:
                         self.env.add_predators(100-len(self.env.predators))
+                self.timer.lap('crossover')
                 if len(self.env.predators) < 2 or len(self.env.preys) < 2 or len(self.env.preys) > 10000 or len(self.env.predators) > 10000:
+                    if renderer is not None:
+                        renderer.close()
+                    if trace is not None:
+                        trace.close()
                     log.close()
                     break
                 #if len(self.env.predators) < 2 or len(self.env.preys) < 2 or len(self.env.preys) > 15000 or len(self.env.predators) > 15000:
@@ -244,9 +303,13 @@ class DQN(nn.Module):
 
                 if i % update_period:
                     self.update_params()
+                self.timer.lap('update_params')
+                self.timer.step_end()
 
 
+            self.timer.episode_end(episode, log_dir)
             log_file = os.path.join(log_dir, 'log.txt')
+            log.flush()
             plot_dynamics(log_file, 0)
             msg = "episode {:03d} avg loss:{:5.4f} avg reward:{:5.3f} eps_greedy {:5.3f}".format(episode, loss/(i+1), total_reward/(i+1), eps_greedy)
             bar.set_description(msg)
@@ -257,6 +320,15 @@ class DQN(nn.Module):
             #images = [os.path.join(img_dir, ("{:d}.png".format(j+1))) for j in range(timesteps)]
             #self.env.make_video(images, outvid=os.path.join(img_dir, 'episode_{:d}.avi'.format(rounds)))
             self.save_model(model_dir, episode)
+            self.checkpoint_manager.save(self.checkpoint_state(episode, eps_greedy, rounds, timesteps), episode, total_reward/(i+1))
+
+        if renderer is not None:
+            renderer.close()
+        if trace is not None:
+            trace.close()
+        if log is not None:
+            log.close()
+        self.checkpoint_manager.close()
 
     def update(self, view_values, action_batches, next_view_values, view_id, rewards):
         z = self.q_net(view_values)
@@ -316,13 +388,17 @@ class DQN(nn.Module):
         except:
             shutil.rmtree(log_dir)
             os.makedirs(log_dir)
-        log = open(os.path.join(log_dir, 'log.txt'), 'w')
+        log = StepLogger.from_args(log_dir, self.args)
+        renderer = FrameRenderer.from_args(os.path.join(img_dir, 'video.avi'), self.args) if self.video_flag else None
+        trace = TraceWriter.from_args(os.path.join(log_dir, 'trace'), self.args)
 
         timesteps = 0
 
         for i in range(test_step):
             if self.video_flag:
-                self.env.dump_image(os.path.join(img_dir, '{:d}.png'.format(timesteps+1)))
+                renderer.render(self.env)
+            if trace is not None:
+                trace.record(self.env, timesteps)
 
             if self.args.env_type == 'simple_population_dynamics_ga_utility' and i % 200 == 0:
                 plot_diversity(self.env.predators.values(), self.env.preys.values(), log_dir, i)
@@ -376,9 +452,8 @@ class DQN(nn.Module):
             bar.set_description(msg)
             bar.update(1)
 
-            info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}".format(i, total_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators), self.env.increase_predators, self.env.increase_preys)
-            log.write(info+'\n')
-            log.flush()
+            info = step_record(i, total_reward/len(obs), self.env, self.env.increase_predators, self.env.increase_preys)
+            log.write(info)
             timesteps += 1
             killed = self.env.remove_dead_agents()
             if self.obs_type == 'dense':
@@ -396,18 +471,48 @@ class DQN(nn.Module):
 
 
             if len(self.env.predators) < 1 or len(self.env.preys) < 1 or len(self.env.predators) > 20000 or len(self.env.preys) > 20000:
-                log.close()
                 break
+        log.close()
+        if renderer is not None:
+            renderer.close()
+        if trace is not None:
+            trace.close()
         #images = [os.path.join(img_dir, ("{:d}.png".format(j+1))) for j in range(timesteps)]
         #self.env.make_video(images, outvid=os.path.join(img_dir, 'episode_{:d}.avi')
 
 
     def save_model(self, model_dir, episode, file_name=None):
         if file_name is None:
-            torch.save(self.q_net, os.path.join(model_dir, "model_{:d}.h5".format(episode)))
+            file_name = "model_{:d}.h5".format(episode)
+        if self.checkpoint_manager is not None:
+            self.checkpoint_manager.save_model(self.q_net, os.path.join(model_dir, file_name))
         else:
             torch.save(self.q_net, os.path.join(model_dir, file_name))
 
+    def checkpoint_state(self, episode, eps_greedy, rounds, timesteps):
+        '''
+        Everything needed to resume training after the given episode
+        '''
+        return {'episode': episode,
+                'eps_greedy': eps_greedy,
+                'rounds': rounds,
+                'timesteps': timesteps,
+                'q_net': self.q_net.state_dict(),
+                'target_q_net': self.target_q_net.state_dict(),
+                'opt': self.opt.state_dict(),
+                'agent_embeddings': dict(self.agent_embeddings),
+                'world': world_to_columns(self.env),
+                'rng': get_rng_state()}
+
+    def restore_checkpoint(self, state):
+        self.q_net.load_state_dict(state['q_net'])
+        self.target_q_net.load_state_dict(state['target_q_net'])
+        self.opt.load_state_dict(state['opt'])
+        self.agent_embeddings = state['agent_embeddings']
+        columns_to_world(self.env, state['world'])
+        set_rng_state(state['rng'])
+        return state['episode']+1, state['eps_greedy'], state['rounds'], state['timesteps']
+
 
 
     def update_params(self):
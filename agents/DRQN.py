@@ -12,8 +12,17 @@ from tqdm import tqdm
 import gc
 #from torch.utils.tensorboard import SummaryWriter
 import shutil
-from utils import plot_dynamics, plot_diversity
+from plot_worker import plot_dynamics, plot_diversity
+from population_stats import PopulationStats
+from live_plot import LivePlot
+from timing import PhaseTimer
+from memory import MemoryMonitor
+from metrics_log import StepLogger, step_record, variation_counts, open_log_writer
+from renderer import FrameRenderer
+from world_trace import TraceWriter
 from garl_gym import scenarios
+from checkpoint import CheckpointManager, get_rng_state, set_rng_state
+from world_state import HealthyStatePool, world_to_columns, columns_to_world
 #from torch.utils.tensorboard import SummaryWriter
 
 
@@ -54,6 +63,12 @@ class DRQN(nn.Module):
         else:
             self.experiment_type = None
 
+        self.checkpoint_manager = None
+        self.state_pool = None
+        self.population_stats = PopulationStats.from_args(args)
+        self.timer = PhaseTimer.from_args(args)
+        self.memory = MemoryMonitor.from_args(args)
+
 
     def train(self,
               episodes=100,
@@ -62,7 +77,8 @@ class DRQN(nn.Module):
               min_greedy=0.3,
               max_greedy=0.9,
               greedy_step=6000,
-              update_period=10):
+              update_period=10,
+              resume=False):
 
         if self.args.env_type == 'simple_population_dynamics':
             get_obs = scenarios.simple_population_dynamics.get_obs
@@ -84,14 +100,44 @@ class DRQN(nn.Module):
         #eps_greedy = 0.9
 
         rounds = 0
+        start_episode = 0
         model_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'models')
-        try:
-            os.makedirs(model_dir)
-        except:
-            shutil.rmtree(model_dir)
+        checkpoint_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'checkpoints')
+        if not resume:
+            try:
+                os.makedirs(model_dir)
+            except:
+                shutil.rmtree(model_dir)
+                os.makedirs(model_dir)
+            if os.path.exists(checkpoint_dir):
+                shutil.rmtree(checkpoint_dir)
+        elif not os.path.exists(model_dir):
             os.makedirs(model_dir)
-
-        for episode in range(episodes):
+        self.checkpoint_manager = CheckpointManager(checkpoint_dir,
+                                                    keep_last=getattr(self.args, 'checkpoint_keep_last', 3),
+                                                    keep_best=getattr(self.args, 'checkpoint_keep_best', 1))
+
+        # Worlds with healthy populations to restart from instead of env.reset()
+        state_pool_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'state_pool')
+        state_pool_every = getattr(self.args, 'state_pool_every', 100)
+        state_pool_burn_in = getattr(self.args, 'state_pool_burn_in', 1000)
+        if not resume and os.path.exists(state_pool_dir):
+            shutil.rmtree(state_pool_dir)
+        if getattr(self.args, 'state_pool_size', 8) > 0:
+            self.state_pool = HealthyStatePool.from_args(self.args, pool_dir=state_pool_dir)
+
+        log, renderer, trace = None, None, None
+        if resume:
+            state = self.checkpoint_manager.load_latest()
+            if state is not None:
+                start_episode, eps_greedy, rounds, timesteps = self.restore_checkpoint(state)
+                img_dir, log_dir = self.get_dir(rounds-1)
+                log = StepLogger.from_args(log_dir, self.args, 'a')
+                renderer = FrameRenderer.from_args(os.path.join(img_dir, 'video_{:d}.avi'.format(timesteps)), self.args) if self.video_flag else None
+                trace = TraceWriter.from_args(os.path.join(log_dir, 'trace'), self.args, 'a')
+                self.population_stats.reset()
+
+        for episode in range(start_episode, episodes):
             loss = 0
             total_reward = 0
             bar = tqdm()
@@ -100,16 +146,34 @@ class DRQN(nn.Module):
             if episode==0 or len(self.env.predators) < 2 or len(self.env.preys) < 2 or len(self.env.preys) > self.args.prey_capacity or len(self.env.predators) > self.args.predator_capacity:
             #if episode==0:
                 #or len(self.env.predators) < 2 or len(self.env.preys) < 2 or len(self.env.preys) > 15000 or len(self.env.predators) > 15000:
-                obs = self.env.reset()
+                if episode > 0 and self.state_pool is not None and self.state_pool.restore(self.env):
+                    # ids of the restored agents are unrelated to the ids of the collapsed world
+                    self.agent_embeddings = {}
+                    self.reset_states()
+                else:
+                    obs = self.env.reset()
+                # writers of the previous round, or of the round resumed with 'a'
+                if renderer is not None:
+                    renderer.close()
+                if trace is not None:
+                    trace.close()
+                if log is not None:
+                    log.close()
                 img_dir, log_dir = self.create_dir(rounds)
-                log = open(os.path.join(log_dir, 'log.txt'), 'w')
+                log = StepLogger.from_args(log_dir, self.args)
+                renderer = FrameRenderer.from_args(os.path.join(img_dir, 'video.avi'), self.args) if self.video_flag else None
+                trace = TraceWriter.from_args(os.path.join(log_dir, 'trace'), self.args)
+                self.population_stats.reset()
                 rounds += 1
                 timesteps = 0
 
             for i in range(episode_step):
                 episode_reward = 0
                 if self.video_flag:
-                    self.env.dump_image(os.path.join(img_dir, '{:d}.png'.format(timesteps+1)))
+                    renderer.render(self.env)
+                if trace is not None:
+                    trace.record(self.env, timesteps)
+                self.timer.start()
 
                 eps_greedy += g_step
                 eps_greedy = np.clip(eps_greedy, min_greedy, max_greedy)
@@ -126,126 +190,15 @@ class DRQN(nn.Module):
                 cell_states = []
 
                 trained_env = deepcopy(self.env)
+                self.timer.lap('deepcopy')
 
                 obs = get_obs(trained_env, only_view=True)
-                current_obs = obs
-                num_batches = len(current_obs)//self.args.batch_size
-                if len(current_obs) > self.args.batch_size*num_batches:
+                self.timer.lap('get_obs')
+                num_batches = len(obs)//self.args.batch_size
+                if len(obs) > self.args.batch_size*num_batches:
                     num_batches += 1
 
-                next_hidden_states_list = None
-                next_cell_states_list = None
-                hidden_states_list = None
-                cell_states_list = None
-                loss_batch = 0
-                for j in range(self.args.time_step):
-                    actions = []
-                    ids = []
-                    action_batches = []
-                    view_batches = []
-                    view_ids = []
-                    view_values_list = []
-                    view_agent_embeddings_list = []
-                    hidden_states = []
-                    cell_states = []
-                    outs = []
-                    for k in range(num_batches):
-                        view = current_obs[k*self.args.batch_size:(k+1)*self.args.batch_size]
-
-                        batch_id, batch_view, batch_agent_embeddings = self.process_view_with_emb_batch(view)
-                        view_agent_embeddings_list.append(batch_agent_embeddings)
-
-                        ## Initial State: Zeros
-                        if j == 0:
-                            init_hidden_state, init_cell_state = self.q_net.init_hidden_states(len(view))
-                            out, hidden_state , cell_state = self.q_net(batch_view, batch_agent_embeddings,
-                                                                        Variable(torch.from_numpy(init_hidden_state)).type(self.dtype),
-                                                                        Variable(torch.from_numpy(init_cell_state)).type(self.dtype))
-                        else:
-                            out, hidden_state , cell_state = self.q_net(batch_view, batch_agent_embeddings, hidden_states_list[k], cell_states_list[k])
-
-                        tmp_action = []
-                        for m in range(len(view)):
-                            if np.random.rand() < eps_greedy:
-                                tmp_action.append(int(out[m].max(0)[1].cpu()))
-                            else:
-                                tmp_action.append(np.random.randint(self.num_actions))
-
-                        ids.extend(batch_id)
-                        actions.extend(tmp_action)
-                        action_batches.append(tmp_action)
-                        view_batches.append(view)
-                        view_ids.append(batch_id)
-                        view_values_list.append(batch_view)
-                        hidden_states.append(hidden_state)
-                        cell_states.append(cell_state)
-                        outs.append(out)
-                    hidden_states_list = hidden_states
-                    cell_states_list = cell_states
-
-                    actions = dict(zip(ids, actions))
-                    trained_env.take_actions(actions)
-                    if self.args.time_step == j+1:
-                        next_obs, rewards, killed = get_obs(trained_env)
-                    else:
-                        next_obs = get_obs(trained_env, only_view=True)
-
-
-                    next_hidden_states = []
-                    next_cell_states = []
-                    for k in range(num_batches):
-                        view_id = view_ids[k]
-                        view_values = view_values_list[k]
-                        next_view = next_obs[k*self.args.batch_size:(k+1)*self.args.batch_size]
-                        next_view_id, next_view_values, next_agent_embeddings = self.process_view_with_emb_batch(next_view)
-                        z, hidden_state, cell_state = self.q_net(view_values, view_agent_embeddings_list[k], hidden_states[k], cell_states[k])
-                        #z = outs[k]
-
-                        ## Init hidden
-                        if j == 0:
-                            init_next_hidden_state, init_next_cell_state = self.target_q_net.init_hidden_states(len(next_view))
-                            next_q_values, next_hidden_state, next_cell_state = self.target_q_net(next_view_values,
-                                                                                                  next_agent_embeddings,
-                                                                                                  Variable(torch.from_numpy(init_next_hidden_state)).type(self.dtype),
-                                                                                                  Variable(torch.from_numpy(init_next_cell_state)).type(self.dtype))
-                        else:
-                            next_q_values, next_hidden_state, next_cell_state = self.target_q_net(next_view_values, next_agent_embeddings, next_hidden_states_list[k], next_cell_states_list[k])
-                        next_hidden_states.append(next_hidden_state.detach())
-                        next_cell_states.append(next_cell_state.detach())
-
-                        if self.args.time_step == j+1:
-                            prior_action = self.q_net(next_view_values, next_agent_embeddings, next_hidden_states_list[k], next_cell_states_list[k])[0].max(1)[1].detach()
-                            q_value = z.gather(1, Variable(torch.Tensor(action_batches[k])).view(len(view_values), 1).type(self.dlongtype))
-                            #max_next_q_values = next_q_values.max(1)[0].detach()
-                            max_next_q_values = next_q_values.gather(1, prior_action.view(-1, 1).type(self.dlongtype)).detach()
-
-                            reward_value = []
-                            for m, id in enumerate(view_id):
-                                if id in rewards.keys():
-                                    reward_value.append(rewards[id])
-                                    #if rewards[id] < -0.001:
-                                        #max_next_q_values[m] = 0
-                                else:
-                                    reward_value.append(0.)
-                            reward_value = np.array(reward_value)
-                            target = Variable(torch.from_numpy(reward_value)).type(self.dtype).view(-1, 1) + max_next_q_values * self.gamma
-                            #target = target.detach().view(len(target), 1) # we do not want to do back-propagation
-                            target = target.detach()
-                            l = self.loss_func(q_value, target)
-
-                            self.opt.zero_grad()
-
-                            l.backward()
-                            clip_grad_norm(self.q_net.parameters(), 0.1)
-                            #torch.nn.utils.clip_grad_norm_(self.q_net.parameters(), 1.)
-                            self.opt.step()
-                            loss_batch += l.cpu().detach().data.numpy()
-
-
-
-                    current_obs = next_obs
-                    next_hidden_states_list = next_hidden_states
-                    next_cell_states_list = next_cell_states
+                loss_batch = self.lookahead(trained_env, obs, get_obs, eps_greedy)
 
                 actions = []
                 ids = []
@@ -256,7 +209,9 @@ class DRQN(nn.Module):
 
                         batch_id, batch_view, batch_agent_embeddings, hidden_state, cell_state = self.process_view_with_emb_batch(view, is_states=True)
                         view_agent_embeddings_list.append(batch_agent_embeddings)
+                        self.timer.lap('tensor')
                         out, hidden_state , cell_state = self.q_net(batch_view, batch_agent_embeddings, hidden_state, cell_state)
+                        self.timer.lap('forward')
                         hidden_state = hidden_state.detach().cpu().numpy()
                         cell_state = cell_state.detach().cpu().numpy()
                         self.update_states(batch_id, hidden_state,  cell_state)
@@ -270,10 +225,13 @@ class DRQN(nn.Module):
 
                         ids.extend(batch_id)
                         actions.extend(tmp_action)
+                        self.timer.lap('action_selection')
 
                 actions = dict(zip(ids, actions))
                 self.env.take_actions(actions)
+                self.timer.lap('take_actions')
                 _, rewards, killed = get_obs(self.env)
+                self.timer.lap('get_obs')
                 episode_reward = np.sum(list(rewards.values()))
                 total_reward += episode_reward
                 self.env.killed = killed
@@ -287,6 +245,7 @@ class DRQN(nn.Module):
                 increase_preys = self.env.increase_preys
                 killed = self.env.remove_dead_agents()
                 self.remove_dead_agent_emb(killed)
+                self.timer.lap('remove_dead_agents')
 
                 #if i % 4 == 0:
                 #    self.reset_states()
@@ -295,48 +254,71 @@ class DRQN(nn.Module):
                 msg = "episode {:03d} episode step {:03d} loss:{:5.4f} reward:{:5.3f} eps_greedy {:5.3f}".format(episode, i, loss_batch/num_batches, episode_reward/len(obs), eps_greedy)
                 bar.set_description(msg)
                 bar.update(1)
+                self.timer.lap('other')
 
 
                 timesteps += 1
+                memory = self.memory.record(self, self.env)
                 if self.args.env_type == 'simple_population_dynamics':
-                    info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators),increase_predators, increase_preys, len(killed))
-                    log.write(info+'\n')
-                    log.flush()
-                    if i % self.args.increase_every == 0:
+                    info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed)
+                    info.update(memory)
+                    log.write(info)
+                    self.timer.lap('logging')
+                    if i % self.args.increase_every == 0 and not self.memory.throttled:
                         self.env.increase_prey(self.args.prey_increase_prob)
                         self.env.increase_predator(self.args.predator_increase_prob)
                 elif self.args.env_type == 'complex_population_dynamics':
-                    info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}\taverage_predator_health\t{:5.3f}\taverage_prey_health\t{:5.3f}\taverage_predator_attack\t{:5.3f}\taverage_prey_attack\t{:5.3f}\taverage_predator_resilience\t{:5.3f}\taverage_prey_resilience\t{:5.3f}\taverage_predator_speed\t{:5.3f}\taverage_prey_speed\t{:5.3f}\tvar_predator_health\t{:5.3f}\tvar_prey_health\t{:5.3f}\tvar_predator_attack\t{:5.3f}\tvar_prey_attack\t{:5.3f}\tvar_predator_resilience\t{:5.3f}\var_prey_resilience\t{:5.3f}\tvar_predator_speed\t{:5.3f}\tvar_prey_speed\t{:5.3f}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators),increase_predators, increase_preys, len(killed), np.mean(self.env.predator_health), np.mean(self.env.prey_health), np.mean(self.env.predator_attack), np.mean(self.env.prey_attack), np.mean(self.env.predator_resilience), np.mean(self.env.prey_resilience), np.mean(self.env.predator_speed), np.mean(self.env.prey_speed), np.var(self.env.predator_health), np.var(self.env.prey_health), np.var(self.env.predator_attack), np.var(self.env.prey_attack), np.var(self.env.predator_resilience), np.var(self.env.prey_resilience), np.var(self.env.predator_speed), np.var(self.env.prey_speed))
-                    log.write(info+'\n')
-                    log.flush()
-                    self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob, mutation_prob=self.args.mutation_prob)
-                    self.env.crossover_predator(self.args.crossover_scope, crossover_rate=self.args.predator_increase_prob, mutation_prob=self.args.mutation_prob)
-                    if i % self.args.increase_every == 0:
+                    info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed)
+                    info.update(self.population_stats.record(self.env, killed=killed))
+                    info.update(memory)
+                    log.write(info)
+                    self.timer.lap('logging')
+                    if not self.memory.throttled:
+                        self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob, mutation_prob=self.args.mutation_prob)
+                        self.env.crossover_predator(self.args.crossover_scope, crossover_rate=self.args.predator_increase_prob, mutation_prob=self.args.mutation_prob)
+                    if i % self.args.increase_every == 0 and not self.memory.throttled:
                         self.env.add_preys(1)
                         self.env.add_predators(1)
                 elif self.args.env_type == 'genetic_population_dynamics':
-                    info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}\taverage_predator_health\t{:5.3f}\taverage_prey_health\t{:5.3f}\taverage_predator_attack\t{:5.3f}\taverage_prey_attack\t{:5.3f}\taverage_predator_resilience\t{:5.3f}\taverage_prey_resilience\t{:5.3f}\taverage_predator_speed\t{:5.3f}\taverage_prey_speed\t{:5.3f}\tvar_predator_health\t{:5.3f}\tvar_prey_health\t{:5.3f}\tvar_predator_attack\t{:5.3f}\tvar_prey_attack\t{:5.3f}\tvar_predator_resilience\t{:5.3f}\var_prey_resilience\t{:5.3f}\tvar_predator_speed\t{:5.3f}\tvar_prey_speed\t{:5.3f}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators),increase_predators, increase_preys, len(killed), np.mean(self.env.predator_health), np.mean(self.env.prey_health), np.mean(self.env.predator_attack), np.mean(self.env.prey_attack), np.mean(self.env.predator_resilience), np.mean(self.env.prey_resilience), np.mean(self.env.predator_speed), np.mean(self.env.prey_speed), np.var(self.env.predator_health), np.var(self.env.prey_health), np.var(self.env.predator_attack), np.var(self.env.prey_attack), np.var(self.env.predator_resilience), np.var(self.env.prey_resilience), np.var(self.env.predator_speed), np.var(self.env.prey_speed))
-                    log.write(info+'\n')
-                    log.flush()
-                    self.env.crossover_prey(self.args.prey_increase_prob, mutation_prob=self.args.mutation_prob)
-                    self.env.crossover_predator(self.args.predator_increase_prob, mutation_prob=self.args.mutation_prob)
+                    info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed)
+                    info.update(self.population_stats.record(self.env, killed=killed))
+                    info.update(memory)
+                    log.write(info)
+                    self.timer.lap('logging')
+                    if not self.memory.throttled:
+                        self.env.crossover_prey(self.args.prey_increase_prob, mutation_prob=self.args.mutation_prob)
+                        self.env.crossover_predator(self.args.predator_increase_prob, mutation_prob=self.args.mutation_prob)
                 elif self.args.env_type != 'simple_population_dynamics_ga_action':
-                    info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators),increase_predators, increase_preys, len(killed))
-                    log.write(info+'\n')
-                    log.flush()
-                    self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob)
-                    self.env.crossover_predator(self.args.crossover_scope, crossover_rate=self.args.predator_increase_prob)
-                    self.env.add_preys(1)
-                    self.env.add_predators(1)
+                    info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed)
+                    info.update(memory)
+                    log.write(info)
+                    self.timer.lap('logging')
+                    if not self.memory.throttled:
+                        self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob)
+                        self.env.crossover_predator(self.args.crossover_scope, crossover_rate=self.args.predator_increase_prob)
+                        self.env.add_preys(1)
+                        self.env.add_predators(1)
+                self.timer.lap('crossover')
                 if len(self.env.predators) < 2 or len(self.env.preys) < 2 or len(self.env.preys) > self.args.prey_capacity or len(self.env.predators) > self.args.predator_capacity:
+                    if renderer is not None:
+                        renderer.close()
+                    if trace is not None:
+                        trace.close()
                     log.close()
                     break
 
+                if self.state_pool is not None and timesteps >= state_pool_burn_in and timesteps % state_pool_every == 0:
+                    self.state_pool.maybe_add(self.env, self.args.predator_capacity, self.args.prey_capacity)
+
                 if i % update_period:
                     self.update_params()
+                self.timer.lap('update_params')
+                self.timer.step_end()
 
 
+            self.timer.episode_end(episode, log_dir)
             log_file = os.path.join(log_dir, 'log.txt')
+            log.flush()
             plot_dynamics(log_file, 0)
             msg = "episode {:03d} avg loss:{:5.4f} avg reward:{:5.3f} eps_greedy {:5.3f}".format(episode, loss/(i+1), total_reward/(i+1), eps_greedy)
             bar.set_description(msg)
@@ -347,6 +329,17 @@ class DRQN(nn.Module):
             #images = [os.path.join(img_dir, ("{:d}.png".format(j+1))) for j in range(timesteps)]
             #self.env.make_video(images, outvid=os.path.join(img_dir, 'episode_{:d}.avi'.format(rounds)))
             self.save_model(model_dir, episode)
+            self.checkpoint_manager.save(self.checkpoint_state(episode, eps_greedy, rounds, timesteps), episode, total_reward/(i+1))
+
+        if renderer is not None:
+            renderer.close()
+        if trace is not None:
+            trace.close()
+        if log is not None:
+            log.close()
+        if self.state_pool is not None:
+            self.state_pool.close()
+        self.checkpoint_manager.close()
 
 
 
@@ -382,20 +375,27 @@ class DRQN(nn.Module):
        # except:
        #     shutil.rmtree(log_dir)
        #     os.makedirs(log_dir)
-        log = open(os.path.join(log_dir, 'log.txt'), 'w')
-        log_local = open(os.path.join(log_dir, 'log_division.txt'), 'w')
+        log = StepLogger.from_args(log_dir, self.args)
+        renderer = FrameRenderer.from_args(os.path.join(img_dir, 'video.avi'), self.args) if self.video_flag else None
+        trace = TraceWriter.from_args(os.path.join(log_dir, 'trace'), self.args)
+        self.population_stats.reset()
+        live_plot = LivePlot(os.path.join(log_dir, 'log.txt'))
+        log_local = open_log_writer(os.path.join(log_dir, 'log_division.txt'), 'w', getattr(self.args, 'compress_logs', False))
 
         timesteps = 0
 
         for i in range(test_step):
             if self.video_flag:
-                self.env.dump_image(os.path.join(img_dir, '{:d}.png'.format(timesteps+1)))
+                renderer.render(self.env)
+            if trace is not None:
+                trace.record(self.env, timesteps)
 
             if self.args.env_type == 'simple_population_dynamics_ga_utility' and i % 200 == 0:
                 plot_diversity(self.env.predators.values(), self.env.preys.values(), log_dir, i)
 
+            # the text log is flushed by the writer thread every flush_interval
             if i % 100 == 0:
-                plot_dynamics(os.path.join(log_dir, 'log.txt'), st=0)
+                live_plot.update()
 
 
             actions = []
@@ -460,7 +460,7 @@ class DRQN(nn.Module):
             bar.set_description(msg)
             bar.update(1)
 
-            info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}".format(i, total_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators), self.env.increase_predators, self.env.increase_preys)
+            info = step_record(i, total_reward/len(obs), self.env, self.env.increase_predators, self.env.increase_preys)
             timesteps += 1
 
             if self.args.env_type == 'simple_population_dynamics':
@@ -468,14 +468,16 @@ class DRQN(nn.Module):
                     self.env.increase_prey(self.args.prey_increase_prob)
                     self.env.increase_predator(self.args.predator_increase_prob)
             elif self.args.env_type == 'complex_population_dynamics':
-                info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}\taverage_predator_health\t{:5.3f}\taverage_prey_health\t{:5.3f}\taverage_predator_attack\t{:5.3f}\taverage_prey_attack\t{:5.3f}\taverage_predator_resilience\t{:5.3f}\taverage_prey_resilience\t{:5.3f}\taverage_predator_speed\t{:5.3f}\taverage_prey_speed\t{:5.3f}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators),increase_predators, increase_preys, len(killed), np.mean(self.env.predator_health), np.mean(self.env.prey_health), np.mean(self.env.predator_attack), np.mean(self.env.prey_attack), np.mean(self.env.predator_resilience), np.mean(self.env.prey_resilience), np.mean(self.env.predator_speed), np.mean(self.env.prey_speed))
+                info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed)
+                info.update(self.population_stats.record(self.env, variance=False, killed=killed))
                 self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob, mutation_prob=self.args.mutation_prob)
                 self.env.crossover_predator(self.args.crossover_scope, crossover_rate=self.args.predator_increase_prob, mutation_prob=self.args.mutation_prob)
                 if i % self.args.increase_every == 0:
                     self.env.add_preys(1)
                     self.env.add_predators(1)
             elif self.args.env_type == 'genetic_population_dynamics':
-                info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}\taverage_predator_health\t{:5.3f}\taverage_prey_health\t{:5.3f}\taverage_predator_attack\t{:5.3f}\taverage_prey_attack\t{:5.3f}\taverage_predator_resilience\t{:5.3f}\taverage_prey_resilience\t{:5.3f}\taverage_predator_speed\t{:5.3f}\taverage_prey_speed\t{:5.3f}\tvar_predator_health\t{:5.3f}\tvar_prey_health\t{:5.3f}\tvar_predator_attack\t{:5.3f}\tvar_prey_attack\t{:5.3f}\tvar_predator_resilience\t{:5.3f}\var_prey_resilience\t{:5.3f}\tvar_predator_speed\t{:5.3f}\tvar_prey_speed\t{:5.3f}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators),increase_predators, increase_preys, len(killed), np.mean(self.env.predator_health), np.mean(self.env.prey_health), np.mean(self.env.predator_attack), np.mean(self.env.prey_attack), np.mean(self.env.predator_resilience), np.mean(self.env.prey_resilience), np.mean(self.env.predator_speed), np.mean(self.env.prey_speed), np.var(self.env.predator_health), np.var(self.env.prey_health), np.var(self.env.predator_attack), np.var(self.env.prey_attack), np.var(self.env.predator_resilience), np.var(self.env.prey_resilience), np.var(self.env.predator_speed), np.var(self.env.prey_speed))
+                info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed)
+                info.update(self.population_stats.record(self.env, killed=killed))
                 self.env.crossover_prey(self.args.prey_increase_prob, mutation_prob=self.args.mutation_prob)
                 self.env.crossover_predator(self.args.predator_increase_prob, mutation_prob=self.args.mutation_prob)
             elif self.args.env_type != 'simple_population_dynamics_ga_action':
@@ -485,25 +487,204 @@ class DRQN(nn.Module):
                 #if len(self.env.predators) < 200:
                 self.env.add_predators(1)
 
-            log.write(info+'\n')
-            log.flush()
+            log.write(info)
 
 
 
             if len(self.env.predators) < 1 or len(self.env.preys) < 1 or len(self.env.predators) > 20000 or len(self.env.preys) > 20000:
-                log.close()
                 break
+        log.close()
+        live_plot.close()
+        if renderer is not None:
+            renderer.close()
+        if trace is not None:
+            trace.close()
         #images = [os.path.join(img_dir, ("{:d}.png".format(j+1))) for j in range(timesteps)]
         #self.env.make_video(images, outvid=os.path.join(img_dir, 'episode_{:d}.avi')
 
 
     def save_model(self, model_dir, episode, file_name=None):
         if file_name is None:
-            torch.save(self.q_net, os.path.join(model_dir, "model_{:d}.h5".format(episode)))
+            file_name = "model_{:d}.h5".format(episode)
+        if self.checkpoint_manager is not None:
+            self.checkpoint_manager.save_model(self.q_net, os.path.join(model_dir, file_name))
         else:
             torch.save(self.q_net, os.path.join(model_dir, file_name))
 
+    def checkpoint_state(self, episode, eps_greedy, rounds, timesteps):
+        '''
+        Everything needed to resume training after the given episode
+        '''
+        return {'episode': episode,
+                'eps_greedy': eps_greedy,
+                'rounds': rounds,
+                'timesteps': timesteps,
+                'q_net': self.q_net.state_dict(),
+                'target_q_net': self.target_q_net.state_dict(),
+                'opt': self.opt.state_dict(),
+                'agent_embeddings': dict(self.agent_embeddings),
+                'agent_hidden_states': dict(self.agent_hidden_states),
+                'agent_cell_states': dict(self.agent_cell_states),
+                'world': world_to_columns(self.env),
+                'rng': get_rng_state()}
+
+    def restore_checkpoint(self, state):
+        self.q_net.load_state_dict(state['q_net'])
+        self.target_q_net.load_state_dict(state['target_q_net'])
+        self.opt.load_state_dict(state['opt'])
+        self.agent_embeddings = state['agent_embeddings']
+        self.agent_hidden_states = state['agent_hidden_states']
+        self.agent_cell_states = state['agent_cell_states']
+        columns_to_world(self.env, state['world'])
+        set_rng_state(state['rng'])
+        return state['episode']+1, state['eps_greedy'], state['rounds'], state['timesteps']
+
+
+
+    def lookahead(self, env, obs, get_obs, eps_greedy):
+        '''
+        Roll a copy of the world forward for args.time_step steps and train the
+        Q-network on the last of them
+
+        Args:
+            env: Copy of the environment, changed by the roll-out
+            obs: Views of the agents of env
+            get_obs: Observation function of the scenario
+            eps_greedy: Probability of a greedy action
+
+        Returns:
+            Sum of the losses of the batches
+        '''
+        current_obs = obs
+        num_batches = len(current_obs)//self.args.batch_size
+        if len(current_obs) > self.args.batch_size*num_batches:
+            num_batches += 1
 
+        next_hidden_states_list = None
+        next_cell_states_list = None
+        hidden_states_list = None
+        cell_states_list = None
+        loss_batch = 0
+        for j in range(self.args.time_step):
+            actions = []
+            ids = []
+            action_batches = []
+            view_batches = []
+            view_ids = []
+            view_values_list = []
+            view_agent_embeddings_list = []
+            hidden_states = []
+            cell_states = []
+            outs = []
+            for k in range(num_batches):
+                view = current_obs[k*self.args.batch_size:(k+1)*self.args.batch_size]
+
+                batch_id, batch_view, batch_agent_embeddings = self.process_view_with_emb_batch(view)
+                view_agent_embeddings_list.append(batch_agent_embeddings)
+                self.timer.lap('tensor')
+
+                ## Initial State: Zeros
+                if j == 0:
+                    init_hidden_state, init_cell_state = self.q_net.init_hidden_states(len(view))
+                    out, hidden_state , cell_state = self.q_net(batch_view, batch_agent_embeddings,
+                                                                Variable(torch.from_numpy(init_hidden_state)).type(self.dtype),
+                                                                Variable(torch.from_numpy(init_cell_state)).type(self.dtype))
+                else:
+                    out, hidden_state , cell_state = self.q_net(batch_view, batch_agent_embeddings, hidden_states_list[k], cell_states_list[k])
+                self.timer.lap('forward')
+
+                tmp_action = []
+                for m in range(len(view)):
+                    if np.random.rand() < eps_greedy:
+                        tmp_action.append(int(out[m].max(0)[1].cpu()))
+                    else:
+                        tmp_action.append(np.random.randint(self.num_actions))
+
+                ids.extend(batch_id)
+                actions.extend(tmp_action)
+                action_batches.append(tmp_action)
+                view_batches.append(view)
+                view_ids.append(batch_id)
+                view_values_list.append(batch_view)
+                hidden_states.append(hidden_state)
+                cell_states.append(cell_state)
+                outs.append(out)
+                self.timer.lap('action_selection')
+            hidden_states_list = hidden_states
+            cell_states_list = cell_states
+
+            actions = dict(zip(ids, actions))
+            env.take_actions(actions)
+            self.timer.lap('take_actions')
+            if self.args.time_step == j+1:
+                next_obs, rewards, killed = get_obs(env)
+            else:
+                next_obs = get_obs(env, only_view=True)
+            self.timer.lap('get_obs')
+
+
+            next_hidden_states = []
+            next_cell_states = []
+            for k in range(num_batches):
+                view_id = view_ids[k]
+                view_values = view_values_list[k]
+                next_view = next_obs[k*self.args.batch_size:(k+1)*self.args.batch_size]
+                next_view_id, next_view_values, next_agent_embeddings = self.process_view_with_emb_batch(next_view)
+                self.timer.lap('tensor')
+                z, hidden_state, cell_state = self.q_net(view_values, view_agent_embeddings_list[k], hidden_states[k], cell_states[k])
+                #z = outs[k]
+
+                ## Init hidden
+                if j == 0:
+                    init_next_hidden_state, init_next_cell_state = self.target_q_net.init_hidden_states(len(next_view))
+                    next_q_values, next_hidden_state, next_cell_state = self.target_q_net(next_view_values,
+                                                                                          next_agent_embeddings,
+                                                                                          Variable(torch.from_numpy(init_next_hidden_state)).type(self.dtype),
+                                                                                          Variable(torch.from_numpy(init_next_cell_state)).type(self.dtype))
+                else:
+                    next_q_values, next_hidden_state, next_cell_state = self.target_q_net(next_view_values, next_agent_embeddings, next_hidden_states_list[k], next_cell_states_list[k])
+                next_hidden_states.append(next_hidden_state.detach())
+                next_cell_states.append(next_cell_state.detach())
+                self.timer.lap('forward')
+
+                if self.args.time_step == j+1:
+                    prior_action = self.q_net(next_view_values, next_agent_embeddings, next_hidden_states_list[k], next_cell_states_list[k])[0].max(1)[1].detach()
+                    q_value = z.gather(1, Variable(torch.Tensor(action_batches[k])).view(len(view_values), 1).type(self.dlongtype))
+                    #max_next_q_values = next_q_values.max(1)[0].detach()
+                    max_next_q_values = next_q_values.gather(1, prior_action.view(-1, 1).type(self.dlongtype)).detach()
+                    self.timer.lap('forward')
+
+                    reward_value = []
+                    for m, id in enumerate(view_id):
+                        if id in rewards.keys():
+                            reward_value.append(rewards[id])
+                            #if rewards[id] < -0.001:
+                                #max_next_q_values[m] = 0
+                        else:
+                            reward_value.append(0.)
+                    reward_value = np.array(reward_value)
+                    target = Variable(torch.from_numpy(reward_value)).type(self.dtype).view(-1, 1) + max_next_q_values * self.gamma
+                    #target = target.detach().view(len(target), 1) # we do not want to do back-propagation
+                    target = target.detach()
+                    l = self.loss_func(q_value, target)
+                    self.timer.lap('loss')
+
+                    self.opt.zero_grad()
+
+                    l.backward()
+                    clip_grad_norm(self.q_net.parameters(), 0.1)
+                    #torch.nn.utils.clip_grad_norm_(self.q_net.parameters(), 1.)
+                    self.timer.lap('backward')
+                    self.opt.step()
+                    loss_batch += l.cpu().detach().data.numpy()
+                    self.timer.lap('optimizer')
+
+
+
+            current_obs = next_obs
+            next_hidden_states_list = next_hidden_states
+            next_cell_states_list = next_cell_states
+        return loss_batch
 
     def update_params(self):
         self.target_q_net = deepcopy(self.q_net)
@@ -685,6 +866,7 @@ class DRQN(nn.Module):
 
         self.trained_q_net = deepcopy(self.q_net)
 
+        log, renderer, trace = None, None, None
         for episode in range(episodes):
             loss = 0
             total_reward = 0
@@ -694,15 +876,27 @@ class DRQN(nn.Module):
             #if episode==0:
                 #or len(self.env.predators) < 2 or len(self.env.preys) < 2 or len(self.env.preys) > 15000 or len(self.env.predators) > 15000:
                 obs = self.env.reset()
+                # writers of the previous round
+                if renderer is not None:
+                    renderer.close()
+                if trace is not None:
+                    trace.close()
+                if log is not None:
+                    log.close()
                 img_dir, log_dir = self.create_dir(rounds)
-                log = open(os.path.join(log_dir, 'log.txt'), 'w')
+                log = StepLogger.from_args(log_dir, self.args)
+                renderer = FrameRenderer.from_args(os.path.join(img_dir, 'video.avi'), self.args) if self.video_flag else None
+                trace = TraceWriter.from_args(os.path.join(log_dir, 'trace'), self.args)
+                self.population_stats.reset()
                 rounds += 1
                 timesteps = 0
 
             for i in range(episode_step):
                 episode_reward = 0
                 if self.video_flag:
-                    self.env.dump_image(os.path.join(img_dir, '{:d}.png'.format(timesteps+1)))
+                    renderer.render(self.env)
+                if trace is not None:
+                    trace.record(self.env, timesteps)
 
                 actions = []
                 ids = []
@@ -956,17 +1150,16 @@ class DRQN(nn.Module):
 
 
                 if self.args.env_type == 'simple_population_dynamics':
-                    info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_random_preys\t{:d}\tnum_trained_preys\t{:d}\tnum_training_preys\t{:d}\tnum_ramdom_predators\t{:d}\tnum_trained_predators\t{:d}\tnum_training_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.random_preys), len(self.env.trained_preys), len(self.env.training_preys), len(self.env.random_predators), len(self.env.trained_predators), len(self.env.training_predators),increase_predators, increase_preys, len(killed))
-                    log.write(info+'\n')
-                    log.flush()
+                    info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed, counts=variation_counts(self.env))
+                    log.write(info)
                     timesteps += 1
                     if i % self.args.increase_every == 0:
                         self.env.increase_prey(self.args.prey_increase_prob)
                         self.env.increase_predator(self.args.predator_increase_prob)
                 elif self.args.env_type == 'complex_population_dynamics':
-                    info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}\taverage_predator_health\t{:5.3f}\taverage_prey_health\t{:5.3f}\taverage_predator_attack\t{:5.3f}\taverage_prey_attack\t{:5.3f}\taverage_predator_resilience\t{:5.3f}\taverage_prey_resilience\t{:5.3f}\taverage_predator_speed\t{:5.3f}\taverage_prey_speed\t{:5.3f}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators),increase_predators, increase_preys, len(killed), np.mean(self.env.predator_health), np.mean(self.env.prey_health), np.mean(self.env.predator_attack), np.mean(self.env.prey_attack), np.mean(self.env.predator_resilience), np.mean(self.env.prey_resilience), np.mean(self.env.predator_speed), np.mean(self.env.prey_speed))
-                    log.write(info+'\n')
-                    log.flush()
+                    info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed)
+                    info.update(self.population_stats.record(self.env, variance=False, killed=killed))
+                    log.write(info)
                     timesteps += 1
                     self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob, mutation_prob=self.args.mutation_prob)
                     self.env.crossover_predator(self.args.crossover_scope, crossover_rate=self.args.predator_increase_prob, mutation_prob=self.args.mutation_prob)
@@ -974,15 +1167,18 @@ class DRQN(nn.Module):
                         self.env.add_preys(1)
                         self.env.add_predators(1)
                 elif self.args.env_type != 'simple_population_dynamics_ga_action':
-                    info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_random_preys\t{:d}\tnum_trained_preys\t{:d}\tnum_training_preys\t{:d}\tnum_ramdom_predators\t{:d}\tnum_trained_predators\t{:d}\tnum_training_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.random_preys), len(self.env.trained_preys), len(self.env.training_preys), len(self.env.random_predators), len(self.env.trained_predators), len(self.env.training_predators),increase_predators, increase_preys, len(killed))
-                    log.write(info+'\n')
-                    log.flush()
+                    info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed, counts=variation_counts(self.env))
+                    log.write(info)
                     timesteps += 1
                     self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob)
                     self.env.crossover_predator(self.args.crossover_scope, crossover_rate=self.args.predator_increase_prob)
                     self.env.add_preys(1)
                     self.env.add_predators(1)
                 if len(self.env.predator_agents) < 2 or len(self.env.prey_agents) < 2 or len(self.env.prey_agents) > self.args.prey_capacity or len(self.env.predator_agents) > self.args.predator_capacity:
+                    if renderer is not None:
+                        renderer.close()
+                    if trace is not None:
+                        trace.close()
                     log.close()
                     break
                 if i % update_period:
@@ -990,6 +1186,7 @@ class DRQN(nn.Module):
 
 
             log_file = os.path.join(log_dir, 'log.txt')
+            log.flush()
             plot_dynamics(log_file, 0)
             msg = "episode {:03d} avg loss:{:5.4f} avg reward:{:5.3f} eps_greedy {:5.3f}".format(episode, loss/(i+1), total_reward/(i+1), eps_greedy)
             bar.set_description(msg)
@@ -1000,13 +1197,24 @@ class DRQN(nn.Module):
             #images = [os.path.join(img_dir, ("{:d}.png".format(j+1))) for j in range(timesteps)]
             #self.env.make_video(images, outvid=os.path.join(img_dir, 'episode_{:d}.avi'.format(rounds)))
 
-    def create_dir(self, rounds):
+        if renderer is not None:
+            renderer.close()
+        if trace is not None:
+            trace.close()
+        if log is not None:
+            log.close()
+
+    def get_dir(self, rounds):
         if self.experiment_type == 'variation':
             img_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'variation_images', str(self.args.variation_id), str(rounds))
             log_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'variation_logs', str(self.args.variation_id), str(rounds))
         else:
             img_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'images',str(rounds))
             log_dir = os.path.join('results', self.args.env_type, 'exp_{:d}'.format(self.args.experiment_id), 'logs', str(rounds))
+        return img_dir, log_dir
+
+    def create_dir(self, rounds):
+        img_dir, log_dir = self.get_dir(rounds)
         try:
             os.makedirs(img_dir)
         except:
@@ -10,7 +10,13 @@ from tqdm import tqdm
 import gc
 #from torch.utils.tensorboard import SummaryWriter
 import shutil
-from utils import plot_dynamics, plot_diversity
+from plot_worker import plot_diversity
+from population_stats import PopulationStats
+from live_plot import LivePlot
+from metrics_log import StepLogger, step_record
+from renderer import FrameRenderer
+from world_trace import TraceWriter
+from timing import PhaseTimer
 from garl_gym import scenarios
 
 
@@ -22,6 +28,8 @@ class Random(object):
 
         self.num_actions = args.num_actions
         self.video_flag= args.video_flag
+        self.population_stats = PopulationStats.from_args(args)
+        self.timer = PhaseTimer.from_args(args)
 
     def test(self, test_step=200000):
         if self.args.env_type == 'simple_population_dynamics':
@@ -55,38 +63,51 @@ class Random(object):
         #except:
         #    shutil.rmtree(log_dir)
         #    os.makedirs(log_dir)
-        log = open(os.path.join(log_dir, 'log.txt'), 'w')
+        log = StepLogger.from_args(log_dir, self.args)
+        renderer = FrameRenderer.from_args(os.path.join(img_dir, 'video.avi'), self.args) if self.video_flag else None
+        trace = TraceWriter.from_args(os.path.join(log_dir, 'trace'), self.args)
+        self.population_stats.reset()
+        live_plot = LivePlot(os.path.join(log_dir, 'log.txt'))
 
         timesteps = 0
 
         for i in range(test_step):
             if self.video_flag:
-                self.env.dump_image(os.path.join(img_dir, '{:d}.png'.format(timesteps+1)))
+                renderer.render(self.env)
+            if trace is not None:
+                trace.record(self.env, timesteps)
 
             if self.args.env_type == 'simple_population_dynamics_ga_utility' and i % 200 == 0:
                 plot_diversity(self.env.predators.values(), self.env.preys.values(), log_dir, i)
 
+            # the text log is flushed by the writer thread every flush_interval
             if i % 100 == 0:
-                plot_dynamics(os.path.join(log_dir, 'log.txt'), 0)
+                live_plot.update()
 
 
+            self.timer.start()
             obs = get_obs(self.env, only_view=True)
+            self.timer.lap('get_obs')
             actions = {}
             for id, agent in self.env.agents.items():
                 actions[id] = np.random.randint(self.num_actions)
+            self.timer.lap('action_selection')
             self.env.take_actions(actions)
+            self.timer.lap('take_actions')
             next_view_batches, rewards, killed = get_obs(self.env)
+            self.timer.lap('get_obs')
             self.env.killed = killed
             episode_reward = np.sum(list(rewards.values()))
             increase_predators = self.env.increase_predators
             increase_preys = self.env.increase_preys
             killed = self.env.remove_dead_agents()
+            self.timer.lap('remove_dead_agents')
 
             msg = "episode step {:03d}".format(i)
             bar.set_description(msg)
             bar.update(1)
 
-            info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators), increase_predators, increase_preys)
+            info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys)
             timesteps += 1
 
             if self.args.env_type == 'simple_population_dynamics':
@@ -94,14 +115,16 @@ class Random(object):
                     self.env.increase_prey(self.args.prey_increase_prob)
                     self.env.increase_predator(self.args.predator_increase_prob)
             elif self.args.env_type == 'complex_population_dynamics':
-                info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}\taverage_predator_health\t{:5.3f}\taverage_prey_health\t{:5.3f}\taverage_predator_attack\t{:5.3f}\taverage_prey_attack\t{:5.3f}\taverage_predator_resilience\t{:5.3f}\taverage_prey_resilience\t{:5.3f}\taverage_predator_speed\t{:5.3f}\taverage_prey_speed\t{:5.3f}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators),increase_predators, increase_preys, len(killed), np.mean(self.env.predator_health), np.mean(self.env.prey_health), np.mean(self.env.predator_attack), np.mean(self.env.prey_attack), np.mean(self.env.predator_resilience), np.mean(self.env.prey_resilience), np.mean(self.env.predator_speed), np.mean(self.env.prey_speed))
+                info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed)
+                info.update(self.population_stats.record(self.env, variance=False, killed=killed))
                 self.env.crossover_prey(self.args.crossover_scope, crossover_rate=self.args.prey_increase_prob, mutation_prob=self.args.mutation_prob)
                 self.env.crossover_predator(self.args.crossover_scope, crossover_rate=self.args.predator_increase_prob, mutation_prob=self.args.mutation_prob)
                 if i % self.args.increase_every == 0:
                     self.env.add_preys(1)
                     self.env.add_predators(1)
             elif self.args.env_type == 'genetic_population_dynamics':
-                info = "Step\t{:03d}\tReward\t{:5.3f}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}\tkilled_agents\t{:d}\taverage_predator_health\t{:5.3f}\taverage_prey_health\t{:5.3f}\taverage_predator_attack\t{:5.3f}\taverage_prey_attack\t{:5.3f}\taverage_predator_resilience\t{:5.3f}\taverage_prey_resilience\t{:5.3f}\taverage_predator_speed\t{:5.3f}\taverage_prey_speed\t{:5.3f}\tvar_predator_health\t{:5.3f}\tvar_prey_health\t{:5.3f}\tvar_predator_attack\t{:5.3f}\tvar_prey_attack\t{:5.3f}\tvar_predator_resilience\t{:5.3f}\var_prey_resilience\t{:5.3f}\tvar_predator_speed\t{:5.3f}\tvar_prey_speed\t{:5.3f}".format(i, episode_reward/len(obs), len(self.env.agents), len(self.env.preys), len(self.env.predators),increase_predators, increase_preys, len(killed), np.mean(self.env.predator_health), np.mean(self.env.prey_health), np.mean(self.env.predator_attack), np.mean(self.env.prey_attack), np.mean(self.env.predator_resilience), np.mean(self.env.prey_resilience), np.mean(self.env.predator_speed), np.mean(self.env.prey_speed), np.var(self.env.predator_health), np.var(self.env.prey_health), np.var(self.env.predator_attack), np.var(self.env.prey_attack), np.var(self.env.predator_resilience), np.var(self.env.prey_resilience), np.var(self.env.predator_speed), np.var(self.env.prey_speed))
+                info = step_record(i, episode_reward/len(obs), self.env, increase_predators, increase_preys, killed)
+                info.update(self.population_stats.record(self.env, killed=killed))
                 self.env.crossover_prey(self.args.prey_increase_prob, mutation_prob=self.args.mutation_prob)
                 self.env.crossover_predator(self.args.predator_increase_prob, mutation_prob=self.args.mutation_prob)
             elif self.args.env_type != 'simple_population_dynamics_ga_action':
@@ -110,13 +133,21 @@ class Random(object):
                 self.env.add_preys(1)
                 #if len(self.env.predators) < 200:
                 self.env.add_predators(1)
+            self.timer.lap('crossover')
 
-            log.write(info+'\n')
-            log.flush()
+            log.write(info)
+            self.timer.lap('logging')
+            self.timer.step_end()
 
             if len(self.env.predators) < 1 or len(self.env.preys) < 1 or len(self.env.predators) > 20000 or len(self.env.preys) > 20000:
-                log.close()
                 break
+        self.timer.episode_end(0, log_dir)
+        log.close()
+        live_plot.close()
+        if renderer is not None:
+            renderer.close()
+        if trace is not None:
+            trace.close()
         #images = [os.path.join(img_dir, ("{:d}.png".format(j+1))) for j in range(timesteps)]
         #self.env.make_video(images, outvid=os.path.join(img_dir, 'episode_{:d}.avi')
 
@@ -0,0 +1,224 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from attrdict import AttrDict
+from models.QNet import QNet, QNetConv
+from models.DRQNet import DRQNet
+from agents.DQN import DQN
+from agents.DRQN import DRQN
+from benchmarks.harness import run_benchmark, write_results, default_output
+from benchmarks.synthetic import SyntheticEnv, synthetic_obs, make_args
+
+'''
+Microbenchmarks of the hot paths of the agents
+
+Every benchmark runs at each population of --agents on a synthetic world
+(benchmarks/synthetic.py), so no map is simulated and only the code of the
+agents and networks is timed:
+
+    process_view_with_emb_batch  views to tensors in batches (DRQN), with and without recurrent states
+    DRQNet.forward               all agents in batches of --batch_sizes, with and without autograd
+    QNetConv.forward             same
+    update_params                copy of the Q-network to the target network (independent of the population)
+    remove_dead_agent_emb        removal of 10% of the agents from the embedding and state dictionaries
+    DQN.learn_step               views to tensors and update() of every batch, dense observations
+    DRQN.lookahead               time_step steps of look-ahead and the update of the last one
+
+    python benchmarks/bench_agents.py --agents 1000 5000 20000 -k forward
+
+The results are written as JSON with the machine and commit, by default to
+benchmarks/results/agents_<commit>_<time>.json.
+'''
+
+
+def make_drqn(params, env):
+    q_net = DRQNet(params.input_dim, params.lstm_input, params.lstm_out, hidden_dims=params.hidden_dims,
+                   num_actions=params.num_actions, agent_emb_dim=params.agent_emb_dim)
+    return DRQN(params, env, q_net, nn.MSELoss(), optim.RMSprop)
+
+
+def drqn_view_shape(params):
+    return (params.input_dim, params.vision_height, params.vision_width)
+
+
+def batches(items, batch_size):
+    return [items[k:k+batch_size] for k in range(0, len(items), batch_size)]
+
+
+def batch_sizes_of(num_agents, batch_size):
+    '''
+    Sizes of the batches of num_agents agents
+    '''
+    sizes = [batch_size] * (num_agents // batch_size)
+    if num_agents % batch_size:
+        sizes.append(num_agents % batch_size)
+    return sizes
+
+
+def bench_process_view(params, num_agents, is_states):
+    env = SyntheticEnv(num_agents, drqn_view_shape(params))
+    agent = make_drqn(params, env)
+    obs = synthetic_obs(env, only_view=True)
+
+    def fn():
+        for view in batches(obs, params.batch_size):
+            agent.process_view_with_emb_batch(view, is_states=is_states)
+    # embeddings and states of the agents are created by the warm-up round
+    return fn, None
+
+
+def bench_forward(q_net, inputs, num_agents, batch_size, grad):
+    '''
+    Forward all agents in batches, inputs(size) returns the inputs of a batch
+    '''
+    sizes = batch_sizes_of(num_agents, batch_size)
+    cached = {size: inputs(size) for size in set(sizes)}
+
+    def fn():
+        with torch.set_grad_enabled(grad):
+            for size in sizes:
+                q_net(*cached[size])
+    return fn, None
+
+
+def bench_drqnet_forward(params, num_agents, batch_size, grad):
+    dtype = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
+    q_net = DRQNet(params.input_dim, params.lstm_input, params.lstm_out, hidden_dims=params.hidden_dims,
+                   num_actions=params.num_actions, agent_emb_dim=params.agent_emb_dim).type(dtype)
+
+    def inputs(size):
+        h, c = q_net.init_hidden_states(size)
+        return (torch.rand(size, *drqn_view_shape(params)).type(dtype),
+                torch.rand(size, params.agent_emb_dim).type(dtype),
+                torch.from_numpy(h).type(dtype),
+                torch.from_numpy(c).type(dtype))
+    return bench_forward(q_net, inputs, num_agents, batch_size, grad)
+
+
+def bench_qnetconv_forward(params, num_agents, batch_size, grad):
+    dtype = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
+    q_net = QNetConv(params.input_dim, hidden_dims=params.hidden_dims, num_actions=params.num_actions,
+                     agent_emb_dim=params.agent_emb_dim).type(dtype)
+
+    def inputs(size):
+        # two stride-2 convolutions down to the 7x7 maps of the linear layer
+        return (torch.rand(size, params.input_dim, 25, 25).type(dtype),
+                torch.rand(size, params.agent_emb_dim).type(dtype))
+    return bench_forward(q_net, inputs, num_agents, batch_size, grad)
+
+
+def bench_update_params(params):
+    agent = make_drqn(params, SyntheticEnv(0, drqn_view_shape(params)))
+    return agent.update_params, None
+
+
+def bench_remove_dead_agent_emb(params, num_agents):
+    env = SyntheticEnv(num_agents, drqn_view_shape(params))
+    agent = make_drqn(params, env)
+    h, c = agent.q_net.init_hidden_states(1)
+
+    def setup():
+        ids = list(range(1, num_agents+1))
+        agent.agent_embeddings = {id: np.random.normal(size=params.agent_emb_dim) for id in ids}
+        agent.agent_hidden_states = {id: h[0].copy() for id in ids}
+        agent.agent_cell_states = {id: c[0].copy() for id in ids}
+        return ([ids[k] for k in np.random.choice(num_agents, num_agents//10, replace=False)],)
+    return agent.remove_dead_agent_emb, setup
+
+
+def bench_dqn_learn_step(params, num_agents):
+    params = AttrDict(dict(params, obs_type='dense'))
+    view_size = params.vision_width*params.vision_height*4
+    env = SyntheticEnv(num_agents, (view_size,))
+    q_net = QNet(view_size+params.agent_emb_dim, hidden_dims=params.hidden_dims, num_actions=params.num_actions)
+    agent = DQN(params, env, q_net, nn.MSELoss(), optim.RMSprop)
+    obs, rewards, _ = synthetic_obs(env)
+
+    def fn():
+        for view in batches(obs, params.batch_size):
+            view_id, view_values = agent.process_view_with_emb_batch(view)
+            _, next_view_values = agent.process_view_with_emb_batch(view)
+            actions = np.random.randint(agent.num_actions, size=len(view))
+            agent.update(view_values, actions, next_view_values, view_id, rewards)
+    return fn, None
+
+
+def bench_drqn_lookahead(params, num_agents):
+    env = SyntheticEnv(num_agents, drqn_view_shape(params))
+    agent = make_drqn(params, env)
+    obs = synthetic_obs(env, only_view=True)
+
+    def fn():
+        agent.lookahead(env, obs, synthetic_obs, 0.5)
+    return fn, None
+
+
+def cases(params, agents, batch_sizes):
+    '''
+    (group, params, factory) of the benchmarks. factory() builds the state of
+    a benchmark and returns (fn, setup); it is called just before the timing
+    so only one population is held in memory at a time
+    '''
+    yield 'update_params', {}, lambda: bench_update_params(params)
+    for n in agents:
+        for is_states in [False, True]:
+            yield 'process_view_with_emb_batch', {'agents': n, 'is_states': is_states}, \
+                lambda n=n, is_states=is_states: bench_process_view(params, n, is_states)
+        for batch_size in batch_sizes:
+            for grad in [False, True]:
+                yield 'DRQNet.forward', {'agents': n, 'batch_size': batch_size, 'grad': grad}, \
+                    lambda n=n, b=batch_size, g=grad: bench_drqnet_forward(params, n, b, g)
+                yield 'QNetConv.forward', {'agents': n, 'batch_size': batch_size, 'grad': grad}, \
+                    lambda n=n, b=batch_size, g=grad: bench_qnetconv_forward(params, n, b, g)
+        yield 'remove_dead_agent_emb', {'agents': n}, lambda n=n: bench_remove_dead_agent_emb(params, n)
+        yield 'DQN.learn_step', {'agents': n}, lambda n=n: bench_dqn_learn_step(params, n)
+        yield 'DRQN.lookahead', {'agents': n}, lambda n=n: bench_drqn_lookahead(params, n)
+
+
+def benchmark_name(group, bench_params):
+    if len(bench_params) == 0:
+        return group
+    return '{}[{}]'.format(group, '-'.join('{}={}'.format(k, v) for k, v in bench_params.items()))
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--config_file', type=str, default='./configs/config_genetic.yaml', help='config of the networks and batch size')
+    argparser.add_argument('--agents', type=int, nargs='+', default=[1000, 5000, 20000], help='populations')
+    argparser.add_argument('--batch_sizes', type=int, nargs='+', default=[128, 512, 2048], help='batch sizes of the forward benchmarks')
+    argparser.add_argument('-k', '--select', type=str, nargs='*', default=None, help='run the benchmarks whose name contains one of these')
+    argparser.add_argument('--warmup', type=int, default=1, help='rounds before the timing')
+    argparser.add_argument('--min_rounds', type=int, default=5)
+    argparser.add_argument('--min_time', type=float, default=1., help='minimum timed seconds per benchmark')
+    argparser.add_argument('--max_time', type=float, default=30., help='no round is started after this many seconds')
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--output', type=str, default=None, help='JSON file of the results')
+    args = argparser.parse_args()
+
+    params = make_args(args.config_file, 'DRQN')
+    sync = torch.cuda.synchronize if torch.cuda.is_available() else None
+
+    results = []
+    for group, bench_params, factory in cases(params, args.agents, args.batch_sizes):
+        name = benchmark_name(group, bench_params)
+        if args.select and not any(s in name for s in args.select):
+            continue
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        fn, setup = factory()
+        stats = run_benchmark(fn, setup, args.warmup, args.min_rounds, args.min_time, args.max_time, sync)
+        results.append(OrderedDict([('group', group), ('name', name), ('params', bench_params), ('stats', stats)]))
+        per_agent = ' {:8.3f} us/agent'.format(stats['median']*1e6/bench_params['agents']) if 'agents' in bench_params else ''
+        print('{:<70s} {:10.3f} ms (median of {:d}){}'.format(name, stats['median']*1000, stats['rounds'], per_agent))
+        del fn, setup
+
+    settings = OrderedDict([('config_file', args.config_file), ('agents', args.agents),
+                            ('batch_sizes', args.batch_sizes), ('seed', args.seed)])
+    print(write_results(args.output or default_output('agents'), results, {'settings': settings}))
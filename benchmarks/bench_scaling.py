@@ -0,0 +1,254 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+import queue
+import shutil
+import argparse
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+from benchmarks.harness import (REPO_DIR, write_results, default_output, load_results,
+                                compare_results, format_comparison)
+
+'''
+End-to-end scaling benchmark of the agents
+
+Every agent type runs on the real environment for a fixed number of steps,
+for each initial population and map size of a grid, with fixed seeds. Each run
+is a separate process, so its peak RSS is its own. Recorded per run: steps per
+second, agent-steps per second (the populations summed over the steps, from
+the log), the peak RSS and the mean time of the phases of a step
+(timing.PhaseTimer). The run is written to results/<env_type>/exp_<id>, which
+is removed first.
+
+    python benchmarks/bench_scaling.py run --models DQN DRQN --agents 1000 5000 --map_sizes 300 600 --steps 50
+    python benchmarks/bench_scaling.py compare old.json new.json --threshold 0.1
+
+compare diffs the throughput, the peak RSS and the main phases of the runs
+present in both files and exits with status 1 if one of them is slower (or
+larger) by more than the threshold. It also reads the files of bench_agents.py.
+'''
+
+MODELS = ['DQN', 'DDQN', 'DRQN', 'Random']
+# phases taking less than this share of a step are too noisy to compare
+MIN_PHASE_SHARE = 0.05
+
+
+def phase_means(history):
+    '''
+    Mean time in ms of each phase over the episodes of PhaseTimer.history, weighted by their steps
+    '''
+    totals = OrderedDict()
+    steps = 0
+    for _, n, summary in history:
+        steps += n
+        for name, stats in summary.items():
+            totals[name] = totals.get(name, 0.) + stats['mean'] * n
+    return OrderedDict((name, total / steps) for name, total in totals.items()) if steps > 0 else OrderedDict()
+
+
+def logged_steps(exp_dir):
+    '''
+    Number of steps and sum of the populations over the steps of the logs of a run
+    '''
+    from metrics_log import load_metrics
+
+    steps, agent_steps = 0, 0
+    for root, _, files in os.walk(exp_dir):
+        if 'log.txt' in files or 'log.txt.gz' in files:
+            num_agents = np.asarray(load_metrics(os.path.join(root, 'log.txt'))['num_agents'])
+            steps += len(num_agents)
+            agent_steps += int(num_agents.sum())
+    return steps, agent_steps
+
+
+def run_case(case):
+    '''
+    Run one agent of the grid and measure it, in the current process
+    '''
+    import random
+    import torch
+    import torch.nn as nn
+    import torch.optim as optim
+    from main import read_yaml, make_env, create_nn
+    from agents.DQN import DQN
+    from agents.DDQN import DDQN
+    from agents.DRQN import DRQN
+    from agents.random import Random
+    from memory import peak_rss_bytes
+
+    os.chdir(REPO_DIR)
+    seed = case['seed']
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    params = read_yaml(case['config_file'])
+    params['model_type'] = case['model_type']
+    params['env_type'] = case['env_type']
+    params['experiment_id'] = case['experiment_id']
+    params['test_id'] = 0
+    params['predator_num'] = int(round(case['agents'] * case['predator_share']))
+    params['prey_num'] = case['agents'] - params['predator_num']
+    params['height'] = case['map_size']
+    params['width'] = case['map_size']
+    params['timing'] = True
+    params['video_flag'] = False
+    params['trace_every'] = 0
+    params['load_weight'] = None
+    # populations are allowed to grow, so runs of the same grid point last the same number of steps
+    params['predator_capacity'] = max(params.get('predator_capacity', 0), 10 * case['agents'])
+    params['prey_capacity'] = max(params.get('prey_capacity', 0), 10 * case['agents'])
+
+    exp_dir = os.path.join('results', case['env_type'], 'exp_{:d}'.format(case['experiment_id']))
+    if os.path.exists(exp_dir):
+        shutil.rmtree(exp_dir)
+
+    env = make_env(case['env_type'], params)
+    env.make_world(wall_prob=params.wall_prob, wall_seed=seed, food_prob=0)
+    if case['model_type'] == 'Random':
+        agent = Random(params, env)
+        run = lambda: agent.test(case['steps'])
+    else:
+        agent_class = {'DQN': DQN, 'DDQN': DDQN, 'DRQN': DRQN}[case['model_type']]
+        agent = agent_class(params, env, create_nn(params), nn.MSELoss(), optim.RMSprop)
+        run = lambda: agent.train(1, case['steps'], params.random_step, params.min_greedy, params.max_greedy,
+                                  params.greedy_step, params.update_period)
+
+    st = time.perf_counter()
+    run()
+    wall = time.perf_counter() - st
+
+    steps, agent_steps = logged_steps(exp_dir)
+    phases = phase_means(agent.timer.history)
+    stats = OrderedDict()
+    stats['steps'] = steps
+    stats['wall'] = wall
+    stats['steps_per_sec'] = steps / wall if wall > 0 else 0.
+    stats['agent_steps_per_sec'] = agent_steps / wall if wall > 0 else 0.
+    stats['mean_agents'] = agent_steps / float(max(steps, 1))
+    stats['peak_rss_mb'] = peak_rss_bytes() / float(1 << 20)
+    for name, value in phases.items():
+        stats['phase_{}_ms'.format(name)] = value
+    return stats
+
+
+def _run_case_worker(results, case):
+    try:
+        results.put(('ok', run_case(case)))
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+def run_in_process(case, timeout=None):
+    '''
+    run_case in a new process. Returns (status, stats or traceback)
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=_run_case_worker, args=(results, case))
+    process.start()
+    started = time.time()
+    try:
+        while True:
+            try:
+                result = results.get(timeout=1.)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    result = ('error', 'process exited with code {}'.format(process.exitcode))
+                    break
+                if timeout is not None and time.time() - started > timeout:
+                    process.terminate()
+                    result = ('error', 'timed out after {:.0f}s'.format(timeout))
+                    break
+    finally:
+        process.join()
+    return result
+
+
+def compared_stats(stats):
+    '''
+    Names of the values of a run checked by compare: throughput, memory and the main phases
+    '''
+    names = ['steps_per_sec', 'agent_steps_per_sec', 'peak_rss_mb']
+    step = stats.get('phase_step_ms', 0.)
+    for name, value in stats.items():
+        if name.startswith('phase_') and name != 'phase_step_ms' and step > 0 and value >= MIN_PHASE_SHARE * step:
+            names.append(name)
+    return names
+
+
+def run_grid(args):
+    config_file = os.path.abspath(args.config_file)
+    results = []
+    for model_type in args.models:
+        for map_size in args.map_sizes:
+            for agents in args.agents:
+                name = '{}[agents={}-map={}]'.format(model_type, agents, map_size)
+                if agents > map_size * map_size // 2:
+                    print('{:<40s} skipped, the map has room for {:d} agents'.format(name, map_size * map_size // 2))
+                    continue
+                case = OrderedDict([('config_file', config_file), ('env_type', args.env_type), ('model_type', model_type),
+                                    ('agents', agents), ('map_size', map_size), ('steps', args.steps),
+                                    ('predator_share', args.predator_share), ('seed', args.seed),
+                                    ('experiment_id', args.experiment_id)])
+                status, value = run_in_process(case, args.timeout)
+                if status != 'ok':
+                    print('{:<40s} failed\n{}'.format(name, value))
+                    continue
+                print('{:<40s} {:8.2f} steps/s {:12.0f} agent-steps/s {:8.0f} MB peak RSS'.format(
+                    name, value['steps_per_sec'], value['agent_steps_per_sec'], value['peak_rss_mb']))
+                params = OrderedDict([('agents', agents), ('map_size', map_size), ('steps', args.steps)])
+                results.append(OrderedDict([('group', model_type), ('name', name), ('params', params),
+                                            ('stats', value), ('compare', compared_stats(value))]))
+
+    settings = OrderedDict([('config_file', args.config_file), ('env_type', args.env_type), ('models', args.models),
+                            ('agents', args.agents), ('map_sizes', args.map_sizes), ('steps', args.steps),
+                            ('predator_share', args.predator_share), ('seed', args.seed)])
+    print(write_results(args.output or default_output('scaling'), results, {'settings': settings}))
+
+
+def compare(args):
+    old, new = load_results(args.old), load_results(args.new)
+    rows = compare_results(old, new, args.threshold)
+    print(format_comparison(rows, old, new))
+    regressions = [row for row in rows if row[5] == 'regression']
+    if len(regressions) > 0:
+        print('{:d} regressions beyond {:.0f}%'.format(len(regressions), 100 * args.threshold))
+        sys.exit(1)
+    print('no regressions beyond {:.0f}%'.format(100 * args.threshold))
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    subparsers = argparser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='run the grid')
+    run_parser.add_argument('--config_file', type=str, default='./configs/config.yaml')
+    run_parser.add_argument('--env_type', type=str, default='simple_population_dynamics_ga', help='environment supported by all the agents')
+    run_parser.add_argument('--models', type=str, nargs='+', default=MODELS, choices=MODELS)
+    run_parser.add_argument('--agents', type=int, nargs='+', default=[1000, 5000, 20000], help='initial populations')
+    run_parser.add_argument('--map_sizes', type=int, nargs='+', default=[300, 600, 1000], help='height and width of the map')
+    run_parser.add_argument('--steps', type=int, default=50, help='steps per run')
+    run_parser.add_argument('--predator_share', type=float, default=0.5, help='fraction of predators in the initial population')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--experiment_id', type=int, default=9998, help='experiment of the runs, overwritten')
+    run_parser.add_argument('--timeout', type=float, default=None, help='seconds after which a run is stopped')
+    run_parser.add_argument('--output', type=str, default=None, help='JSON file of the results')
+
+    compare_parser = subparsers.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('old', type=str)
+    compare_parser.add_argument('new', type=str)
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown flagged as a regression')
+
+    args = argparser.parse_args()
+    if args.command == 'run':
+        run_grid(args)
+    elif args.command == 'compare':
+        compare(args)
+    else:
+        argparser.print_help()
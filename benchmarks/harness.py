@@ -0,0 +1,227 @@
+import os, sys
+
+import gc
+import json
+import time
+import socket
+import platform
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+
+'''
+Timing of benchmarks and their result files
+
+A benchmark is a function timed over rounds, after warm-up rounds, until both
+a minimum number of rounds and a minimum time are reached. An optional setup
+function prepares the arguments of every round outside of the timing. Results
+are written as JSON in the layout of pytest-benchmark (machine_info,
+commit_info, benchmarks with their stats), so the files of two commits can be
+compared with the same tools, or with compare_results.
+'''
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# values of the results for which a decrease is a regression
+HIGHER_IS_BETTER = set(['ops', 'steps_per_sec', 'agent_steps_per_sec'])
+
+
+def stats_of(times):
+    '''
+    Statistics in seconds of the times of the rounds
+    '''
+    times = np.asarray(times, dtype=float)
+    q1, median, q3 = np.percentile(times, [25, 50, 75])
+    stats = OrderedDict()
+    stats['min'] = float(times.min())
+    stats['max'] = float(times.max())
+    stats['mean'] = float(times.mean())
+    stats['stddev'] = float(times.std(ddof=1)) if len(times) > 1 else 0.
+    stats['median'] = float(median)
+    stats['iqr'] = float(q3 - q1)
+    stats['rounds'] = len(times)
+    stats['total'] = float(times.sum())
+    stats['ops'] = float(1. / times.mean()) if times.mean() > 0 else 0.
+    return stats
+
+
+def run_benchmark(fn, setup=None, warmup=1, min_rounds=5, min_time=1., max_time=30., sync=None):
+    '''
+    Time fn over rounds
+
+    Args:
+        fn: Function of a round, called with the arguments returned by setup
+        setup: Function returning the arguments of a round (a tuple), not timed
+        warmup: Number of rounds run before the timing
+        min_rounds: Minimum number of timed rounds
+        min_time: Rounds are timed until their total reaches min_time seconds
+        max_time: No new round is started after max_time seconds
+        sync: Function waiting for asynchronous work (torch.cuda.synchronize)
+
+    Returns:
+        Statistics of the rounds (see stats_of)
+    '''
+    def call():
+        args = setup() if setup is not None else ()
+        if sync is not None:
+            sync()
+        st = time.perf_counter()
+        fn(*args)
+        if sync is not None:
+            sync()
+        return time.perf_counter() - st
+
+    for _ in range(warmup):
+        call()
+    times = []
+    # the collector would add the cost of earlier rounds to the current one
+    gc_enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    started = time.perf_counter()
+    try:
+        while len(times) < min_rounds or sum(times) < min_time:
+            times.append(call())
+            if time.perf_counter() - started > max_time and len(times) >= 1:
+                break
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return stats_of(times)
+
+
+def git_output(*args):
+    try:
+        return subprocess.check_output(['git'] + list(args), cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def commit_info():
+    info = OrderedDict()
+    info['id'] = git_output('rev-parse', 'HEAD')
+    info['branch'] = git_output('rev-parse', '--abbrev-ref', 'HEAD')
+    info['time'] = git_output('log', '-1', '--format=%cI')
+    status = git_output('status', '--porcelain', '--untracked-files=no')
+    info['dirty'] = bool(status) if status is not None else None
+    return info
+
+
+def machine_info():
+    info = OrderedDict()
+    info['node'] = socket.gethostname()
+    info['platform'] = platform.platform()
+    info['machine'] = platform.machine()
+    info['processor'] = platform.processor()
+    info['python_version'] = platform.python_version()
+    info['cpu_count'] = os.cpu_count()
+    info['numpy_version'] = np.__version__
+    try:
+        import torch
+        info['torch_version'] = torch.__version__
+        info['torch_threads'] = torch.get_num_threads()
+        info['cuda'] = torch.cuda.get_device_name(0) if torch.cuda.is_available() else None
+    except ImportError:
+        info['torch_version'] = None
+    return info
+
+
+def write_results(path, benchmarks, extra=None):
+    '''
+    Write the results of benchmarks with the machine and commit they ran on
+
+    Args:
+        path: Path of the JSON file
+        benchmarks: List of dictionaries with name, group, params and stats
+        extra: Dictionary of other information on the run (settings, ...)
+    '''
+    results = OrderedDict()
+    results['machine_info'] = machine_info()
+    results['commit_info'] = commit_info()
+    results['datetime'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    if extra is not None:
+        results.update(extra)
+    results['benchmarks'] = benchmarks
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path+'.tmp', 'w') as f:
+        json.dump(results, f, indent=2)
+    os.replace(path+'.tmp', path)
+    return path
+
+
+def default_output(name):
+    '''
+    benchmarks/results/<name>_<commit>_<time>.json
+    '''
+    commit = git_output('rev-parse', '--short', 'HEAD') or 'nocommit'
+    file_name = '{}_{}_{}.json'.format(name, commit, time.strftime('%Y%m%d_%H%M%S'))
+    return os.path.join(REPO_DIR, 'benchmarks', 'results', file_name)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compared_values(bench):
+    '''
+    Values of a benchmark to compare, as name -> (value, higher is better).
+    A benchmark lists them in 'compare', the median time by default
+    '''
+    stats = bench['stats']
+    values = OrderedDict()
+    for name in bench.get('compare', ['median']):
+        if name in stats and stats[name] is not None:
+            values[name] = (stats[name], name in HIGHER_IS_BETTER)
+    return values
+
+
+def compare_results(old, new, threshold=0.1):
+    '''
+    Compare the benchmarks of two result files by name
+
+    Args:
+        old, new: Results of write_results
+        threshold: Relative change beyond which a value is flagged
+
+    Returns:
+        List of (benchmark, value name, old value, new value, relative change, flag)
+        where the change is positive for a slowdown (or more memory) and flag is
+        'regression', 'improvement' or ''
+    '''
+    old_benchmarks = OrderedDict((bench['name'], bench) for bench in old['benchmarks'])
+    rows = []
+    for bench in new['benchmarks']:
+        if bench['name'] not in old_benchmarks:
+            continue
+        old_values = compared_values(old_benchmarks[bench['name']])
+        new_values = compared_values(bench)
+        for name, (old_value, higher_is_better) in old_values.items():
+            if name not in new_values:
+                continue
+            new_value = new_values[name][0]
+            if higher_is_better:
+                change = old_value / new_value - 1. if new_value > 0 else float('inf')
+            else:
+                change = new_value / old_value - 1. if old_value > 0 else 0.
+            flag = 'regression' if change > threshold else ('improvement' if change < -threshold else '')
+            rows.append((bench['name'], name, old_value, new_value, change, flag))
+    return rows
+
+
+def format_comparison(rows, old, new):
+    lines = []
+    old_commit = (old.get('commit_info') or {}).get('id') or '?'
+    new_commit = (new.get('commit_info') or {}).get('id') or '?'
+    lines.append('old {} ({})'.format(old_commit[:10], old.get('datetime', '')))
+    lines.append('new {} ({})'.format(new_commit[:10], new.get('datetime', '')))
+    for key in ['node', 'processor', 'cpu_count', 'torch_version', 'cuda']:
+        a, b = old['machine_info'].get(key), new['machine_info'].get(key)
+        if a != b:
+            lines.append('warning: {} differs: {} -> {}'.format(key, a, b))
+    lines.append('{:<60s} {:<28s} {:>14s} {:>14s} {:>9s}'.format('benchmark', 'value', 'old', 'new', 'change'))
+    for name, value, a, b, change, flag in rows:
+        lines.append('{:<60s} {:<28s} {:>14.6g} {:>14.6g} {:>+8.1f}% {}'.format(name, value, a, b, 100*change, flag))
+    return '\n'.join(lines)
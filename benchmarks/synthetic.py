@@ -0,0 +1,98 @@
+import os, sys
+
+import numpy as np
+import yaml
+from attrdict import AttrDict
+
+'''
+Synthetic worlds and observations for the benchmarks
+
+SyntheticEnv has what the agents read from a garl_gym world in their hot
+paths (agents, predators and preys keyed by id, with a predator flag) and
+synthetic_obs has the signature of the get_obs functions of the scenarios, so
+agents can be run at any population without simulating a map. Views are
+drawn from a fixed pool of random views, which keeps the memory of 20k agents
+small while the agents still copy one view per agent.
+'''
+
+
+class SyntheticAgent(object):
+    def __init__(self, id, predator):
+        self.id = id
+        self.predator = predator
+
+
+class SyntheticEnv(object):
+    '''
+    Args:
+        num_agents: Number of agents
+        view_shape: Shape of the view of an agent
+        predator_ratio: Fraction of predators
+        pool_size: Number of distinct random views
+        dtype: Type of the views
+        seed: Random seed
+    '''
+    def __init__(self, num_agents, view_shape, predator_ratio=0.5, pool_size=1024, dtype=np.float64, seed=0):
+        self.rng = np.random.RandomState(seed)
+        self.view_shape = tuple(view_shape)
+        self.pool = self.rng.rand(min(pool_size, max(num_agents, 1)), *self.view_shape).astype(dtype)
+        self.agents = {}
+        self.predators = {}
+        self.preys = {}
+        self.next_id = 1
+        self.killed = []
+        self.add_agents(num_agents, predator_ratio)
+
+    def add_agents(self, n, predator_ratio=0.5):
+        for _ in range(n):
+            agent = SyntheticAgent(self.next_id, self.rng.rand() < predator_ratio)
+            self.agents[agent.id] = agent
+            if agent.predator:
+                self.predators[agent.id] = agent
+            else:
+                self.preys[agent.id] = agent
+            self.next_id += 1
+
+    def view(self, id):
+        return self.pool[id % len(self.pool)]
+
+    def take_actions(self, actions):
+        # agents do not move, the views stay the same
+        pass
+
+    def kill(self, fraction):
+        '''
+        Remove a random fraction of the agents, returns their ids
+        '''
+        ids = list(self.agents.keys())
+        killed = [ids[k] for k in self.rng.choice(len(ids), int(len(ids)*fraction), replace=False)]
+        for id in killed:
+            del self.agents[id]
+            self.predators.pop(id, None)
+            self.preys.pop(id, None)
+        return killed
+
+
+def synthetic_obs(env, only_view=False):
+    '''
+    Views of the agents of a SyntheticEnv, with random rewards unless only_view
+    '''
+    obs = [(id, env.view(id)) for id in env.agents.keys()]
+    if only_view:
+        return obs
+    rewards = dict(zip(env.agents.keys(), env.rng.normal(0, 0.1, len(env.agents))))
+    return obs, rewards, []
+
+
+def make_args(config_file, model_type, **overrides):
+    '''
+    Parameters of a config, as read by main.py, for an agent of model_type
+    '''
+    with open(config_file) as f:
+        params = AttrDict(yaml.safe_load(f)).parameters
+    params['model_type'] = model_type
+    params['env_type'] = 'synthetic'
+    params['experiment_id'] = 0
+    for key, value in overrides.items():
+        params[key] = value
+    return params
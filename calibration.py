@@ -0,0 +1,348 @@
+import os, sys
+
+import csv
+import json
+import math
+import time
+from copy import deepcopy
+
+import numpy as np
+import pandas as pd
+import torch.nn as nn
+import torch.optim as optim
+from attrdict import AttrDict
+from tqdm import tqdm
+from agents.DRQN import DRQN
+import lotka_volterra
+from metrics_log import open_log_writer
+from garl_gym.scenarios.simple_population_dynamics_ga import SimplePopulationDynamicsGA
+from garl_gym.scenarios.simple_population_dynamics_ga_action import SimplePopulationDynamicsGAAction
+from garl_gym.scenarios.simple_population_dynamics_ga_utility import SimplePopulationDynamicsGAUtility
+from garl_gym.scenarios.simple_population_dynamics import SimplePopulationDynamics
+from garl_gym.scenarios.complex_population_dynamics import ComplexPopulationDynamics
+
+'''
+Calibration of the simulator against the hare-lynx series
+'''
+
+def make_env(env_type, params):
+    if env_type == 'simple_population_dynamics_ga':
+        return SimplePopulationDynamicsGA(params)
+    elif env_type == 'simple_population_dynamics':
+        return SimplePopulationDynamics(params)
+    elif env_type == 'simple_population_dynamics_ga_utility':
+        return SimplePopulationDynamicsGAUtility(params)
+    elif env_type == 'simple_population_dynamics_ga_action':
+        return SimplePopulationDynamicsGAAction(params)
+    elif env_type == 'complex_population_dynamics':
+        return ComplexPopulationDynamics(params)
+
+def load_targets(data_file='./data/hare_lynx_data.csv', scale=100):
+    '''
+    Returns:
+        hare, lynx: Target populations of preys and predators
+    '''
+    df = pd.read_csv(data_file)
+    return np.array(df['Hare'])*scale, np.array(df['Lynx'])*scale
+
+def sample_candidate(rng):
+    '''
+    Draw a candidate from the same search space as the optuna study
+    '''
+    return {'timestep': int(rng.choice(np.arange(300, 601, 50))),
+            'predator_increase_rate': float(rng.uniform(0.001, 0.02)),
+            'prey_increase_rate': float(rng.uniform(0.001, 0.02)),
+            'predator_health_increase_rate': int(rng.randint(1, 5)),
+            'height': int(rng.choice(np.arange(500, 1001, 100)))}
+
+def apply_candidate(params, candidate):
+    params = AttrDict(deepcopy(dict(params)))
+    params.predator_increase_prob = candidate['predator_increase_rate']
+    params.prey_increase_prob = candidate['prey_increase_rate']
+    params.health_increase_rate = candidate['predator_health_increase_rate']
+    params.height = int(candidate['height'])
+    params.width = int(candidate['height'])
+    return params
+
+def scale_params(params, fidelity):
+    '''
+    Scale the world down to a fraction of its area. Initial populations and
+    capacities are scaled by the same fraction so that densities are kept.
+
+    Args:
+        params: Parameters of the full size world
+        fidelity: Fraction of the full area (0, 1]
+    '''
+    params = AttrDict(deepcopy(dict(params)))
+    if fidelity == 1:
+        return params
+    side = math.sqrt(fidelity)
+    params.height = max(params.vision_height, int(round(params.height*side)))
+    params.width = max(params.vision_width, int(round(params.width*side)))
+    params.predator_num = max(2, int(round(params.predator_num*fidelity)))
+    params.prey_num = max(2, int(round(params.prey_num*fidelity)))
+    params.predator_capacity = int(params.predator_capacity*fidelity)
+    params.prey_capacity = int(params.prey_capacity*fidelity)
+    return params
+
+def simulate(params, q_net, targets, T, points=25, fidelity=1., max_agents=16000, log_file=None, report=None):
+    '''
+    Run the simulator and compare the populations with the targets every T steps
+
+    Args:
+        params: Parameters of the full size world
+        q_net: Trained network
+        targets: Tuple of the target prey and predator populations
+        T: Number of steps between two data points
+        points: Number of data points to fit
+        fidelity: Fraction of the full area to simulate. Targets are rescaled accordingly
+        max_agents: Number of agents (at full size) at which the run is considered diverged
+        log_file: Path of the population log, gzip-compressed if it ends with .gz
+        report: Called with (error so far, point) after every data point
+
+    Returns:
+        error: Mean squared error of both species, in units of the full size world
+        cost: Dictionary with seconds, steps and agent steps of the run
+        populations: Arrays of the number of preys and predators at every step
+    '''
+    params = scale_params(params, fidelity)
+    hare, lynx = targets
+    env = make_env(params.env_type, params)
+    env.make_world(wall_prob=params.wall_prob, food_prob=0)
+    agent = DRQN(params,
+                env,
+                q_net,
+                nn.MSELoss(),
+                optim.RMSprop)
+    env.reset()
+
+    start = time.time()
+    total_predator_mse = 0
+    total_prey_mse = 0
+    agent_steps = 0
+    point = 0
+    prey_num = []
+    predator_num = []
+    log = open_log_writer(log_file) if log_file is not None else None
+    bar = tqdm(range(int(points*T)))
+    try:
+        for t in range(int(points*T)):
+            agent.one_iteration(t)
+            agent_steps += len(env.agents)
+            prey_num.append(len(env.preys))
+            predator_num.append(len(env.predators))
+
+            if (t+1)%T == 0:
+                # errors of the scaled world are brought back to the units of the full world
+                total_predator_mse += np.mean((agent.env.predator_num-lynx[point]*fidelity)**2)/fidelity**2
+                total_prey_mse += np.mean((agent.env.prey_num-hare[point]*fidelity)**2)/fidelity**2
+                point += 1
+                if report is not None:
+                    report(total_predator_mse/point+total_prey_mse/point, point)
+            if log is not None:
+                info = "Step\t{:03d}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}".format(t, len(env.agents), len(env.preys), len(env.predators), env.increase_predators, env.increase_preys)
+                log.write(info+'\n')
+            bar.update(1)
+
+            if len(agent.env.predators) > max_agents*fidelity or len(agent.env.preys) > max_agents*fidelity:
+                total_predator_mse = np.inf
+                total_prey_mse = np.inf
+                break
+    finally:
+        if log is not None:
+            log.close()
+        bar.close()
+
+    error = total_predator_mse/points+total_prey_mse/points
+    cost = {'seconds': time.time()-start, 'steps': t+1, 'agent_steps': agent_steps}
+    return error, cost, (np.array(prey_num), np.array(predator_num))
+
+
+class LotkaVolterraSurrogate(object):
+    '''
+    Cheap screen of candidates before any agent-based simulation.
+
+    Every completed simulation is summarised by the Lotka-Volterra parameters
+    fitted to its trajectory. A ridge regression from the simulator parameters
+    to log(theta) is refitted online, and the cycle predicted by integrating
+    the model from the initial populations is used to reject candidates which
+    would exceed the capacity or go extinct.
+
+    Args:
+        max_agents: Predicted populations above this are rejected
+        min_agents: Predicted populations below this are rejected
+        min_trials: The surrogate accepts everything until this many trials are observed
+        ridge: Regularisation of the regression
+    '''
+    def __init__(self, max_agents=16000, min_agents=2, min_trials=8, ridge=1e-3):
+        self.max_agents = max_agents
+        self.min_agents = min_agents
+        self.min_trials = min_trials
+        self.ridge = ridge
+        self.features = []
+        self.log_thetas = []
+        self.weights = None
+
+    def featurize(self, candidate):
+        return np.array([1.,
+                         np.log(candidate['predator_increase_rate']),
+                         np.log(candidate['prey_increase_rate']),
+                         candidate['predator_health_increase_rate'],
+                         candidate['height']/1000.])
+
+    def add_theta(self, candidate, theta):
+        if theta is None or np.any(theta <= 0):
+            return False
+        self.features.append(self.featurize(candidate))
+        self.log_thetas.append(np.log(theta))
+        self.weights = None
+        return True
+
+    def add(self, candidate, prey_num, predator_num, fidelity=1.):
+        '''
+        Fit theta to the trajectory of a completed simulation and record it.
+        Populations of scaled-down worlds are brought back to full size first.
+        '''
+        theta = lotka_volterra.fit_regression(np.asarray(prey_num)/fidelity, np.asarray(predator_num)/fidelity)
+        return self.add_theta(candidate, theta)
+
+    def fit(self):
+        X = np.array(self.features)
+        Y = np.array(self.log_thetas)
+        A = X.T.dot(X) + self.ridge*np.eye(X.shape[1])
+        self.weights = np.linalg.solve(A, X.T.dot(Y))
+
+    def ready(self):
+        return len(self.features) >= self.min_trials
+
+    def predict_theta(self, candidate):
+        if self.weights is None:
+            self.fit()
+        return np.exp(self.featurize(candidate).dot(self.weights))
+
+    def predict(self, candidate, z_init, steps, stride=10):
+        '''
+        Predicted populations {prey, predator} every stride steps
+        '''
+        theta = self.predict_theta(candidate)
+        return lotka_volterra.integrate(z_init, theta, int(steps)//stride, dt=stride, substeps=4)
+
+    def screen(self, candidate, z_init, steps):
+        '''
+        Returns:
+            False if the candidate is predicted to exceed the capacity or to go extinct
+        '''
+        if not self.ready():
+            return True
+        zs = self.predict(candidate, z_init, steps)
+        return bool(zs.max() < self.max_agents and zs.min() >= self.min_agents)
+
+
+class CalibrationLog(object):
+    '''
+    Records every evaluation and the cost spent at each fidelity level
+    '''
+    fields = ['bracket', 'round', 'fidelity', 'candidate', 'error', 'seconds', 'steps', 'agent_steps']
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.records = []
+        self.f = open(os.path.join(log_dir, 'calibration_log.csv'), 'w')
+        self.writer = csv.DictWriter(self.f, fieldnames=self.fields)
+        self.writer.writeheader()
+
+    def add(self, bracket, round, fidelity, candidate, error, cost):
+        record = {'bracket': bracket, 'round': round, 'fidelity': fidelity,
+                  'candidate': json.dumps(candidate), 'error': error}
+        record.update(cost)
+        self.records.append(record)
+        self.writer.writerow(record)
+        self.f.flush()
+
+    def summary(self):
+        '''
+        Cost per fidelity level and the estimated wall-clock saved compared to
+        evaluating every simulated candidate at full size. Candidates rejected
+        by the surrogate (fidelity 0) were never simulated and are only counted
+        under rejected_by_surrogate.
+        '''
+        levels = {}
+        simulated = [record for record in self.records if record['fidelity'] > 0]
+        for record in simulated:
+            level = levels.setdefault(record['fidelity'], {'evaluations': 0, 'seconds': 0., 'agent_steps': 0})
+            level['evaluations'] += 1
+            level['seconds'] += record['seconds']
+            level['agent_steps'] += record['agent_steps']
+        spent = sum(level['seconds'] for level in levels.values())
+        summary = {'levels': {str(k): v for k, v in sorted(levels.items())}, 'seconds': spent,
+                   'rejected_by_surrogate': len(self.records) - len(simulated)}
+        if 1.0 in levels:
+            full = levels[1.0]
+            num_candidates = len(set((r['bracket'], r['candidate']) for r in simulated))
+            full_cost = num_candidates*full['seconds']/full['evaluations']
+            summary['full_fidelity_seconds_estimate'] = full_cost
+            summary['seconds_saved_estimate'] = full_cost - spent
+        return summary
+
+    def close(self):
+        self.f.close()
+        with open(os.path.join(self.log_dir, 'calibration_summary.json'), 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def hyperband(params, q_net, targets, log_dir, fidelities=(0.125, 0.25, 0.5, 1.), eta=3, points=25, seed=0, surrogate=None,
+              max_rejections=20):
+    '''
+    Hyperband over world sizes. Each bracket evaluates candidates on small
+    worlds and promotes the best 1/eta of them to the next larger world.
+
+    Args:
+        params: Parameters of the full size world
+        q_net: Trained network
+        targets: Tuple of the target prey and predator populations
+        log_dir: Directory of the calibration logs
+        fidelities: Increasing fractions of the full area, the last one should be 1
+        eta: Ratio of candidates kept between two rounds
+        points: Number of data points to fit
+        surrogate: LotkaVolterraSurrogate used to reject candidates before they are simulated
+        max_rejections: After max_rejections*n candidates of a bracket of n are
+            rejected, the remaining ones are accepted without screening
+
+    Returns:
+        best candidate and its error at full size
+    '''
+    rng = np.random.RandomState(seed)
+    log = CalibrationLog(log_dir)
+    s_max = len(fidelities)-1
+    best, best_error = None, np.inf
+    for s in reversed(range(s_max+1)):
+        n = int(math.ceil((s_max+1)/(s+1)*eta**s))
+        candidates = []
+        rejected = 0
+        while len(candidates) < n:
+            candidate = sample_candidate(rng)
+            screened = surrogate is not None and rejected < max_rejections*n
+            if screened and not surrogate.screen(candidate, [params.prey_num, params.predator_num], points*candidate['timestep']):
+                log.add(s, -1, 0., candidate, np.inf, {'seconds': 0., 'steps': 0, 'agent_steps': 0})
+                rejected += 1
+                if rejected == max_rejections*n:
+                    print('warning: the surrogate rejected {:d} candidates in bracket {:d}, the other {:d} candidates are not screened'.format(
+                        rejected, s, n-len(candidates)))
+                continue
+            candidates.append(candidate)
+        for i in range(s+1):
+            fidelity = fidelities[s_max-s+i]
+            errors = []
+            for candidate in candidates:
+                error, cost, (prey_num, predator_num) = simulate(apply_candidate(params, candidate), q_net, targets, candidate['timestep'], points=points, fidelity=fidelity)
+                log.add(s, i, fidelity, candidate, error, cost)
+                if surrogate is not None:
+                    surrogate.add(candidate, prey_num, predator_num, fidelity)
+                errors.append(error)
+                if fidelity == fidelities[-1] and error < best_error:
+                    best, best_error = candidate, error
+            order = np.argsort(errors)
+            candidates = [candidates[k] for k in order[:max(1, len(candidates)//eta)]]
+    log.close()
+    print(json.dumps(log.summary(), indent=2))
+    return best, best_error
@@ -0,0 +1,169 @@
+import os, sys
+
+import json
+import threading
+import queue
+from copy import deepcopy
+
+import numpy as np
+import torch
+
+'''
+Asynchronous, resumable training checkpoints
+'''
+
+
+def _to_cpu(obj):
+    '''
+    Copy tensors (possibly nested in dicts/lists) to the cpu so that the copy
+    does not change while the training thread keeps updating the originals.
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    elif isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return deepcopy(obj)
+
+
+class CheckpointManager(object):
+    '''
+    Writes training checkpoints on a background thread.
+
+    The snapshot is taken on the caller thread (at a step boundary) and only
+    serialisation is done in the background, so training continues while
+    torch.save runs.
+
+    Args:
+        checkpoint_dir: Directory where checkpoints are stored
+        keep_last: Number of most recent checkpoints to keep
+        keep_best: Number of checkpoints with the highest reward to keep
+    '''
+    index_name = 'checkpoints.json'
+
+    def __init__(self, checkpoint_dir, keep_last=3, keep_best=1):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        self.index = self.read_index()
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def read_index(self):
+        index_file = os.path.join(self.checkpoint_dir, self.index_name)
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                return json.load(f)
+        return []
+
+    def write_index(self):
+        index_file = os.path.join(self.checkpoint_dir, self.index_name)
+        with open(index_file+'.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(index_file+'.tmp', index_file)
+
+    def save(self, state, episode, reward):
+        '''
+        Snapshot the state and schedule it for writing
+
+        Args:
+            state: Dictionary returned by agent.checkpoint_state()
+            episode: Episode number
+            reward: Score used by the keep-best retention policy
+        '''
+        self.raise_error()
+        snapshot = _to_cpu(state)
+        path = os.path.join(self.checkpoint_dir, 'checkpoint_{:d}.pt'.format(episode))
+        self.queue.put(('checkpoint', snapshot, path, {'episode': episode, 'reward': float(reward), 'path': path}))
+
+    def save_model(self, q_net, path):
+        '''
+        Write a whole model (as torch.save(q_net) did) in the background
+        '''
+        self.raise_error()
+        self.queue.put(('model', deepcopy(q_net), path, None))
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            kind, obj, path, entry = job
+            try:
+                torch.save(obj, path+'.tmp')
+                os.replace(path+'.tmp', path)
+                if kind == 'checkpoint':
+                    self.index = [e for e in self.index if e['path'] != path] + [entry]
+                    self.apply_retention()
+                    self.write_index()
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def apply_retention(self):
+        ordered = sorted(self.index, key=lambda e: e['episode'])
+        keep = set(e['path'] for e in ordered[-self.keep_last:]) if self.keep_last > 0 else set()
+        best = sorted(ordered, key=lambda e: e['reward'], reverse=True)[:self.keep_best]
+        keep |= set(e['path'] for e in best)
+        for e in ordered:
+            if e['path'] not in keep and os.path.exists(e['path']):
+                os.remove(e['path'])
+        self.index = [e for e in ordered if e['path'] in keep]
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def latest(self):
+        '''
+        Path of the most recent checkpoint, or None
+        '''
+        self.wait()
+        if len(self.index) == 0:
+            return None
+        return max(self.index, key=lambda e: e['episode'])['path']
+
+    def best(self):
+        self.wait()
+        if len(self.index) == 0:
+            return None
+        return max(self.index, key=lambda e: e['reward'])['path']
+
+    def load_latest(self):
+        path = self.latest()
+        if path is None:
+            return None
+        return load_checkpoint(path)
+
+    def wait(self):
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+
+def load_checkpoint(path):
+    # checkpoints hold numpy RNG states and world columns, which torch >= 2.6 refuses by default
+    if torch.cuda.is_available():
+        return torch.load(path, weights_only=False)
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def get_rng_state():
+    return {'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+
+
+def set_rng_state(state):
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
@@ -1,15 +1,27 @@
-import pystan
+import os, sys
+
+import argparse
+import glob
+import hashlib
+import pickle
 import numpy as np
-import pylab as p
-from scipy import integrate
-import matplotlib.pyplot as plt
-import seaborn as sns
-from utils import plot_circle
+from utils import load_populations
+import lotka_volterra
 
 '''
 Estimate parameters for LV model
+
+By default the model is fitted with numpy/scipy (lotka_volterra.fit): multistart
+least squares or MAP on the log populations with Laplace uncertainties.
+--method stan samples the posterior with pystan, which is only imported then.
+The compiled Stan model is cached on disk, keyed by a hash of its source, and
+the chains run in parallel processes.
+
+Several log files (or glob patterns) can be fitted in one run, e.g.
+    python estimate_parameters.py --log_file 'results/simple_population_dynamics/exp_1/test_logs/*/log.txt'
 '''
 
+STAN_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rl-ecosystem', 'stan')
 
 lotka_code = """
 functions {
@@ -69,32 +81,105 @@ generated quantities {
 }
 """
 
-sm = pystan.StanModel(model_code=lotka_code)
 
-log_file = './results/simple_population_dynamics/exp_1/test_logs/3/log.txt'
+def make_data(prey_num, predator_num, st=1, ed=10000, stride=20):
+    '''
+    Subsample a log into the measurements of the LV model
+
+    Returns:
+        y_init (measured populations at time 0) and y (N x 2, at times 1, ..., N)
+    '''
+    y_init = np.array([prey_num[st-1], predator_num[st-1]], dtype=float)
+    y = np.stack([prey_num[st:ed:stride], predator_num[st:ed:stride]], 1).astype(float)
+    return y_init, y
+
+
+def load_stan_model(model_code, cache_dir=STAN_CACHE_DIR):
+    '''
+    Compile model_code, or load it from the cache if it was compiled before on this machine
+
+    Args:
+        model_code: Stan source
+        cache_dir: Directory of the pickled models
+    '''
+    import pystan
+
+    key = hashlib.sha256((pystan.__version__+model_code).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(cache_dir, 'model_{}.pkl'.format(key[:16]))
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+
+    sm = pystan.StanModel(model_code=model_code)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file so that concurrent runs never read a partial model
+    with open(cache_file+'.{:d}.tmp'.format(os.getpid()), 'wb') as f:
+        pickle.dump(sm, f)
+    os.replace(cache_file+'.{:d}.tmp'.format(os.getpid()), cache_file)
+    return sm
+
+
+def fit_stan(y_init, y, iter=1000, chains=4, n_jobs=-1, sm=None):
+    '''
+    Args:
+        n_jobs: Number of processes running the chains (-1: one per chain up to the number of cpus)
+        sm: Compiled model, loaded with load_stan_model if None
+    '''
+    if sm is None:
+        sm = load_stan_model(lotka_code)
+    N = len(y)
+    dat = {'N': N,
+        'ts': list(range(1, N+1)),
+        'y_init': y_init.tolist(),
+        'y': y.tolist()}
+    return sm.sampling(data=dat, iter=iter, chains=chains, n_jobs=n_jobs)
+
+
+def fit_numpy(y_init, y, method='lsq', n_starts=256, n_refine=4):
+    populations = np.concatenate([y_init[None], y], 0)
+    return lotka_volterra.fit(populations[:, 0], populations[:, 1], method=method, n_starts=n_starts, n_refine=n_refine)
 
-prey_num = []
-predator_num = []
-with open(log_file)as fin:
-    for line in fin:
-        line = line.split()
-        #if len(line) == 12:
-        #    prey_num.append(int(line[9]))
-        #    predator_num.append(int(line[11]))
-        #elif len(line) == 10:
-        prey_num.append(int(line[7]))
-        predator_num.append(int(line[9]))
-prey_num = np.array(prey_num)
-predator_num = np.array(predator_num)
 
-N = len(prey_num[1:10000:20])
-ts = list(range(1,N+1))
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--log_file', type=str, nargs='+', default=['./results/simple_population_dynamics/exp_1/test_logs/3/log.txt'],
+                           help='Log files or glob patterns')
+    argparser.add_argument('--method', type=str, default='numpy', choices=['numpy', 'stan'])
+    argparser.add_argument('--objective', type=str, default='lsq', choices=['lsq', 'map'], help='Objective of the numpy fit')
+    argparser.add_argument('--st', type=int, default=1)
+    argparser.add_argument('--ed', type=int, default=10000)
+    argparser.add_argument('--stride', type=int, default=20)
+    argparser.add_argument('--n_starts', type=int, default=256)
+    argparser.add_argument('--n_refine', type=int, default=4)
+    argparser.add_argument('--iter', type=int, default=1000)
+    argparser.add_argument('--chains', type=int, default=4)
+    argparser.add_argument('--n_jobs', type=int, default=-1, help='Number of processes running the Stan chains')
+    argparser.add_argument('--cache_dir', type=str, default=STAN_CACHE_DIR, help='Cache of compiled Stan models')
+    args = argparser.parse_args()
 
-dat = {'N': N,
-    'ts': ts,
-    'y_init': [float(prey_num[0]), float(predator_num[1000])],
-    'y': np.array([prey_num[1:10000:20].astype(float), predator_num[1:10000:20]]).T.tolist()}
+    log_files = []
+    for pattern in args.log_file:
+        log_files += sorted(glob.glob(pattern)) or [pattern]
 
-fit = sm.sampling(data=dat, iter=1000, chains=4)
-print(fit)
+    sm = load_stan_model(lotka_code, args.cache_dir) if args.method == 'stan' else None
+    for log_file in log_files:
+        print(log_file)
+        prey_num, predator_num = load_populations(log_file)
+        y_init, y = make_data(prey_num, predator_num, args.st, args.ed, args.stride)
 
+        if args.method == 'stan':
+            fit = fit_stan(y_init, y, iter=args.iter, chains=args.chains, n_jobs=args.n_jobs, sm=sm)
+            report = str(fit)
+        else:
+            result = fit_numpy(y_init, y, method=args.objective, n_starts=args.n_starts, n_refine=args.n_refine)
+            names = ['alpha', 'beta', 'gamma', 'delta']
+            lines = []
+            for k, name in enumerate(names):
+                lines.append('{}\t{:.6g}\tsd\t{:.3g}\t95%\t[{:.6g}, {:.6g}]'.format(name, result['theta'][k], result['theta_sd'][k],
+                                                                                     result['theta_interval'][k, 0], result['theta_interval'][k, 1]))
+            lines.append('z_init\t{}\tsigma\t{}\tloss\t{:.6g}'.format(result['z_init'], result['sigma'], result['loss']))
+            report = '\n'.join(lines)
+        print(report)
+        with open(os.path.join(os.path.dirname(log_file), 'lv_parameters_{}.txt'.format(args.method)), 'w') as fout:
+            fout.write(report+'\n')
@@ -0,0 +1,223 @@
+import os, sys
+
+import queue
+import multiprocessing
+
+import numpy as np
+from metrics_log import parse_line, log_parts, read_part, gunzip
+
+'''
+Live plot of the populations of a running test
+
+Only the bytes appended to the log since the previous update are parsed, the
+series are decimated for display and the figure is drawn by a background
+process with the Agg backend, so refreshing the plot of a long run does not
+slow down the step loop.
+'''
+
+
+class GrowingArray(object):
+    '''
+    1-D float array with amortised O(1) append
+    '''
+    def __init__(self, capacity=1024):
+        self.data = np.zeros(capacity)
+        self.size = 0
+
+    def extend(self, values):
+        n = self.size + len(values)
+        if n > len(self.data):
+            data = np.zeros(max(n, 2*len(self.data)))
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:n] = values
+        self.size = n
+
+    def array(self):
+        return self.data[:self.size]
+
+
+class LogTail(object):
+    '''
+    Keeps the columns of a text log in memory, reading only new lines.
+    Compressed (log.txt.gz) and rotated logs are supported
+
+    Args:
+        log_file: Path of log.txt
+        columns: Names of the columns to keep
+    '''
+    def __init__(self, log_file, columns=('num_predators', 'num_preys')):
+        self.log_file = log_file
+        self.columns = list(columns)
+        self.reset()
+
+    def reset(self):
+        self.path = None
+        self.inode = None
+        self.offset = 0
+        self.partial = b''
+        self.decompressor = None
+        self.data = {name: GrowingArray() for name in self.columns}
+
+    def __len__(self):
+        return self.data[self.columns[0]].size
+
+    def add_lines(self, lines):
+        records = [parse_line(line) for line in lines if line.strip()]
+        for name in self.columns:
+            self.data[name].extend([record.get(name, np.nan) for record in records])
+        return len(records)
+
+    def read(self):
+        '''
+        Parse the lines appended since the previous call. Returns the number of new lines
+        '''
+        parts = log_parts(self.log_file)
+        if len(parts) == 0:
+            return 0
+        n = 0
+        path = parts[-1]
+        stat = os.stat(path)
+        if path != self.path or stat.st_ino != self.inode or stat.st_size < self.offset:
+            # the log was restarted or rotated: read the older parts again
+            self.reset()
+            self.path = path
+            self.inode = stat.st_ino
+            for part in parts[:-1]:
+                n += self.add_lines(read_part(part))
+        with open(path, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        self.offset += len(chunk)
+        if path.endswith('.gz'):
+            self.decompressor, chunk = gunzip(self.decompressor, chunk)
+
+        lines = (self.partial + chunk).split(b'\n')
+        self.partial = lines.pop()
+        return n + self.add_lines([line.decode() for line in lines])
+
+    def __getitem__(self, name):
+        return self.data[name].array()
+
+
+def minmax_decimate(x, y, n_out):
+    '''
+    Keep the minimum and the maximum of y in n_out/2 buckets, so peaks stay visible
+    '''
+    n = len(y)
+    if n <= n_out:
+        return x, y
+    buckets = max(n_out // 2, 1)
+    edges = np.linspace(0, n, buckets+1).astype(np.int64)
+    keep = []
+    for st, ed in zip(edges[:-1], edges[1:]):
+        if ed > st:
+            segment = y[st:ed]
+            keep += sorted([st + int(np.nanargmin(segment)), st + int(np.nanargmax(segment))])
+    keep = np.unique(keep)
+    return x[keep], y[keep]
+
+
+def lttb_decimate(x, y, n_out):
+    '''
+    Largest-Triangle-Three-Buckets downsampling
+    '''
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return x, y
+    edges = np.linspace(1, n-1, n_out-1).astype(np.int64)
+    keep = [0]
+    for b in range(n_out-2):
+        st, ed = edges[b], max(edges[b+1], edges[b]+1)
+        next_st, next_ed = edges[b+1], edges[b+2] if b+2 < len(edges) else n
+        next_x = x[next_st:max(next_ed, next_st+1)].mean()
+        next_y = y[next_st:max(next_ed, next_st+1)].mean()
+        a = keep[-1]
+        area = np.abs((x[a] - next_x) * (y[st:ed] - y[a]) - (x[a] - x[st:ed]) * (next_y - y[a]))
+        keep.append(st + int(np.argmax(area)))
+    keep.append(n-1)
+    keep = np.array(keep)
+    return x[keep], y[keep]
+
+
+def decimate(x, y, n_out, method='minmax'):
+    if method == 'lttb':
+        return lttb_decimate(x, y, n_out)
+    return minmax_decimate(x, y, n_out)
+
+
+def _render_worker(requests, save_path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    sns.set_style("darkgrid")
+    fig = plt.figure(figsize=(18, 6))
+    ax = fig.add_subplot(111)
+    predator_line, = ax.plot([], [])
+    prey_line, = ax.plot([], [])
+    ax.legend(['Predators', 'Preys'])
+    ax.set_xlabel('Timestep')
+    ax.set_ylabel('Number of Agents')
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        predator_line.set_data(*request['predators'])
+        prey_line.set_data(*request['preys'])
+        ax.relim()
+        ax.autoscale_view()
+        fig.savefig(save_path+'.tmp.png')
+        os.replace(save_path+'.tmp.png', save_path)
+    plt.close(fig)
+
+
+class LivePlot(object):
+    '''
+    Refreshes agent_num_plot.png next to a log while the log is written
+
+    Args:
+        log_file: Path of log.txt
+        save_path: Path of the figure, agent_num_plot.png next to the log by default
+        max_points: Number of points of each series after decimation
+        method: 'minmax' or 'lttb'
+    '''
+    def __init__(self, log_file, save_path=None, max_points=4000, method='minmax'):
+        self.tail = LogTail(log_file)
+        self.save_path = save_path or os.path.join(os.path.dirname(log_file), 'agent_num_plot.png')
+        self.max_points = max_points
+        self.method = method
+        ctx = multiprocessing.get_context('spawn')
+        # only the latest request is kept, older ones are dropped
+        self.requests = ctx.Queue(maxsize=1)
+        self.process = ctx.Process(target=_render_worker, args=(self.requests, self.save_path), daemon=True)
+        self.process.start()
+
+    def update(self):
+        if self.tail.read() == 0 and len(self.tail) > 0:
+            return
+        predators = self.tail['num_predators']
+        preys = self.tail['num_preys']
+        x = np.arange(len(preys), dtype=float)
+        request = {'predators': decimate(x, predators, self.max_points, self.method),
+                   'preys': decimate(x, preys, self.max_points, self.method)}
+        try:
+            self.requests.put_nowait(request)
+        except queue.Full:
+            try:
+                self.requests.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self.requests.put_nowait(request)
+            except queue.Full:
+                pass
+
+    def close(self):
+        if self.process is None:
+            return
+        self.update()
+        self.requests.put(None)
+        self.process.join()
+        self.process = None
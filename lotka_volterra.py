@@ -0,0 +1,182 @@
+import os, sys
+
+import numpy as np
+
+'''
+Lotka-Volterra model
+
+    du/dt = (alpha - beta * v) * u
+    dv/dt = (-gamma + delta * u) * v
+
+u is the number of preys and v the number of predators, theta = (alpha, beta, gamma, delta).
+All functions accept a batch of parameter vectors: z has shape (..., 2) and theta (..., 4).
+'''
+
+
+def dz_dt(z, theta):
+    '''
+    Args:
+        z: Populations {prey, predator}, shape (..., 2)
+        theta: Parameters {alpha, beta, gamma, delta}, shape (..., 4)
+    '''
+    u = z[..., 0]
+    v = z[..., 1]
+    alpha, beta, gamma, delta = theta[..., 0], theta[..., 1], theta[..., 2], theta[..., 3]
+    return np.stack([(alpha - beta * v) * u, (-gamma + delta * u) * v], -1)
+
+
+def integrate(z_init, theta, steps, dt=1., substeps=10):
+    '''
+    Integrate the model with the classical Runge-Kutta method, for a whole
+    batch of initial populations and parameters at once
+
+    Args:
+        z_init: Initial populations {prey, predator}, shape (..., 2)
+        theta: Parameters {alpha, beta, gamma, delta}, shape (..., 4)
+        steps: Number of time steps to return
+        dt: Length of a time step
+        substeps: Number of RK4 steps per time step
+
+    Returns:
+        Array of shape (steps+1, ..., 2)
+    '''
+    z_init = np.asarray(z_init, dtype=float)
+    theta = np.asarray(theta, dtype=float)
+    batch_shape = np.broadcast(z_init[..., 0], theta[..., 0]).shape
+    z = np.broadcast_to(z_init, batch_shape+(2,)).copy()
+    h = dt / substeps
+    zs = np.zeros((steps+1,)+batch_shape+(2,))
+    zs[0] = z
+    with np.errstate(over='ignore', invalid='ignore'):
+        for i in range(steps):
+            for _ in range(substeps):
+                k1 = dz_dt(z, theta)
+                k2 = dz_dt(z + h/2*k1, theta)
+                k3 = dz_dt(z + h/2*k2, theta)
+                k4 = dz_dt(z + h*k3, theta)
+                z = np.clip(z + h/6*(k1 + 2*k2 + 2*k3 + k4), 0., 1e12)
+            zs[i+1] = z
+    return np.nan_to_num(zs, nan=1e12)
+
+
+def fit_regression(prey_num, predator_num, stride=10):
+    '''
+    Fast estimate of theta from an observed trajectory.
+
+    The per-capita growth rates d(log u)/dt = alpha - beta * v and
+    d(log v)/dt = -gamma + delta * u are linear in the populations, so theta is
+    found by two least-squares fits on central differences of the log
+    populations.
+
+    Args:
+        prey_num: Number of preys at every step
+        predator_num: Number of predators at every step
+        stride: The trajectory is subsampled every stride steps to reduce noise
+
+    Returns:
+        theta {alpha, beta, gamma, delta} in units of steps, or None if the
+        trajectory is too short
+    '''
+    u = np.asarray(prey_num, dtype=float)[::stride]
+    v = np.asarray(predator_num, dtype=float)[::stride]
+    valid = (u > 0) & (v > 0)
+    n = np.argmin(valid) if not valid.all() else len(u)
+    u, v = u[:n], v[:n]
+    if n < 5:
+        return None
+
+    dlog_u = (np.log(u[2:]) - np.log(u[:-2])) / (2.*stride)
+    dlog_v = (np.log(v[2:]) - np.log(v[:-2])) / (2.*stride)
+    ones = np.ones(n-2)
+    a, _, _, _ = np.linalg.lstsq(np.stack([ones, -v[1:-1]], 1), dlog_u, rcond=None)
+    b, _, _, _ = np.linalg.lstsq(np.stack([-ones, u[1:-1]], 1), dlog_v, rcond=None)
+    return np.array([a[0], a[1], b[0], b[1]])
+
+
+# Priors of the Stan model in estimate_parameters.py
+PRIOR_MEAN = np.array([1., 0.05, 1., 0.05])
+PRIOR_SD = np.array([0.5, 0.05, 0.5, 0.05])
+
+
+def fit(prey_num, predator_num, method='lsq', n_starts=256, n_refine=4, substeps=4, seed=0):
+    '''
+    Fit the model to observed populations without Stan.
+
+    The parameters phi = log(theta, z_init) are fitted to the log populations,
+    like the lognormal likelihood of the Stan model. Many starting points are
+    screened at once with the batched integrator, and the best ones are refined
+    with scipy.optimize.least_squares. Uncertainties come from a Laplace
+    approximation around the optimum.
+
+    Args:
+        prey_num: Observed preys at times 0, 1, ..., N
+        predator_num: Observed predators at times 0, 1, ..., N
+        method: 'lsq' for least squares or 'map' to add the priors of the Stan model
+        n_starts: Number of random starting points
+        n_refine: Number of starting points refined by the optimiser
+        substeps: Number of RK4 steps per time step
+
+    Returns:
+        Dictionary with theta, z_init, sigma, theta_sd, theta_interval (95%),
+        cov (of phi) and loss
+    '''
+    from scipy.optimize import least_squares
+
+    y = np.stack([np.asarray(prey_num, dtype=float), np.asarray(predator_num, dtype=float)], -1)
+    log_y = np.log(np.maximum(y, 1.))
+    N = len(y)-1
+
+    def predict_log(phi):
+        zs = integrate(np.exp(phi[..., 4:]), np.exp(phi[..., :4]), N, 1., substeps)
+        return np.log(np.maximum(zs, 1e-8))
+
+    def data_residuals(phi):
+        return (predict_log(phi) - log_y.reshape((N+1,)+(1,)*(phi.ndim-1)+(2,)))
+
+    sigma = np.ones(2)
+
+    def residuals(phi):
+        r = (data_residuals(phi)/sigma).ravel()
+        if method == 'map':
+            r = np.concatenate([r, (np.exp(phi[:4]) - PRIOR_MEAN)/PRIOR_SD, phi[4:] - np.log(10.)])
+        return r
+
+    # starting points around the regression estimate
+    rng = np.random.RandomState(seed)
+    theta0 = fit_regression(y[:, 0], y[:, 1], stride=1)
+    if theta0 is None or np.any(theta0 <= 0):
+        theta0 = np.array([0.1, 0.1/y[:, 1].mean(), 0.1, 0.1/y[:, 0].mean()])
+    phi0 = np.concatenate([np.log(theta0), np.log(np.maximum(y[0], 1.))])
+    starts = phi0 + rng.normal(scale=[1., 1., 1., 1., 0.1, 0.1], size=(n_starts, 6))
+    starts[0] = phi0
+    ssr = (data_residuals(starts)**2).sum(axis=(0, 2))
+    ssr[~np.isfinite(ssr)] = np.inf
+
+    best = None
+    for k in np.argsort(ssr)[:n_refine]:
+        res = least_squares(residuals, starts[k], method='trf')
+        if best is None or res.cost < best.cost:
+            best = res
+    if method == 'map':
+        # the priors are weighted against the noise level of the first fit
+        sigma = np.sqrt(np.mean(data_residuals(best.x)**2, axis=0))
+        best = least_squares(residuals, best.x, method='trf')
+
+    phi = best.x
+    J = best.jac
+    if method == 'lsq':
+        dof = max(1, J.shape[0] - len(phi))
+        s2 = 2*best.cost/dof
+        cov = np.linalg.pinv(J.T.dot(J))*s2
+        sigma = np.sqrt(np.mean(data_residuals(phi)**2, axis=0))
+    else:
+        cov = np.linalg.pinv(J.T.dot(J))
+    sd = np.sqrt(np.maximum(np.diag(cov), 0.))
+    theta = np.exp(phi[:4])
+    return {'theta': theta,
+            'z_init': np.exp(phi[4:]),
+            'sigma': sigma,
+            'theta_sd': theta*sd[:4],
+            'theta_interval': np.stack([np.exp(phi[:4]-1.96*sd[:4]), np.exp(phi[:4]+1.96*sd[:4])], -1),
+            'cov': cov,
+            'loss': 2*best.cost}
@@ -25,6 +25,7 @@ import torch.nn as nn
 import torch.optim as optim
 import shutil
 from trainer import Trainer
+from profiling import profile_call
 
 def read_yaml(path):
     f = open(path, 'r')
@@ -76,7 +77,8 @@ def main():
 @click.option('--env_type', required=True)
 @click.option('--experiment_id', help='Experiment Id', required=True, type=int)
 @click.option('--config_file', help='config file', type=str, default='./configs/config.yaml')
-def ddqn(env_type, experiment_id, config_file):
+@click.option('--resume', help='Resume from the latest checkpoint', is_flag=True, default=False)
+def ddqn(env_type, experiment_id, config_file, resume):
     '''
     Double Deep Q-learning
 
@@ -84,6 +86,7 @@ def ddqn(env_type, experiment_id, config_file):
         env_type: Evnrionment Type
         experiment_id: Id for the experiment
         config_file: Path of the config file
+        resume: Restart from the latest checkpoint of the experiment
     '''
 
     params = read_yaml(config_file)
@@ -91,7 +94,8 @@ def ddqn(env_type, experiment_id, config_file):
     params['env_type'] = env_type
     params['experiment_id'] = experiment_id
 
-    save_config(params, experiment_id)
+    if not resume:
+        save_config(params, experiment_id)
     env = make_env(env_type, params)
     env.make_world(wall_prob=params.wall_prob, wall_seed=20, food_prob=0)
     q_net = create_nn(params)
@@ -106,14 +110,16 @@ def ddqn(env_type, experiment_id, config_file):
                 params.min_greedy,
                 params.max_greedy,
                 params.greedy_step,
-                params.update_period)
+                params.update_period,
+                resume=resume)
 
 
 @main.command()
 @click.option('--env_type', required=True)
 @click.option('--experiment_id', help='Experiment Id', required=True, type=int)
 @click.option('--config_file', help='config file', type=str, default='./configs/config.yaml')
-def dqn(env_type, experiment_id, config_file):
+@click.option('--resume', help='Resume from the latest checkpoint', is_flag=True, default=False)
+def dqn(env_type, experiment_id, config_file, resume):
     '''
     Deep Q-learning
 
@@ -121,6 +127,7 @@ def dqn(env_type, experiment_id, config_file):
         env_type: Evnrionment Type
         experiment_id: Id for the experiment
         config_file: Path of the config file
+        resume: Restart from the latest checkpoint of the experiment
     '''
 
     params = read_yaml(config_file)
@@ -128,7 +135,8 @@ def dqn(env_type, experiment_id, config_file):
     params['env_type'] = env_type
     params['experiment_id'] = experiment_id
 
-    save_config(params, experiment_id)
+    if not resume:
+        save_config(params, experiment_id)
     env = make_env(env_type, params)
     env.make_world(wall_prob=params.wall_prob, wall_seed=20, food_prob=0)
     q_net = create_nn(params)
@@ -140,7 +148,8 @@ def dqn(env_type, experiment_id, config_file):
     agent.train(params.episodes,
                 params.episode_step,
                 params.random_step, params.min_greedy, params.max_greedy, params.greedy_step,
-                params.update_period)
+                params.update_period,
+                resume=resume)
 
 @click.option('--config_file', help='config file', type=str, default='./configs/config.yaml')
 def dqn_two_agents(env_type, experiment_id, config_file):
@@ -171,7 +180,8 @@ def dqn_two_agents(env_type, experiment_id, config_file):
 @click.option('--env_type', required=True)
 @click.option('--experiment_id', help='Experiment Id', required=True, type=int)
 @click.option('--config_file', help='config file', type=str, default='./configs/config.yaml')
-def drqn(env_type, experiment_id, config_file):
+@click.option('--resume', help='Resume from the latest checkpoint', is_flag=True, default=False)
+def drqn(env_type, experiment_id, config_file, resume):
     '''
     Deep Recurrent Q-learning
 
@@ -179,6 +189,7 @@ def drqn(env_type, experiment_id, config_file):
         env_type: Evnrionment Type
         experiment_id: Id for the experiment
         config_file: Path of the config file
+        resume: Restart from the latest checkpoint of the experiment
     '''
 
     params = read_yaml(config_file)
@@ -186,7 +197,8 @@ def drqn(env_type, experiment_id, config_file):
     params['env_type'] = env_type
     params['experiment_id'] = experiment_id
 
-    save_config(params, experiment_id)
+    if not resume:
+        save_config(params, experiment_id)
     env = make_env(env_type, params)
     env.make_world(wall_prob=params.wall_prob, food_prob=0)
     q_net = create_nn(params)
@@ -198,8 +210,71 @@ def drqn(env_type, experiment_id, config_file):
     agent.train(params.episodes,
                 params.episode_step,
                 params.random_step, params.min_greedy, params.max_greedy, params.greedy_step,
-                params.update_period)
+                params.update_period,
+                resume=resume)
+
+
+@main.command(name='profile')
+@click.option('--env_type', required=True)
+@click.option('--config_file', help='config file', type=str, default='./configs/config.yaml')
+@click.option('--model_type', help='Agent to profile', type=click.Choice(['DQN', 'DDQN', 'DRQN']), default='DRQN')
+@click.option('--steps', help='Number of training steps', type=int, default=100)
+@click.option('--experiment_id', help='Experiment Id of the profiled run', type=int, default=9999)
+@click.option('--out_dir', help='Directory of the profiles, profile/ in the experiment by default', type=str, default=None)
+@click.option('--seed', help='Random seed', type=int, default=0)
+@click.option('--torch_profiler/--no_torch_profiler', help='Also run torch.profiler', default=True)
+def profile(env_type, config_file, model_type, steps, experiment_id, out_dir, seed, torch_profiler):
+    '''
+    Profile the training of an agent for a number of steps
+
+    Writes profile.pstats, trace.json (Chrome trace), stacks.txt (collapsed
+    stacks for flamegraphs) and report.txt (top 20 hotspots), see profiling.py
+
+    Args:
+        env_type: Evnrionment Type
+        config_file: Path of the config file
+        model_type: DQN, DDQN or DRQN
+        steps: Number of training steps, run as one episode
+        experiment_id: Id for the profiled run, its results are overwritten
+        out_dir: Directory of the profiles
+        seed: Seed of numpy, random and torch
+        torch_profiler: Also run torch.profiler
+    '''
+    import random
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    params = read_yaml(config_file)
+    params['model_type'] = model_type
+    params['env_type'] = env_type
+    params['experiment_id'] = experiment_id
+    save_config(params, experiment_id)
+
+    env = make_env(env_type, params)
+    if model_type == 'DRQN':
+        env.make_world(wall_prob=params.wall_prob, food_prob=0)
+    else:
+        env.make_world(wall_prob=params.wall_prob, wall_seed=20, food_prob=0)
+    q_net = create_nn(params)
+    agent = {'DQN': DQN, 'DDQN': DDQN, 'DRQN': DRQN}[model_type](params,
+                env,
+                q_net,
+                nn.MSELoss(),
+                optim.RMSprop)
+
+    def run():
+        agent.train(1,
+                    steps,
+                    params.random_step, params.min_greedy, params.max_greedy, params.greedy_step,
+                    params.update_period)
 
+    if out_dir is None:
+        out_dir = os.path.join('./results', env_type, 'exp_{:d}'.format(experiment_id), 'profile')
+    report_file = profile_call(run, out_dir, use_torch=torch_profiler)
+    with open(report_file) as f:
+        print(f.read())
+    print('Profiles written to {}'.format(out_dir))
 
 
 if __name__ == '__main__':
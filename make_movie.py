@@ -1,26 +1,180 @@
 import os, sys
 
+import re
+import shutil
+import subprocess
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import argparse
 import cv2
-from cv2 import imread, VideoWriter
-from utils import make_video
 
 '''
 Generate a movie from images
+
+The images of a directory are listed with one scan and ordered by their
+number. They are decoded and resized by a thread pool; a bounded buffer of
+pending frames keeps them in order and limits the memory in use. With
+--chunks, independent parts of the movie are encoded by separate processes
+and concatenated (with ffmpeg when it is installed).
 '''
 
-argparser = argparse.ArgumentParser()
+FRAME_PATTERN = re.compile(r'^(\d+)\.png$')
+
+
+def list_frames(img_dir):
+    '''
+    Paths of the numbered images (1.png, 2.png, ...) of a directory in numeric order
+    '''
+    frames = []
+    for entry in os.scandir(img_dir):
+        match = FRAME_PATTERN.match(entry.name)
+        if match is not None:
+            frames.append((int(match.group(1)), entry.path))
+    frames.sort()
+    return [path for _, path in frames]
+
+
+def load_frame(path, size=None):
+    img = cv2.imread(path)
+    if img is None:
+        raise IOError('cannot read {}'.format(path))
+    if size is not None and (img.shape[1], img.shape[0]) != tuple(size):
+        img = cv2.resize(img, tuple(size), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def frame_size(path, scale=1.):
+    img = load_frame(path)
+    return (max(int(round(img.shape[1]*scale)), 1), max(int(round(img.shape[0]*scale)), 1))
+
+
+def decoded_frames(paths, size=None, workers=4, buffer_size=16):
+    '''
+    Decoded frames in the order of paths. At most buffer_size frames are
+    decoded ahead of the one being written
+    '''
+    if workers <= 1:
+        for path in paths:
+            yield load_frame(path, size)
+        return
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(load_frame, path, size))
+            if len(pending) >= buffer_size:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def encode(paths, outvid, fps=5, size=None, format='XVID', workers=4, buffer_size=16):
+    '''
+    Write the images to a video
+
+    Args:
+        paths: Paths of the images in order
+        outvid: Path of the video
+        size: (width, height) of the video, the size of the first image by default
+        workers: Number of decoding threads
+        buffer_size: Number of frames decoded ahead
+    '''
+    if size is None:
+        size = frame_size(paths[0])
+    vid = cv2.VideoWriter(outvid, cv2.VideoWriter_fourcc(*format), float(fps), tuple(size), True)
+    for img in decoded_frames(paths, size, workers, buffer_size):
+        vid.write(img)
+    vid.release()
+    return outvid
+
+
+def _encode_chunk(job):
+    paths, outvid, fps, size, format, workers, buffer_size = job
+    return encode(paths, outvid, fps, size, format, workers, buffer_size)
+
+
+def concatenate(parts, outvid):
+    '''
+    Concatenate videos encoded with the same settings
+    '''
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is not None:
+        list_file = outvid+'.parts.txt'
+        with open(list_file, 'w') as f:
+            for part in parts:
+                f.write("file '{}'\n".format(os.path.abspath(part)))
+        try:
+            subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', outvid], check=True)
+        finally:
+            os.remove(list_file)
+        return outvid
+
+    # without ffmpeg the frames of the parts are decoded and encoded again
+    vid = None
+    for part in parts:
+        cap = cv2.VideoCapture(part)
+        if vid is None:
+            size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            vid = cv2.VideoWriter(outvid, int(cap.get(cv2.CAP_PROP_FOURCC)), cap.get(cv2.CAP_PROP_FPS), size, True)
+        while True:
+            ok, img = cap.read()
+            if not ok:
+                break
+            vid.write(img)
+        cap.release()
+    if vid is not None:
+        vid.release()
+    return outvid
+
+
+def make_movie(paths, outvid, fps=5, scale=1., format='XVID', workers=4, buffer_size=16, chunks=1):
+    '''
+    Write the images to a video, in chunks encoded by separate processes if chunks > 1
+    '''
+    size = frame_size(paths[0], scale)
+    chunks = max(min(chunks, len(paths)), 1)
+    if chunks == 1:
+        return encode(paths, outvid, fps, size, format, workers, buffer_size)
+
+    root, ext = os.path.splitext(outvid)
+    bounds = np.linspace(0, len(paths), chunks+1).astype(np.int64)
+    # the decoding threads are shared among the chunks
+    chunk_workers = max(workers // chunks, 1)
+    jobs = [(paths[st:ed], '{}.part{:03d}{}'.format(root, k, ext), fps, size, format, chunk_workers, buffer_size)
+            for k, (st, ed) in enumerate(zip(bounds[:-1], bounds[1:]))]
+    with multiprocessing.Pool(chunks) as pool:
+        parts = pool.map(_encode_chunk, jobs)
+    try:
+        concatenate(parts, outvid)
+    finally:
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+    return outvid
 
-argparser.add_argument('--img_dir', type=str, help='image dir', required=True)
 
-args = argparser.parse_args()
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
 
-img_dir = args.img_dir
+    argparser.add_argument('--img_dir', type=str, help='image dir', required=True)
+    argparser.add_argument('--outvid', type=str, default=None, help='video path, video.avi in the image dir by default')
+    argparser.add_argument('--st', type=int, default=0, help='index of the first image')
+    argparser.add_argument('--ed', type=int, default=None, help='index after the last image')
+    argparser.add_argument('--fps', type=float, default=5)
+    argparser.add_argument('--scale', type=float, default=1., help='scale of the frames')
+    argparser.add_argument('--format', type=str, default='XVID', help='FourCC code of the codec')
+    argparser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of decoding threads')
+    argparser.add_argument('--buffer_size', type=int, default=None, help='number of frames decoded ahead, 4 per worker by default')
+    argparser.add_argument('--chunks', type=int, default=1, help='number of parts encoded in parallel')
 
-st = 0
-ed = len(os.listdir(img_dir))
+    args = argparser.parse_args()
 
-images = [os.path.join(img_dir, '{:d}.png'.format(i+1)) for i in range(st, ed)]
+    img_dir = args.img_dir
+    images = list_frames(img_dir)[args.st:args.ed]
+    if len(images) == 0:
+        sys.exit('no images in {}'.format(img_dir))
 
-make_video(images, os.path.join(img_dir, 'video.avi'))
+    outvid = args.outvid or os.path.join(img_dir, 'video.avi')
+    buffer_size = args.buffer_size or 4*args.workers
+    make_movie(images, outvid, args.fps, args.scale, args.format, args.workers, buffer_size, args.chunks)
@@ -0,0 +1,238 @@
+import os, sys
+
+import gc
+import resource
+from collections import OrderedDict
+
+import numpy as np
+
+'''
+Memory accounting of a training run
+
+MemoryMonitor reads the resident set size (RSS) of the process at every step,
+which costs a read of /proc/self/statm, and every `every` steps breaks the
+memory down by subsystem: tensors of the networks and the optimizer, the
+agent embeddings, the recurrent states, the agents of the environment and the
+snapshots of the state pool. The values, with the bytes per agent, are added
+to the records of the metrics log as mem_* columns.
+
+With a budget, crossing budget_ratio of it prints a warning, and with the
+'throttle' action the loop also stops adding agents (crossover) until the RSS
+is back under it, since the deepcopy of the world and the look-ahead grow with
+the population.
+'''
+
+MB = float(1 << 20)
+STATE_DICTS = ['agent_hidden_states', 'agent_cell_states', 'agent_target_hidden_states', 'agent_target_cell_states']
+ACTIONS = ['warn', 'throttle']
+
+
+def rss_bytes():
+    '''
+    Resident set size of the process, or its peak where /proc is not available
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def value_bytes(value):
+    '''
+    Bytes of an array, a tensor or a container of them, including the Python objects
+    '''
+    if isinstance(value, np.ndarray):
+        # getsizeof counts the data only if the array owns it
+        return sys.getsizeof(value) + (value.nbytes if value.base is not None else 0)
+    if hasattr(value, 'element_size') and hasattr(value, 'nelement'):
+        return sys.getsizeof(value) + value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return dict_bytes(value)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(value_bytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def dict_bytes(d):
+    '''
+    Bytes of a dictionary, its keys and its values
+    '''
+    return sys.getsizeof(d) + sum(sys.getsizeof(k) + value_bytes(v) for k, v in d.items())
+
+
+def object_bytes(obj):
+    '''
+    Shallow size of an object: the object, its attribute dictionary and the attributes
+    '''
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__) + sum(value_bytes(v) for v in obj.__dict__.values())
+    return size
+
+
+def sampled_dict_bytes(d, sample=100):
+    '''
+    Bytes of a dictionary of objects, extrapolated from the size of at most sample of them
+    '''
+    n = len(d)
+    if n == 0:
+        return sys.getsizeof(d)
+    step = max(n // sample, 1)
+    values = list(d.values())[::step][:sample]
+    per_object = sum(object_bytes(v) for v in values) / float(len(values))
+    return sys.getsizeof(d) + int(per_object * n)
+
+
+def module_bytes(module):
+    '''
+    Bytes of the parameters and buffers of a torch module
+    '''
+    if module is None:
+        return 0
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.element_size() * t.nelement() for t in tensors)
+
+
+def optimizer_bytes(opt):
+    '''
+    Bytes of the state tensors of a torch optimizer (moments, square averages, ...)
+    '''
+    if opt is None:
+        return 0
+    size = 0
+    for state in opt.state.values():
+        for value in state.values():
+            if hasattr(value, 'element_size'):
+                size += value.element_size() * value.nelement()
+    return size
+
+
+class MemoryMonitor(object):
+    '''
+    Args:
+        every: Break the memory down every this many steps, 0 disables the monitor
+        budget: Budget of the RSS in bytes, None for no budget
+        action: 'warn' or 'throttle' when the RSS reaches budget_ratio of the budget
+        budget_ratio: Fraction of the budget at which the action is taken
+    '''
+    def __init__(self, every=100, budget=None, action='warn', budget_ratio=0.9):
+        if action not in ACTIONS:
+            raise ValueError('memory action must be one of {}, got {}'.format(ACTIONS, action))
+        self.every = every
+        self.budget = budget
+        self.action = action
+        self.budget_ratio = budget_ratio
+        self.calls = 0
+        self.last = OrderedDict()
+        self.over_budget = False
+        self.peak = 0
+
+    @classmethod
+    def from_args(cls, args):
+        '''
+        Monitor configured by the optional memory_every, memory_budget_mb,
+        memory_action and memory_budget_ratio entries of a config
+        '''
+        budget = getattr(args, 'memory_budget_mb', None)
+        return cls(getattr(args, 'memory_every', 100),
+                   budget * MB if budget else None,
+                   getattr(args, 'memory_action', 'warn'),
+                   getattr(args, 'memory_budget_ratio', 0.9))
+
+    @property
+    def enabled(self):
+        return self.every > 0
+
+    @property
+    def throttled(self):
+        '''
+        True while the loop should not add agents
+        '''
+        return self.action == 'throttle' and self.over_budget
+
+    def measure(self, agent, env):
+        '''
+        Memory of the subsystems of an agent and its environment
+
+        Returns:
+            Dictionary of subsystem to bytes
+        '''
+        sizes = OrderedDict()
+        sizes['rss'] = rss_bytes()
+        sizes['tensors'] = (module_bytes(getattr(agent, 'q_net', None)) +
+                            module_bytes(getattr(agent, 'target_q_net', None)) +
+                            optimizer_bytes(getattr(agent, 'opt', None)))
+        sizes['embeddings'] = dict_bytes(getattr(agent, 'agent_embeddings', {}))
+        sizes['recurrent_states'] = sum(dict_bytes(getattr(agent, name, {})) for name in STATE_DICTS)
+        # predators and preys refer to the objects of agents, only their tables are added
+        sizes['env_agents'] = (sampled_dict_bytes(env.agents) +
+                               sys.getsizeof(env.predators) + sys.getsizeof(env.preys))
+        state_pool = getattr(agent, 'state_pool', None)
+        sizes['state_pool'] = sum(value_bytes(state) for state in state_pool.states) if state_pool is not None else 0
+        try:
+            import torch
+            if torch.cuda.is_available():
+                sizes['cuda'] = torch.cuda.memory_allocated()
+        except ImportError:
+            pass
+        return sizes
+
+    def record(self, agent, env):
+        '''
+        Memory columns of the metrics log for the current step
+
+        The RSS and the budget are checked at every call, the breakdown is
+        measured every `every` calls and repeated in between, so every record
+        has the same columns.
+        '''
+        if not self.enabled:
+            return OrderedDict()
+        self.calls += 1
+        rss = rss_bytes()
+        if (self.calls-1) % self.every == 0:
+            sizes = self.measure(agent, env)
+            rss = sizes['rss']
+            num_agents = max(len(env.agents), 1)
+            per_agent = sizes['embeddings'] + sizes['recurrent_states'] + sizes['env_agents']
+            self.last = OrderedDict()
+            for name, value in sizes.items():
+                if name != 'rss':
+                    self.last['mem_{}_mb'.format(name)] = value / MB
+            self.last['mem_bytes_per_agent'] = int(rss // num_agents)
+            self.last['mem_agent_state_bytes_per_agent'] = int(per_agent // num_agents)
+        self.last['mem_rss_mb'] = rss / MB
+        self.last.move_to_end('mem_rss_mb', last=False)
+        self.peak = max(self.peak, rss)
+        self.check_budget(rss)
+        return self.last
+
+    def check_budget(self, rss):
+        if self.budget is None:
+            return
+        limit = self.budget_ratio * self.budget
+        if rss >= limit and not self.over_budget:
+            # memory held by collected objects and the CUDA cache is given back first
+            gc.collect()
+            try:
+                import torch
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except ImportError:
+                pass
+            rss = rss_bytes()
+            if rss < limit:
+                return
+            self.over_budget = True
+            print('memory: RSS {:.0f} MB is above {:.0f}% of the budget of {:.0f} MB{}'.format(
+                rss / MB, 100 * self.budget_ratio, self.budget / MB,
+                ', no agents are added until it goes down' if self.action == 'throttle' else ''))
+        elif rss < limit and self.over_budget:
+            self.over_budget = False
+            print('memory: RSS {:.0f} MB is back under the budget'.format(rss / MB))
@@ -0,0 +1,724 @@
+import os, sys
+
+import json
+import gzip
+import zlib
+import shutil
+import time
+import atexit
+import threading
+import queue
+from collections import OrderedDict
+
+import numpy as np
+
+'''
+Columnar metrics log
+
+Per-step records are buffered and appended in chunks to .npy segments of a
+metrics directory (one structured array per segment). schema.json lists the
+columns with their types and the segments, so a reader addresses columns by
+name and memory-maps the segments instead of parsing text. Existing text logs
+(log.txt) are parsed once and cached next to the log (load_metrics), or
+converted into a metrics directory with convert_text_log.
+
+Text logs may be gzip-compressed (log.txt.gz) and rotated by size (log.txt.1,
+log.txt.2, ... with the oldest part last); the readers take the path of the
+current log.txt and read every part, compressed or not.
+'''
+
+SCHEMA_NAME = 'schema.json'
+TRAITS = ['health', 'attack', 'resilience', 'speed']
+
+# names of columns written with a typo by older versions of the text log
+RENAMED_COLUMNS = {'ar_prey_resilience': 'var_prey_resilience',
+                   'num_ramdom_predators': 'num_random_predators'}
+
+
+def metrics_dir_of(log_file):
+    return os.path.join(os.path.dirname(log_file), 'metrics')
+
+
+def step_record(step, reward, env, increase_predators=None, increase_preys=None, killed=None, counts=None):
+    '''
+    Record of the population at one step
+
+    Args:
+        step: Step in the episode
+        reward: Average reward
+        env: Environment
+        increase_predators: Number of predators born at this step
+        increase_preys: Number of preys born at this step
+        killed: Agents removed at this step
+        counts: Population columns, by default num_preys and num_predators
+    '''
+    record = OrderedDict([('Step', int(step)), ('Reward', float(reward)), ('num_agents', len(env.agents))])
+    if counts is None:
+        counts = [('num_preys', len(env.preys)), ('num_predators', len(env.predators))]
+    record.update(counts)
+    if increase_predators is not None:
+        record['increase_predators'] = int(increase_predators)
+        record['increase_preys'] = int(increase_preys)
+    if killed is not None:
+        record['killed_agents'] = len(killed)
+    return record
+
+
+def variation_counts(env):
+    '''
+    Population columns of train_with_variation
+    '''
+    return [('num_random_preys', len(env.random_preys)),
+            ('num_trained_preys', len(env.trained_preys)),
+            ('num_training_preys', len(env.training_preys)),
+            ('num_random_predators', len(env.random_predators)),
+            ('num_trained_predators', len(env.trained_predators)),
+            ('num_training_predators', len(env.training_predators))]
+
+
+def trait_record(env, variance=True):
+    '''
+    Averages (and variances) of the traits of predators and preys
+    '''
+    record = OrderedDict()
+    for trait in TRAITS:
+        for species in ['predator', 'prey']:
+            record['average_{}_{}'.format(species, trait)] = float(np.mean(getattr(env, '{}_{}'.format(species, trait))))
+    if variance:
+        for trait in TRAITS:
+            for species in ['predator', 'prey']:
+                record['var_{}_{}'.format(species, trait)] = float(np.var(getattr(env, '{}_{}'.format(species, trait))))
+    return record
+
+
+def format_record(record):
+    '''
+    Text line of a record, in the format of log.txt
+    '''
+    items = []
+    for name, value in record.items():
+        if name in ('Step', 'Episode'):
+            items.append('{}\t{:03d}'.format(name, value))
+        elif isinstance(value, (int, np.integer)):
+            items.append('{}\t{:d}'.format(name, value))
+        else:
+            items.append('{}\t{:5.3f}'.format(name, value))
+    return '\t'.join(items)
+
+
+def parse_line(line):
+    '''
+    Record of a line of a text log. Names and values alternate in the line
+    '''
+    tokens = line.split()
+    record = OrderedDict()
+    for name, value in zip(tokens[0::2], tokens[1::2]):
+        name = RENAMED_COLUMNS.get(name, name)
+        try:
+            record[name] = int(value)
+        except ValueError:
+            record[name] = float(value)
+    return record
+
+
+class MetricsWriter(object):
+    '''
+    Appends records to a metrics directory in chunks
+
+    Args:
+        metrics_dir: Directory of the segments
+        chunk_size: Number of records per segment
+        append: Keep the existing segments (when a run is resumed)
+        fsync: Sync the segments and the schema to disk before they replace the old files
+    '''
+    def __init__(self, metrics_dir, chunk_size=1000, append=False, fsync=False):
+        self.metrics_dir = metrics_dir
+        self.chunk_size = chunk_size
+        self.fsync = fsync
+        if not append and os.path.exists(metrics_dir):
+            shutil.rmtree(metrics_dir)
+        if not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+
+        self.schema = read_schema(metrics_dir)
+        write_schema(metrics_dir, self.schema, fsync)
+        self.names = None
+        self.rows = []
+
+    def write(self, record):
+        names = tuple(record.keys())
+        if self.names is not None and names != self.names:
+            # records with other columns go to a new segment
+            self.flush()
+        self.names = names
+        self.rows.append(tuple(record.values()))
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        columns = list(zip(*self.rows))
+        dtype = [(name, np.asarray(values).dtype.str) for name, values in zip(self.names, columns)]
+        self.write_segment(np.array(self.rows, dtype=dtype))
+        self.rows = []
+
+    def write_columns(self, columns):
+        '''
+        Append whole columns at once
+
+        Args:
+            columns: Dictionary of name to 1-D array, all of the same length
+        '''
+        self.flush()
+        names = list(columns.keys())
+        n = len(columns[names[0]]) if len(names) > 0 else 0
+        array = np.zeros(n, dtype=[(name, np.asarray(columns[name]).dtype.str) for name in names])
+        for name in names:
+            array[name] = columns[name]
+        for st in range(0, n, self.chunk_size):
+            self.write_segment(array[st:st+self.chunk_size])
+
+    def write_segment(self, array):
+        file_name = 'segment_{:06d}.npy'.format(len(self.schema['segments']))
+        path = os.path.join(self.metrics_dir, file_name)
+        with open(path+'.tmp', 'wb') as f:
+            np.save(f, array)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path+'.tmp', path)
+
+        known = set(name for name, _ in self.schema['columns'])
+        for name in array.dtype.names:
+            if name not in known:
+                self.schema['columns'].append([name, array.dtype[name].str])
+        self.schema['segments'].append({'file': file_name, 'rows': len(array)})
+        write_schema(self.metrics_dir, self.schema, self.fsync)
+
+    def close(self):
+        self.flush()
+
+
+def read_schema(metrics_dir):
+    schema_file = os.path.join(metrics_dir, SCHEMA_NAME)
+    if os.path.exists(schema_file):
+        with open(schema_file) as f:
+            return json.load(f)
+    return {'columns': [], 'segments': []}
+
+
+def write_schema(metrics_dir, schema, fsync=False):
+    schema_file = os.path.join(metrics_dir, SCHEMA_NAME)
+    with open(schema_file+'.tmp', 'w') as f:
+        json.dump(schema, f)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(schema_file+'.tmp', schema_file)
+
+
+def fsync_file(path):
+    '''
+    Sync a closed file to disk
+    '''
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+class MetricsReader(object):
+    '''
+    Reads the columns of a metrics directory by name. Segments are memory-mapped
+
+    Args:
+        metrics_dir: Directory written by MetricsWriter
+    '''
+    def __init__(self, metrics_dir):
+        self.metrics_dir = metrics_dir
+        self.schema = read_schema(metrics_dir)
+        self.columns = [name for name, _ in self.schema['columns']]
+        self.segments = [np.load(os.path.join(metrics_dir, segment['file']), mmap_mode='r') for segment in self.schema['segments']]
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        if name not in self.columns:
+            raise KeyError(name)
+        if len(self.segments) == 1:
+            return np.asarray(self.segments[0][name])
+        parts = []
+        for segment in self.segments:
+            if name in segment.dtype.names:
+                parts.append(np.asarray(segment[name]))
+            else:
+                # the column did not exist when this segment was written
+                parts.append(np.full(len(segment), np.nan))
+        return np.concatenate(parts)
+
+    def get(self, name, default=None):
+        if name in self.columns:
+            return self[name]
+        return default
+
+
+def open_log_writer(path, mode='w', compress=False):
+    '''
+    Open a text log for writing, gzip-compressed if compress is set or the path
+    ends with .gz. Appending to a compressed log adds a gzip member
+    '''
+    if compress and not path.endswith('.gz'):
+        path += '.gz'
+    if path.endswith('.gz'):
+        return gzip.open(path, mode+'t')
+    return open(path, mode)
+
+
+def log_parts(log_file):
+    '''
+    Existing files of a text log, oldest first: the rotated parts
+    log.txt.N ... log.txt.1 followed by the current log.txt, each of them
+    possibly compressed
+
+    Args:
+        log_file: Path of log.txt (or log.txt.gz)
+    '''
+    base = log_file[:-3] if log_file.endswith('.gz') else log_file
+    rotated = []
+    while True:
+        name = '{}.{:d}'.format(base, len(rotated)+1)
+        found = [path for path in (name, name+'.gz') if os.path.exists(path)]
+        if len(found) == 0:
+            break
+        rotated.append(found[0])
+    current = [path for path in (base, base+'.gz') if os.path.exists(path)]
+    if len(current) > 1:
+        # left by runs with and without compression, the newest one is current
+        current = [max(current, key=os.path.getmtime)]
+    return rotated[::-1] + current
+
+
+def log_exists(log_file):
+    return len(log_parts(log_file)) > 0
+
+
+def log_size(log_file):
+    '''
+    Number of bytes of all the parts of a text log on disk
+    '''
+    return sum(os.path.getsize(path) for path in log_parts(log_file))
+
+
+def gunzip(decompressor, chunk):
+    '''
+    Decompress the next bytes of a gzip stream which may have several members
+    (appending to a compressed log starts a new one)
+
+    Returns:
+        The decompressor to use for the next bytes and the decompressed bytes
+    '''
+    if decompressor is None:
+        decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+    data = decompressor.decompress(chunk)
+    while decompressor.unused_data:
+        rest = decompressor.unused_data
+        decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+        data += decompressor.decompress(rest)
+    return decompressor, data
+
+
+def read_part(path, chunk_size=1<<20):
+    '''
+    Lines of one file of a text log, compressed or not. Compressed files are
+    decompressed incrementally, so a log which is still written (without a
+    gzip trailer yet) is read up to its last flush
+    '''
+    if not path.endswith('.gz'):
+        with open(path) as f:
+            for line in f:
+                yield line
+        return
+    decompressor = None
+    partial = b''
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            decompressor, data = gunzip(decompressor, chunk)
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line.decode()+'\n'
+    if partial:
+        yield partial.decode()
+
+
+def read_lines(log_file):
+    '''
+    Lines of all the parts of a text log, oldest first
+    '''
+    for path in log_parts(log_file):
+        for line in read_part(path):
+            yield line
+
+
+def load_text_columns(log_file, names=None):
+    '''
+    Columns of a text log selected by name, loaded with np.loadtxt.
+
+    Every line must have the layout of the first line; raises ValueError otherwise
+
+    Args:
+        log_file: Path of a text log
+        names: Names of the columns, all columns by default
+    '''
+    header = parse_line(next(read_lines(log_file), ''))
+    keys = list(header.keys())
+    if len(keys) == 0:
+        return OrderedDict()
+    if names is None:
+        names = keys
+    usecols = [2*keys.index(name)+1 for name in names]
+    # lines of older logs contain a vertical tab, which np.loadtxt does not split on
+    data = np.loadtxt((line.replace('\x0b', '\t') for line in read_lines(log_file)), usecols=usecols, ndmin=2)
+    columns = OrderedDict()
+    for k, name in enumerate(names):
+        columns[name] = data[:, k].astype(np.int64) if isinstance(header[name], int) else data[:, k]
+    return columns
+
+
+def parse_text_log(log_file):
+    '''
+    All columns of a text log. Lines with other layouts than the first line
+    are parsed one by one and missing values are NaN
+    '''
+    try:
+        return load_text_columns(log_file)
+    except (ValueError, IndexError):
+        pass
+    records = []
+    for line in read_lines(log_file):
+        if line.strip():
+            records.append(parse_line(line))
+    names = []
+    for record in records:
+        for name in record.keys():
+            if name not in names:
+                names.append(name)
+    columns = OrderedDict()
+    for name in names:
+        values = [record.get(name, np.nan) for record in records]
+        columns[name] = np.array(values)
+    return columns
+
+
+def convert_text_log(log_file, metrics_dir=None, chunk_size=10000):
+    '''
+    Convert a text log (log.txt) into a metrics directory
+
+    Returns:
+        Path of the metrics directory
+    '''
+    if metrics_dir is None:
+        metrics_dir = metrics_dir_of(log_file)
+    writer = MetricsWriter(metrics_dir, chunk_size=chunk_size)
+    writer.write_columns(parse_text_log(log_file))
+    writer.schema['log_size'] = log_size(log_file)
+    write_schema(metrics_dir, writer.schema)
+    return metrics_dir
+
+
+class LogColumns(object):
+    '''
+    Columns of a log held in memory, with the interface of MetricsReader
+    '''
+    def __init__(self, columns):
+        self.data = columns
+        self.columns = list(columns.keys())
+
+    def __len__(self):
+        return len(self.data[self.columns[0]]) if len(self.columns) > 0 else 0
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def get(self, name, default=None):
+        return self.data.get(name, default)
+
+
+def cache_file_of(log_file):
+    if log_file.endswith('.gz'):
+        log_file = log_file[:-3]
+    return log_file+'.cache.npz'
+
+
+def load_cached_columns(log_file):
+    '''
+    Columns of a text log, stored next to it as a compressed .npz which is
+    parsed again when the size or the modification time of a part of the log changes
+    '''
+    cache_file = cache_file_of(log_file)
+    stats = [os.stat(path) for path in log_parts(log_file)]
+    source = np.array([[stat.st_size, stat.st_mtime_ns] for stat in stats], dtype=np.int64).ravel()
+    if os.path.exists(cache_file):
+        try:
+            with np.load(cache_file, allow_pickle=False) as f:
+                if np.array_equal(f['__source__'], source):
+                    return LogColumns(OrderedDict((name, f[name]) for name in f['__columns__'].tolist()))
+        except (OSError, KeyError, ValueError):
+            pass
+
+    columns = parse_text_log(log_file)
+    try:
+        with open(cache_file+'.tmp', 'wb') as f:
+            np.savez_compressed(f, __source__=source, __columns__=np.array(list(columns.keys())), **columns)
+        os.replace(cache_file+'.tmp', cache_file)
+    except OSError:
+        # e.g. a read-only results directory
+        pass
+    return LogColumns(columns)
+
+
+def load_metrics(log_file):
+    '''
+    Columns of a log file by name. This is the loader used by the plots, the
+    scripts and the notebooks.
+
+    The metrics directory written next to the log is used when it covers the
+    whole log; other logs are parsed once and cached (see load_cached_columns)
+    '''
+    schema = read_schema(metrics_dir_of(log_file))
+    if log_exists(log_file) and schema.get('log_size') == log_size(log_file):
+        return MetricsReader(metrics_dir_of(log_file))
+    return load_cached_columns(log_file)
+
+
+_FLUSH = 'flush'
+_CLOSE = 'close'
+
+
+class StepLogger(object):
+    '''
+    Writes per-step records to the text log (log.txt) and to the columnar metrics log.
+
+    write() only queues the record; formatting and writing are done in batches
+    on a background thread. The text log is flushed every flush_interval
+    seconds and synced to disk (os.fsync) every fsync_interval seconds, so at
+    most that much of it is lost if the process crashes. Metrics segments are
+    written (and synced) every chunk_size records, by flush() and by close(),
+    so the metrics may lag behind the text log until then and load_metrics
+    reads the text log instead. With compress the text log
+    is written as log.txt.gz; every flush ends a deflate block, so a longer
+    flush_interval compresses better. With max_bytes the current text log is
+    rotated to log.txt.1 once it is larger than max_bytes.
+
+    Args:
+        log_dir: Directory of the logs
+        mode: 'w' to start new logs, 'a' to append to existing ones
+        chunk_size: Number of records per metrics segment
+        background: Write on a background thread, otherwise in write()
+        flush_interval: Seconds between flushes of the text log
+        fsync_interval: Seconds between syncs of the logs to disk
+        compress: Write the text log with gzip
+        max_bytes: Size of the text log on disk after which it is rotated (checked
+            every fsync_interval), 0 to never rotate
+    '''
+    def __init__(self, log_dir, mode='w', chunk_size=1000, background=True, flush_interval=1., fsync_interval=10.,
+                 compress=False, max_bytes=0):
+        self.log_dir = log_dir
+        self.text_file = os.path.join(log_dir, 'log.txt')
+        self.text_path = self.text_file+'.gz' if compress else self.text_file
+        self.max_bytes = max_bytes
+        if mode == 'w':
+            # also the parts left by a run with the other compression setting
+            while log_exists(self.text_file):
+                for path in log_parts(self.text_file):
+                    os.remove(path)
+        self.text = open_log_writer(self.text_path, mode)
+        self.metrics = MetricsWriter(os.path.join(log_dir, 'metrics'), chunk_size=chunk_size, append=(mode == 'a'), fsync=True)
+        self.background = background
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.last_flush = self.last_fsync = time.time()
+        self.closed = False
+        self.error = None
+
+        # time spent in write() by the step loop and by the writer
+        self.records = 0
+        self.caller_seconds = 0.
+        self.writer_seconds = 0.
+
+        if background:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_args(cls, log_dir, args, mode='w'):
+        '''
+        Logger configured by the optional compress_logs, log_max_bytes and
+        log_flush_interval entries of a config
+        '''
+        return cls(log_dir, mode,
+                   flush_interval=getattr(args, 'log_flush_interval', 1.),
+                   compress=getattr(args, 'compress_logs', False),
+                   max_bytes=getattr(args, 'log_max_bytes', 0))
+
+    def write(self, record):
+        if self.closed:
+            raise ValueError('write to the closed log {}'.format(self.log_dir))
+        st = time.time()
+        self.raise_error()
+        if self.background:
+            self.queue.put(record)
+        else:
+            self._write_batch([record])
+            self._maybe_flush()
+        self.records += 1
+        self.caller_seconds += time.time() - st
+
+    def _write_batch(self, records):
+        st = time.time()
+        self.text.write(''.join(format_record(record)+'\n' for record in records))
+        for record in records:
+            self.metrics.write(record)
+        self.writer_seconds += time.time() - st
+
+    def _flush(self, fsync=False, metrics=False):
+        '''
+        Flush the text log, sync it to disk with fsync, and with metrics also
+        write the pending records of the metrics as a segment
+        '''
+        st = time.time()
+        self.text.flush()
+        self.last_flush = time.time()
+        if fsync:
+            if self.max_bytes > 0 and os.path.getsize(self.text_path) >= self.max_bytes:
+                self.rotate()
+            os.fsync(self.text.fileno())
+            self.last_fsync = self.last_flush
+        if metrics:
+            self.metrics.flush()
+            # the metrics, synced by the writer, now hold every record of the text log
+            self.metrics.schema['log_size'] = log_size(self.text_file)
+            write_schema(self.metrics.metrics_dir, self.metrics.schema, fsync=True)
+        self.writer_seconds += time.time() - st
+
+    def rotate(self):
+        '''
+        Move log.txt to log.txt.1, log.txt.1 to log.txt.2, ... and start a new log.txt
+        '''
+        self.text.close()
+        # closing a compressed log writes its trailer, the old log is synced before it is renamed
+        fsync_file(self.text_path)
+        parts = log_parts(self.text_file)
+        for path in parts:
+            suffix = '.gz' if path.endswith('.gz') else ''
+            name = path[:len(path)-len(suffix)]
+            n = int(name.rsplit('.', 1)[1]) if name != self.text_file else 0
+            os.replace(path, '{}.{:d}{}'.format(self.text_file, n+1, suffix))
+        self.text = open_log_writer(self.text_path, 'w')
+
+    def _maybe_flush(self):
+        now = time.time()
+        if now - self.last_fsync >= self.fsync_interval:
+            self._flush(fsync=True)
+        elif now - self.last_flush >= self.flush_interval:
+            self._flush()
+
+    def _run(self):
+        running = True
+        while running:
+            try:
+                items = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                items = []
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                records = []
+                for item in items:
+                    if item is _FLUSH or item is _CLOSE:
+                        self._write_batch(records)
+                        records = []
+                        self._flush(fsync=True, metrics=True)
+                        running = running and item is not _CLOSE
+                    else:
+                        records.append(item)
+                self._write_batch(records)
+                self._maybe_flush()
+            except Exception as e:
+                self.error = e
+            for _ in items:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        '''
+        Write every queued record and flush both logs, e.g. before reading them.
+        The pending metrics records are written as a segment shorter than
+        chunk_size, so it is meant for episode ends rather than every step
+        '''
+        if self.closed:
+            return
+        if self.background:
+            self.queue.put(_FLUSH)
+            self.queue.join()
+        else:
+            self._flush(fsync=True, metrics=True)
+        self.raise_error()
+
+    def report(self):
+        return {'records': self.records,
+                'caller_seconds': self.caller_seconds,
+                'writer_seconds': self.writer_seconds,
+                'saved_seconds': self.writer_seconds - self.caller_seconds}
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.background:
+            self.queue.put(_CLOSE)
+            self.thread.join()
+        else:
+            self._flush(fsync=True, metrics=True)
+        self.text.close()
+        fsync_file(self.text_path)
+        self.metrics.close()
+        # closing a compressed log writes its trailer
+        self.metrics.schema['log_size'] = log_size(self.text_file)
+        write_schema(self.metrics.metrics_dir, self.metrics.schema, fsync=True)
+        atexit.unregister(self.close)
+        if self.background and self.records > 0:
+            report = self.report()
+            print('log {}: {:d} records, {:.3f}s in the step loop, {:.3f}s in the background writer'.format(
+                self.log_dir, report['records'], report['caller_seconds'], report['writer_seconds']))
+        self.raise_error()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('log_files', type=str, nargs='+', help='Text logs to convert')
+    args = argparser.parse_args()
+
+    for log_file in args.log_files:
+        print(convert_text_log(log_file))
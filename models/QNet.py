@@ -66,7 +66,7 @@ class QNetConv(nn.Module):
         num_actions: Number of actions
     '''
     def __init__(self, input_dim, hidden_dims=[32, 32], num_actions=4, agent_emb_dim=5, agent_emb_hidden=16):
-        super(QNetConvWithID, self).__init__()
+        super(QNetConv, self).__init__()
         self.num_actions = num_actions
         self.conv1 = nn.Conv2d(input_dim, hidden_dims[0], 3, padding=1, stride=2)
         self.conv2 = nn.Conv2d(hidden_dims[0], hidden_dims[1], 3, padding=1, stride=2)
@@ -0,0 +1,182 @@
+import os, sys
+
+import argparse
+import numpy as np
+import matplotlib.pyplot as plt
+import seaborn as sns
+from lotka_volterra import dz_dt, integrate
+from utils import load_populations
+
+'''
+Phase space of the Lotka-Volterra model
+
+Derivatives are evaluated on dense grids and trajectories are integrated for
+whole batches of initial conditions and parameters at once. Trajectories of the
+agent-based simulation read from log files can be overlaid on the vector field.
+The prey population is on the x axis and the predator population on the y axis.
+'''
+
+
+def make_grid(prey_max, predator_max, resolution=100):
+    '''
+    Returns:
+        Grid of populations, shape (resolution, resolution, 2)
+    '''
+    prey, predator = np.meshgrid(np.linspace(0, prey_max, resolution), np.linspace(0, predator_max, resolution))
+    return np.stack([prey, predator], -1)
+
+
+def vector_field(theta, grid):
+    '''
+    Derivatives on a grid, for one or many parameter vectors
+
+    Args:
+        theta: Parameters, shape (4,) or (P, 4)
+        grid: Populations, shape (R, R, 2)
+
+    Returns:
+        Derivatives, shape (R, R, 2) or (P, R, R, 2)
+    '''
+    theta = np.asarray(theta, dtype=float)
+    return dz_dt(grid, theta[..., None, None, :])
+
+
+def fixed_point(theta):
+    '''
+    Non trivial equilibrium (gamma / delta, alpha / beta), shape (..., 2)
+    '''
+    theta = np.asarray(theta, dtype=float)
+    return np.stack([theta[..., 2] / theta[..., 3], theta[..., 0] / theta[..., 1]], -1)
+
+
+def jacobian(z, theta):
+    '''
+    Jacobian of the derivatives, shape (..., 2, 2)
+    '''
+    theta = np.asarray(theta, dtype=float)
+    u, v = z[..., 0], z[..., 1]
+    alpha, beta, gamma, delta = theta[..., 0], theta[..., 1], theta[..., 2], theta[..., 3]
+    return np.stack([np.stack([alpha - beta * v, -beta * u], -1),
+                     np.stack([delta * v, -gamma + delta * u], -1)], -2)
+
+
+def period(theta):
+    '''
+    Period of small oscillations around the fixed point, 2 pi / sqrt(alpha gamma)
+    '''
+    theta = np.asarray(theta, dtype=float)
+    return 2 * np.pi / np.sqrt(theta[..., 0] * theta[..., 2])
+
+
+def parameter_grid(alpha, beta, gamma, delta):
+    '''
+    Cartesian product of the values of each parameter
+
+    Returns:
+        Parameters, shape (P, 4)
+    '''
+    return np.stack(np.meshgrid(alpha, beta, gamma, delta, indexing='ij'), -1).reshape(-1, 4)
+
+
+def starting_points(theta, fractions):
+    '''
+    Initial conditions on the segment between the origin and the fixed point
+
+    Returns:
+        Initial populations, shape (F, ..., 2)
+    '''
+    return np.asarray(fractions, dtype=float).reshape((-1,) + (1,) * np.ndim(theta)) * fixed_point(theta)
+
+
+def trajectories(z_init, theta, steps, dt=1., substeps=10):
+    '''
+    Integrate many trajectories at once, see lotka_volterra.integrate
+
+    Returns:
+        Populations, shape (steps+1, ..., 2)
+    '''
+    return integrate(z_init, theta, steps, dt, substeps)
+
+
+def summarize(zs):
+    '''
+    Minimum, maximum and mean of each population along a batch of trajectories
+
+    Args:
+        zs: Populations returned by trajectories, shape (T, ..., 2)
+    '''
+    return {'min': zs.min(0), 'max': zs.max(0), 'mean': zs.mean(0), 'extinct': (zs[-1] < 1.).any(-1)}
+
+
+def agent_trajectory(log_file, st=0, ed=None, window=10):
+    '''
+    Populations of the agent-based simulation, smoothed with a moving average
+
+    Returns:
+        Populations {prey, predator}, shape (T, 2)
+    '''
+    prey_num, predator_num = load_populations(log_file)
+    z = np.stack([prey_num, predator_num], -1)[st:ed].astype(float)
+    if window > 1 and len(z) >= window:
+        cumsum = np.cumsum(np.concatenate([np.zeros((1, 2)), z], 0), 0)
+        z = (cumsum[window:] - cumsum[:-window]) / window
+    return z
+
+
+def plot_phase_space(theta, steps=1000, dt=1., fractions=(0.3, 0.5, 0.7, 0.9), log_files=(),
+                     st=0, ed=None, window=10, resolution=25, save_path='phase_space.png'):
+    '''
+    Plot the normalised vector field, model trajectories and trajectories from log files
+
+    Args:
+        theta: Parameters {alpha, beta, gamma, delta}
+        steps: Number of time steps of the model trajectories
+        fractions: Starting points of the model trajectories as fractions of the fixed point
+        log_files: Log files whose populations are overlaid
+        window: Window of the moving average of the logged populations
+        resolution: Number of arrows along each axis
+    '''
+    theta = np.asarray(theta, dtype=float)
+    zs = trajectories(starting_points(theta, fractions), theta, steps, dt)
+    agents = [agent_trajectory(log_file, st, ed, window) for log_file in log_files]
+
+    prey_max = max([zs[..., 0].max()] + [z[:, 0].max() for z in agents]) * 1.05
+    predator_max = max([zs[..., 1].max()] + [z[:, 1].max() for z in agents]) * 1.05
+
+    grid = make_grid(prey_max, predator_max, resolution)
+    field = vector_field(theta, grid)
+    norm = np.hypot(field[..., 0], field[..., 1])
+    norm[norm == 0] = 1.
+
+    plt.figure(figsize=(12, 8))
+    sns.set_style("darkgrid")
+    plt.quiver(grid[..., 0], grid[..., 1], field[..., 0] / norm, field[..., 1] / norm, norm, pivot='mid', cmap=plt.cm.jet)
+    colors = plt.cm.autumn_r(np.linspace(0.3, 1., len(fractions)))
+    for k, color in enumerate(colors):
+        plt.plot(zs[:, k, 0], zs[:, k, 1], color=color, label='LV X0=({:.0f}, {:.0f})'.format(zs[0, k, 0], zs[0, k, 1]))
+    for log_file, z in zip(log_files, agents):
+        plt.plot(z[:, 0], z[:, 1], lw=1., label=log_file)
+    plt.xlim(0, prey_max)
+    plt.ylim(0, predator_max)
+    plt.xlabel('Number of prey agents')
+    plt.ylabel('Number of predator agents')
+    plt.legend()
+    plt.savefig(save_path)
+    plt.close()
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--theta', type=float, nargs=4, required=True, help='alpha beta gamma delta')
+    argparser.add_argument('--log_file', type=str, nargs='*', default=[], help='Log files to overlay')
+    argparser.add_argument('--steps', type=int, default=1000)
+    argparser.add_argument('--dt', type=float, default=1.)
+    argparser.add_argument('--st', type=int, default=0, help='Start time step of the logs')
+    argparser.add_argument('--ed', type=int, default=None, help='End time step of the logs')
+    argparser.add_argument('--window', type=int, default=10)
+    argparser.add_argument('--resolution', type=int, default=25)
+    argparser.add_argument('--save_path', type=str, default='phase_space.png')
+    args = argparser.parse_args()
+
+    plot_phase_space(args.theta, steps=args.steps, dt=args.dt, log_files=args.log_file, st=args.st,
+                     ed=args.ed, window=args.window, resolution=args.resolution, save_path=args.save_path)
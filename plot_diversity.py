@@ -0,0 +1,28 @@
+import os, sys
+
+import glob
+import argparse
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from utils import load_diversity_snapshot, save_diversity
+
+
+'''
+Plot the diversity snapshots (diversity/diversity_<step>.npz) of a log directory
+'''
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument('--log_dir', type=str, help='Directory of the logs')
+argparser.add_argument('--st', type=int, default=0, help='Start time step')
+argparser.add_argument('--ed', type=int, default=None, help='End time step')
+argparser.add_argument('--hexbin_above', type=int, default=2000, help='Number of agents above which densities are drawn')
+args = argparser.parse_args()
+
+fig = plt.figure(figsize=(18, 10))
+for path in sorted(glob.glob(os.path.join(args.log_dir, 'diversity', 'diversity_*.npz'))):
+    step = int(os.path.basename(path)[len('diversity_'):-len('.npz')])
+    if step < args.st or (args.ed is not None and step >= args.ed):
+        continue
+    save_diversity(load_diversity_snapshot(path), path[:-len('.npz')]+'.png', fig, args.hexbin_above)
+plt.close(fig)
@@ -0,0 +1,136 @@
+import os, sys
+
+import queue
+import atexit
+import traceback
+import multiprocessing
+
+'''
+Plots drawn by a worker process
+
+The training and test loops send the data of a plot over a queue and go on;
+a worker process draws it with the Agg backend, reusing one figure per kind
+of plot. When the worker is behind, requests for the same file are merged so
+only the latest one is drawn, and requests that do not fit in the queue are
+dropped, so plotting never stalls the simulation.
+
+plot_dynamics and plot_diversity have the signatures of the functions of
+utils and can replace them in the loops. The traits for plot_diversity are
+saved to a small .npz snapshot by the loop, the worker only receives its path.
+'''
+
+
+def _plot(kind, request, figures):
+    import matplotlib.pyplot as plt
+    import utils
+
+    if kind == 'dynamics':
+        if kind not in figures:
+            figures[kind] = plt.figure(figsize=(18, 6))
+        prey_num, predator_num = utils.load_populations(request['log_file'])
+        utils.save_dynamics(prey_num, predator_num, request['st'], request['save_path'], figures[kind])
+    elif kind == 'diversity':
+        if kind not in figures:
+            figures[kind] = plt.figure(figsize=(18, 10))
+        snapshot = request['snapshot']
+        utils.save_diversity(utils.load_diversity_snapshot(snapshot), snapshot[:-len('.npz')]+'.png', figures[kind])
+    else:
+        raise ValueError('unknown plot {}'.format(kind))
+
+
+def _plot_worker(requests):
+    import matplotlib
+    matplotlib.use('Agg')
+
+    figures = {}
+    running = True
+    while running:
+        items = [requests.get()]
+        while True:
+            try:
+                items.append(requests.get_nowait())
+            except queue.Empty:
+                break
+        # only the latest request for each file is drawn
+        latest = {}
+        for item in items:
+            if item is None:
+                running = False
+                continue
+            latest[item[0], item[1]] = item[2]
+        for (kind, _), request in latest.items():
+            try:
+                _plot(kind, request, figures)
+            except Exception:
+                traceback.print_exc()
+
+
+class PlotWorker(object):
+    '''
+    Process drawing the plots sent by submit()
+
+    Args:
+        max_pending: Number of requests waiting in the queue, newer ones are dropped
+    '''
+    def __init__(self, max_pending=8):
+        ctx = multiprocessing.get_context('spawn')
+        self.requests = ctx.Queue(maxsize=max_pending)
+        self.process = ctx.Process(target=_plot_worker, args=(self.requests,), daemon=True)
+        self.process.start()
+        self.dropped = 0
+        atexit.register(self.close)
+
+    def submit(self, kind, key, request):
+        '''
+        Args:
+            kind: 'dynamics' or 'diversity'
+            key: Output of the plot, a newer request with the same key replaces a pending one
+            request: Data of the plot
+        '''
+        if self.process is None:
+            return
+        try:
+            self.requests.put_nowait((kind, key, request))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.process is None:
+            return
+        self.requests.put(None)
+        self.process.join()
+        self.process = None
+        atexit.unregister(self.close)
+
+
+_worker = None
+
+
+def get_worker():
+    '''
+    Worker shared by the agents of the process, started on first use
+    '''
+    global _worker
+    if _worker is None:
+        _worker = PlotWorker()
+    return _worker
+
+
+def plot_dynamics(log_file, st):
+    '''
+    Plot the populations of a log to agent_num_plot.png next to it. The log
+    is read by the worker, so it should be flushed first
+    '''
+    save_path = os.path.join(os.path.dirname(log_file), 'agent_num_plot.png')
+    get_worker().submit('dynamics', save_path, {'log_file': log_file, 'st': st, 'save_path': save_path})
+
+
+def plot_diversity(predators, preys, prefix_path, step):
+    '''
+    Save the traits of the agents to a snapshot (see utils.save_diversity_snapshot)
+    and plot it to diversity_<step>.png in the worker
+    '''
+    from utils import save_diversity_snapshot
+
+    snapshot = save_diversity_snapshot(predators, preys, prefix_path, step)
+    get_worker().submit('diversity', snapshot, {'snapshot': snapshot})
@@ -0,0 +1,302 @@
+import os, sys
+
+from collections import OrderedDict
+
+import numpy as np
+
+'''
+Incremental statistics of the traits of predators and preys
+
+Traits which only change at birth (attack, resilience, speed) are tracked with
+running sums, sums of squares and histograms that are updated from the agents
+born since the previous step (ids from the previous env.max_id on) and the
+ids killed by env.remove_dead_agents(), so a step costs O(changes) instead of
+O(population). When a newborn falls outside of the range of a histogram, the
+range is widened and the histogram is rebuilt from the traits of the tracked
+agents, which is O(population) but rare. Health changes for every agent at every step: it is binned
+into a histogram from the environment arrays in one vectorized pass, without
+sorting for the quantiles.
+'''
+
+SPECIES = ['predator', 'prey']
+
+
+class TraitStats(object):
+    '''
+    Running moments and histograms of a set of traits of one species
+
+    Args:
+        ranges: Initial (low, high) of the histogram of each trait, see widen
+        bins: Number of histogram bins
+    '''
+    def __init__(self, ranges, bins=20):
+        self.low = np.array([r[0] for r in ranges], dtype=float)
+        self.high = np.array([r[1] for r in ranges], dtype=float)
+        self.bins = bins
+        # sums are taken around a shift to keep the variance accurate
+        self.shift = (self.low + self.high) / 2.
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.s1 = np.zeros(len(self.low))
+        self.s2 = np.zeros(len(self.low))
+        self.counts = np.zeros((len(self.low), self.bins), dtype=np.int64)
+
+    def bin_index(self, values):
+        index = ((values - self.low) / (self.high - self.low) * self.bins).astype(np.int64)
+        return np.clip(index, 0, self.bins-1)
+
+    def update(self, values, sign):
+        '''
+        Args:
+            values: Traits of the agents added (sign=1) or removed (sign=-1), shape (k, traits)
+        '''
+        if len(values) == 0:
+            return
+        x = values - self.shift
+        self.n += sign * len(values)
+        self.s1 += sign * x.sum(0)
+        self.s2 += sign * (x**2).sum(0)
+        index = self.bin_index(values)
+        for t in range(len(self.low)):
+            self.counts[t] += sign * np.bincount(index[:, t], minlength=self.bins)
+        if sign < 0:
+            # a negative count would make the cdf of quantile() decrease
+            np.maximum(self.counts, 0, out=self.counts)
+
+    def widen(self, low, high):
+        '''
+        Extend the ranges to [low, high] with a margin. The counts are cleared
+        and must be rebuilt with rebin()
+
+        Returns:
+            True if a range changed
+        '''
+        outside = (low < self.low) | (high > self.high)
+        if not outside.any():
+            return False
+        low = np.minimum(low, self.low)
+        high = np.maximum(high, self.high)
+        pad = np.maximum(0.25 * (high - low), 1e-3)
+        self.low = np.where(low < self.low, low - pad, self.low)
+        self.high = np.where(high > self.high, high + pad, self.high)
+        self.counts[:] = 0
+        return True
+
+    def rebin(self, values):
+        '''
+        Rebuild the histograms from the traits of every agent, shape (n, traits)
+        '''
+        index = self.bin_index(values)
+        for t in range(len(self.low)):
+            self.counts[t] = np.bincount(index[:, t], minlength=self.bins)
+
+    def mean(self):
+        if self.n == 0:
+            return np.full(len(self.low), np.nan)
+        return self.shift + self.s1 / self.n
+
+    def var(self):
+        if self.n == 0:
+            return np.full(len(self.low), np.nan)
+        return np.maximum(self.s2 / self.n - (self.s1 / self.n)**2, 0.)
+
+    def edges(self, t):
+        return np.linspace(self.low[t], self.high[t], self.bins+1)
+
+    def quantile(self, t, q):
+        '''
+        Quantile q of trait t, interpolated within the histogram bins
+        '''
+        if self.n == 0:
+            return np.nan
+        cdf = np.concatenate([[0.], np.cumsum(self.counts[t])]) / float(self.n)
+        return float(np.interp(q, cdf, self.edges(t)))
+
+
+class PopulationStats(object):
+    '''
+    Trait statistics of the predators and preys of an environment
+
+    Args:
+        traits: Traits read from the agents, which only change at birth
+        recomputed: Traits read from the environment arrays at every step (env.<species>_<trait>)
+        bins: Number of histogram bins
+        ranges: Dictionary of trait to initial (low, high). Missing ranges are
+            taken from the first population, widened by 50%. Ranges grow with
+            the values (see TraitStats.widen)
+        quantiles: Quantiles added to the records
+        refresh_every: Number of steps between full recomputations, which
+            remove the rounding errors of the running sums
+    '''
+    def __init__(self, traits=('attack', 'resilience', 'speed'), recomputed=('health',), bins=20,
+                 ranges=None, quantiles=(0.1, 0.5, 0.9), refresh_every=1000):
+        self.traits = list(traits)
+        self.recomputed = list(recomputed)
+        self.bins = bins
+        self.ranges = dict(ranges or {})
+        self.quantiles = quantiles
+        self.refresh_every = refresh_every
+        self.reset()
+
+    @classmethod
+    def from_args(cls, args):
+        '''
+        Statistics with the ranges of the traits of a config where they are
+        given: (min_<trait>, max_<trait>) and (0, max_health)
+        '''
+        ranges = {}
+        for trait in ['attack', 'resilience', 'speed', 'health']:
+            low = 0. if trait == 'health' else getattr(args, 'min_'+trait, None)
+            high = getattr(args, 'max_'+trait, None)
+            if low is not None and high is not None and high > low:
+                ranges[trait] = (float(low), float(high))
+        return cls(ranges=ranges)
+
+    def reset(self):
+        '''
+        Forget the tracked agents, e.g. after env.reset() where ids are reused
+        '''
+        self.values = {species: {} for species in SPECIES}
+        self.stats = {}
+        self.health = {}
+        self.steps = 0
+        self.last_id = None
+
+    def agent_traits(self, agent):
+        return [getattr(agent, trait) for trait in self.traits]
+
+    def make_stats(self, species, agents):
+        ranges = []
+        values = np.array([self.agent_traits(agent) for agent in agents.values()], dtype=float).reshape(-1, len(self.traits))
+        for t, trait in enumerate(self.traits):
+            if trait in self.ranges:
+                ranges.append(self.ranges[trait])
+            elif len(values) > 0:
+                low, high = values[:, t].min(), values[:, t].max()
+                pad = max(0.5 * (high - low), 1e-3)
+                ranges.append((low - pad, high + pad))
+            else:
+                ranges.append((0., 1.))
+        return TraitStats(ranges, self.bins)
+
+    def update(self, env, killed=None):
+        '''
+        Apply the births and deaths since the previous call
+
+        Args:
+            env: Environment
+            killed: Ids removed by env.remove_dead_agents() since the previous
+                call. Without them, or when the environment has no max_id, all
+                the agents are read again
+        '''
+        refresh = self.refresh_every > 0 and self.steps % self.refresh_every == 0
+        self.steps += 1
+        max_id = getattr(env, 'max_id', None)
+        incremental = not refresh and killed is not None and max_id is not None and self.last_id is not None
+        for species in SPECIES:
+            agents = env.predators if species == 'predator' else env.preys
+            known = self.values[species]
+            if species not in self.stats:
+                self.stats[species] = self.make_stats(species, agents)
+            stats = self.stats[species]
+            if not incremental:
+                known.clear()
+                stats.reset()
+                born = agents.keys()
+                dead = []
+            else:
+                # ids are given in increasing order, newborns which already died are not in agents
+                born = [id for id in range(self.last_id, max_id) if id in agents]
+                dead = [id for id in killed if id in known]
+
+            if len(born) > 0:
+                values = np.array([self.agent_traits(agents[id]) for id in born], dtype=float)
+                if stats.widen(values.min(0), values.max(0)):
+                    stats.rebin(np.array(list(known.values()), dtype=float).reshape(-1, len(self.traits)))
+                for id, value in zip(born, values.tolist()):
+                    known[id] = value
+                stats.update(values, 1)
+            if len(dead) > 0:
+                stats.update(np.array([known.pop(id) for id in dead], dtype=float), -1)
+        self.last_id = max_id
+
+    def update_recomputed(self, env):
+        '''
+        Histograms of the traits read from the environment arrays, rebuilt at every call
+        '''
+        for species in SPECIES:
+            values = np.stack([np.asarray(getattr(env, species+'_'+trait), dtype=float) for trait in self.recomputed], 1) \
+                if len(self.recomputed) > 0 else np.zeros((0, 0))
+            if species not in self.health:
+                ranges = []
+                for t, trait in enumerate(self.recomputed):
+                    if trait in self.ranges:
+                        ranges.append(self.ranges[trait])
+                    elif len(values) > 0:
+                        ranges.append((values[:, t].min(), values[:, t].max() + 1e-3))
+                    else:
+                        ranges.append((0., 1.))
+                self.health[species] = TraitStats(ranges, self.bins)
+            self.health[species].reset()
+            if len(values) > 0:
+                self.health[species].widen(values.min(0), values.max(0))
+            self.health[species].update(values, 1)
+
+    def histograms(self, env=None):
+        '''
+        Dictionary of '<species>_<trait>' to (counts, edges)
+        '''
+        histograms = {}
+        for species, stats in self.stats.items():
+            for t, trait in enumerate(self.traits):
+                histograms[species+'_'+trait] = (stats.counts[t].copy(), stats.edges(t))
+        if env is not None:
+            self.update_recomputed(env)
+        for species, stats in self.health.items():
+            for t, trait in enumerate(self.recomputed):
+                histograms[species+'_'+trait] = (stats.counts[t].copy(), stats.edges(t))
+        return histograms
+
+    def record(self, env, variance=True, killed=None):
+        '''
+        Update the statistics and return the columns of the log: averages and
+        variances (with the names used by metrics_log.trait_record), then quantiles
+
+        Args:
+            env: Environment
+            variance: Add the variances
+            killed: Ids removed by env.remove_dead_agents() at this step
+        '''
+        self.update(env, killed)
+        self.update_recomputed(env)
+        mean = {}
+        var = {}
+        quantiles = {}
+        for species in SPECIES:
+            stats = self.stats[species]
+            for t, trait in enumerate(self.traits):
+                mean[species, trait] = stats.mean()[t]
+                var[species, trait] = stats.var()[t]
+                quantiles[species, trait] = [stats.quantile(t, q) for q in self.quantiles]
+            health = self.health[species]
+            for t, trait in enumerate(self.recomputed):
+                mean[species, trait] = health.mean()[t]
+                var[species, trait] = health.var()[t]
+                quantiles[species, trait] = [health.quantile(t, q) for q in self.quantiles]
+
+        traits = self.recomputed + self.traits
+        record = OrderedDict()
+        for trait in traits:
+            for species in SPECIES:
+                record['average_{}_{}'.format(species, trait)] = float(mean[species, trait])
+        if variance:
+            for trait in traits:
+                for species in SPECIES:
+                    record['var_{}_{}'.format(species, trait)] = float(var[species, trait])
+        for trait in traits:
+            for species in SPECIES:
+                for q, value in zip(self.quantiles, quantiles[species, trait]):
+                    record['q{:02d}_{}_{}'.format(int(round(q*100)), species, trait)] = float(value)
+        return record
@@ -0,0 +1,114 @@
+import os, sys
+
+import io
+import time
+import pstats
+import cProfile
+
+'''
+Profiling of a run with cProfile and torch.profiler
+
+profile_call runs a function under both profilers and writes to an output directory:
+
+    profile.pstats   cProfile statistics (python -m pstats, snakeviz, ...)
+    trace.json       Chrome trace of torch.profiler (chrome://tracing, Perfetto)
+    stacks.txt       collapsed stacks for flamegraph.pl / speedscope
+    report.txt       top functions by cumulative and own time, and top torch operators
+'''
+
+
+def collapsed_from_pstats(stats):
+    '''
+    Collapsed stacks of caller;callee pairs weighted by own time in microseconds.
+    cProfile does not keep whole stacks, so each entry is only two frames deep
+    '''
+    def frame(func):
+        file_name, line, name = func
+        return '{}:{}:{:d}'.format(os.path.basename(file_name), name, line)
+
+    lines = []
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if len(callers) == 0:
+            weight = int(tt*1e6)
+            if weight > 0:
+                lines.append('{} {:d}'.format(frame(func), weight))
+            continue
+        for caller, value in callers.items():
+            # value is (cc, nc, tt, ct) for the calls from this caller
+            weight = int(value[2]*1e6) if isinstance(value, tuple) else int(tt*1e6/len(callers))
+            if weight > 0:
+                lines.append('{};{} {:d}'.format(frame(caller), frame(func), weight))
+    return lines
+
+
+def top_report(stats, limit=20):
+    out = io.StringIO()
+    stats.stream = out
+    out.write('Top {:d} functions by cumulative time\n'.format(limit))
+    stats.sort_stats('cumulative').print_stats(limit)
+    out.write('\nTop {:d} functions by own time\n'.format(limit))
+    stats.sort_stats('tottime').print_stats(limit)
+    return out.getvalue()
+
+
+def profile_call(fn, out_dir, use_torch=True, with_stack=True):
+    '''
+    Run fn() under cProfile and, if available, torch.profiler
+
+    Args:
+        fn: Function without arguments
+        out_dir: Directory of the outputs
+        use_torch: Also run torch.profiler (Chrome trace, operator table, stacks)
+        with_stack: Record the python stacks of the torch operators
+
+    Returns:
+        Path of the report
+    '''
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    torch_profiler = None
+    if use_torch:
+        try:
+            import torch
+            from torch.profiler import profile, ProfilerActivity
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            torch_profiler = profile(activities=activities, with_stack=with_stack)
+        except ImportError:
+            print('torch.profiler is not available, only cProfile is used')
+
+    profiler = cProfile.Profile()
+    st = time.time()
+    if torch_profiler is not None:
+        torch_profiler.__enter__()
+    profiler.enable()
+    try:
+        fn()
+    finally:
+        profiler.disable()
+        if torch_profiler is not None:
+            torch_profiler.__exit__(None, None, None)
+    elapsed = time.time() - st
+
+    pstats_file = os.path.join(out_dir, 'profile.pstats')
+    profiler.dump_stats(pstats_file)
+    stats = pstats.Stats(pstats_file)
+
+    report = ['Wall time {:.2f}s\n'.format(elapsed), top_report(stats)]
+    stacks_file = os.path.join(out_dir, 'stacks.txt')
+    if torch_profiler is not None:
+        torch_profiler.export_chrome_trace(os.path.join(out_dir, 'trace.json'))
+        report.append('\nTop 20 torch operators by own CPU time\n')
+        report.append(torch_profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=20))
+    if torch_profiler is not None and with_stack:
+        torch_profiler.export_stacks(stacks_file, 'self_cpu_time_total')
+    else:
+        with open(stacks_file, 'w') as f:
+            f.write('\n'.join(collapsed_from_pstats(stats))+'\n')
+
+    report_file = os.path.join(out_dir, 'report.txt')
+    with open(report_file, 'w') as f:
+        f.write(''.join(report))
+    return report_file
@@ -0,0 +1,169 @@
+import os, sys
+
+import queue
+import atexit
+import threading
+
+import numpy as np
+import cv2
+
+'''
+In-memory rendering of the environment to a video
+
+env.map holds the id of the agent in each cell (0 for an empty cell and a
+negative value for a wall). Each frame is turned into species codes with a
+lookup table indexed by id, then into colours with a palette lookup, and the
+frames are written to a cv2.VideoWriter by a background thread, so no image
+file is written or read again.
+'''
+
+EMPTY, WALL, PREDATOR, PREY = 0, 1, 2, 3
+
+# RGB colour of each species code
+PALETTE = np.array([[255, 255, 255],
+                    [0, 0, 0],
+                    [255, 0, 0],
+                    [0, 0, 255]], dtype=np.uint8)
+
+
+class SpeciesTable(object):
+    '''
+    Lookup table from the ids of env.map to species codes, kept between frames
+    '''
+    def __init__(self, capacity=1024):
+        self.table = np.zeros(capacity, dtype=np.uint8)
+
+    def species_map(self, env):
+        '''
+        Species code of every cell of env.map, shape (h, w)
+        '''
+        world = np.asarray(env.map)
+        predators = np.fromiter(env.predators.keys(), dtype=np.int64, count=len(env.predators))
+        preys = np.fromiter(env.preys.keys(), dtype=np.int64, count=len(env.preys))
+        top = max([int(world.max()) if world.size > 0 else 0] + [int(ids.max()) for ids in (predators, preys) if len(ids) > 0])
+        if top >= len(self.table):
+            table = np.zeros(max(top+1, 2*len(self.table)), dtype=np.uint8)
+            table[:len(self.table)] = self.table
+            self.table = table
+        # entries of dead agents are left as they are, their ids are not on the map
+        self.table[predators] = PREDATOR
+        self.table[preys] = PREY
+        self.table[0] = EMPTY
+        codes = self.table[np.maximum(world, 0)]
+        codes[world < 0] = WALL
+        return codes
+
+
+def colorize(codes, palette=PALETTE, scale=1.):
+    '''
+    RGB image of species codes, with scale pixels per cell
+
+    Args:
+        codes: Species codes, shape (h, w)
+        scale: Pixels per cell, below 1 to downscale
+    '''
+    image = palette[codes]
+    if scale != 1:
+        h, w = codes.shape
+        size = (max(int(round(w*scale)), 1), max(int(round(h*scale)), 1))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_NEAREST)
+    return image
+
+
+def render_frame(env, palette=PALETTE, scale=1., table=None):
+    '''
+    RGB image of the environment, the in-memory counterpart of env.dump_image
+    '''
+    if table is None:
+        table = SpeciesTable()
+    return colorize(table.species_map(env), palette, scale)
+
+
+class FrameRenderer(object):
+    '''
+    Renders the environment at every step and streams the frames to a video.
+
+    Only the species codes are computed in render(); colouring, resizing and
+    encoding are done by a background thread. render() blocks when more than
+    queue_size frames wait to be encoded.
+
+    Args:
+        video_path: Path of the video
+        every: Render one step out of every
+        scale: Pixels per cell, below 1 to downscale (e.g. 0.5)
+        fps: Frames per second of the video
+        format: FourCC code of the codec
+        palette: RGB colour of each species code
+        queue_size: Number of frames waiting to be encoded
+    '''
+    def __init__(self, video_path, every=1, scale=1., fps=5, format='XVID', palette=PALETTE, queue_size=16):
+        self.video_path = video_path
+        self.every = max(int(every), 1)
+        self.scale = scale
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*format)
+        # cv2 expects BGR
+        self.palette = np.ascontiguousarray(np.asarray(palette, dtype=np.uint8)[:, ::-1])
+        self.table = SpeciesTable()
+        self.steps = 0
+        self.frames = 0
+        self.closed = False
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_args(cls, video_path, args):
+        '''
+        Renderer configured by the optional video_every, video_scale and video_fps entries of a config
+        '''
+        return cls(video_path,
+                   every=getattr(args, 'video_every', 1),
+                   scale=getattr(args, 'video_scale', 1.),
+                   fps=getattr(args, 'video_fps', 5))
+
+    def render(self, env):
+        if self.closed:
+            raise ValueError('render to the closed video {}'.format(self.video_path))
+        self.steps += 1
+        if (self.steps-1) % self.every != 0:
+            return
+        self.raise_error()
+        self.queue.put(self.table.species_map(env))
+        self.frames += 1
+
+    def _run(self):
+        writer = None
+        while True:
+            codes = self.queue.get()
+            if codes is None:
+                self.queue.task_done()
+                break
+            try:
+                if self.error is None:
+                    frame = colorize(codes, self.palette, self.scale)
+                    if writer is None:
+                        writer = cv2.VideoWriter(self.video_path, self.fourcc, float(self.fps), (frame.shape[1], frame.shape[0]), True)
+                    writer.write(frame)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+        if writer is not None:
+            writer.release()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        atexit.unregister(self.close)
+        self.raise_error()
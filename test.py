@@ -18,7 +18,7 @@ from garl_gym.scenarios.simple_population_dynamics_ga import SimplePopulationDyn
 from garl_gym.scenarios.simple_population_dynamics import SimplePopulationDynamics
 from garl_gym.scenarios.complex_population_dynamics import ComplexPopulationDynamics
 from garl_gym.scenarios.genetic_population_dynamics import GeneticPopulationDynamics
-from utils import str2bool, make_video
+from utils import str2bool
 
 
 argparser = argparse.ArgumentParser()
@@ -221,13 +221,6 @@ if __name__ == '__main__':
         random(params, args.env_type, args.experiment_id, args.test_id)
     else:
         raise NotImplementedError
-
-    if args.video_flag == True:
-        img_dir = os.path.join(args.path_prefix, 'test_images', str(args.test_id))
-        st = 0
-        ed = len(os.listdir(img_dir))
-        images = [os.path.join(img_dir, '{:d}.png'.format(i+1)) for i in range(st, ed)]
-
-        make_video(images, os.path.join(img_dir, 'video.avi'))
+    # with video_flag the agents stream the frames to video.avi in the image directory
 
 
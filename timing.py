@@ -0,0 +1,136 @@
+import os, sys
+
+import time
+from collections import OrderedDict
+
+import numpy as np
+from metrics_log import format_record
+
+'''
+Per-phase timers of the training step
+
+A step is cut into phases with lap(name), which adds the time since the
+previous lap to the phase. The time of each phase is summed over a step, and
+at the end of an episode the percentiles of the per-step times are appended to
+timing.txt in the log directory (in the format of log.txt) and a summary is
+printed. A disabled timer returns at the start of every call.
+'''
+
+PERCENTILES = (50, 90, 99)
+
+
+class PhaseTimer(object):
+    '''
+    Args:
+        enabled: Time the phases, otherwise every call is a no-op
+        synchronize: Wait for the CUDA kernels at every lap, so the time of
+            asynchronous GPU work is given to the phase which launched it
+    '''
+    def __init__(self, enabled=False, synchronize=False):
+        self.enabled = enabled
+        self.sync = None
+        if enabled and synchronize:
+            import torch
+            if torch.cuda.is_available():
+                self.sync = torch.cuda.synchronize
+        self.names = []
+        self.steps = []
+        self.current = {}
+        self.last = None
+        self.history = []
+
+    @classmethod
+    def from_args(cls, args):
+        '''
+        Timer configured by the optional timing and timing_sync entries of a config
+        '''
+        return cls(getattr(args, 'timing', False), getattr(args, 'timing_sync', False))
+
+    def start(self):
+        '''
+        Start a step
+        '''
+        if not self.enabled:
+            return
+        if self.sync is not None:
+            self.sync()
+        self.current = {}
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        '''
+        Add the time since the previous lap (or the start of the step) to phase name
+        '''
+        if not self.enabled or self.last is None:
+            return
+        if self.sync is not None:
+            self.sync()
+        now = time.perf_counter()
+        self.current[name] = self.current.get(name, 0.) + now - self.last
+        self.last = now
+
+    def step_end(self):
+        if not self.enabled or self.last is None:
+            return
+        for name in self.current.keys():
+            if name not in self.names:
+                self.names.append(name)
+        self.steps.append(self.current)
+        self.current = {}
+        self.last = None
+
+    def summary(self):
+        '''
+        Mean, percentiles and maximum in milliseconds of the per-step time of each phase
+
+        Returns:
+            Dictionary of phase to dictionary of statistic to value, with the
+            whole step as 'step'
+        '''
+        if len(self.steps) == 0:
+            return OrderedDict()
+        times = np.array([[step.get(name, 0.) for name in self.names] for step in self.steps]) * 1000.
+        times = np.concatenate([times, times.sum(1, keepdims=True)], 1)
+        summary = OrderedDict()
+        for k, name in enumerate(self.names+['step']):
+            stats = OrderedDict()
+            stats['mean'] = float(times[:, k].mean())
+            for q in PERCENTILES:
+                stats['p{:d}'.format(q)] = float(np.percentile(times[:, k], q))
+            stats['max'] = float(times[:, k].max())
+            summary[name] = stats
+        return summary
+
+    def episode_end(self, episode, log_dir=None, verbose=True):
+        '''
+        Write the summary of the steps since the previous call to
+        <log_dir>/timing.txt, print it, and start a new episode. The
+        summaries are also kept in history as (episode, steps, summary)
+        '''
+        if not self.enabled:
+            return None
+        summary = self.summary()
+        if len(summary) > 0:
+            self.history.append((episode, len(self.steps), summary))
+            if log_dir is not None:
+                record = OrderedDict([('Episode', episode), ('steps', len(self.steps))])
+                for name, stats in summary.items():
+                    for stat, value in stats.items():
+                        record['{}_{}'.format(name, stat)] = value
+                with open(os.path.join(log_dir, 'timing.txt'), 'a') as f:
+                    f.write(format_record(record)+'\n')
+            if verbose:
+                print(self.format_summary(summary, episode))
+        self.steps = []
+        return summary
+
+    def format_summary(self, summary, episode):
+        total = summary['step']['mean']
+        lines = ['episode {:03d}: {:d} steps, {:.1f} ms per step'.format(episode, len(self.steps), total)]
+        lines.append('{:<20s}{:>10s}{:>10s}{:>10s}{:>10s}{:>8s}'.format('phase (ms)', 'mean', 'p50', 'p90', 'p99', 'share'))
+        for name, stats in sorted(summary.items(), key=lambda item: -item[1]['mean']):
+            if name == 'step':
+                continue
+            lines.append('{:<20s}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>7.1f}%'.format(
+                name, stats['mean'], stats['p50'], stats['p90'], stats['p99'], 100.*stats['mean']/max(total, 1e-12)))
+        return '\n'.join(lines)
@@ -14,15 +14,13 @@ from agents.random import Random
 import shutil
 import argparse
 from attrdict import AttrDict
-from garl_gym.scenarios.simple_population_dynamics_ga import SimplePopulationDynamicsGA
-from garl_gym.scenarios.simple_population_dynamics_ga_action import SimplePopulationDynamicsGAAction
-from garl_gym.scenarios.simple_population_dynamics_ga_utility import SimplePopulationDynamicsGAUtility
-from garl_gym.scenarios.simple_population_dynamics import SimplePopulationDynamics
-from garl_gym.scenarios.complex_population_dynamics import ComplexPopulationDynamics
 from utils import str2bool, make_video
+from calibration import load_targets, apply_candidate, simulate, hyperband, LotkaVolterraSurrogate
+import lotka_volterra
 from tqdm import tqdm
 import optuna
 import pandas as pd
+import multiprocessing
 
 
 argparser = argparse.ArgumentParser()
@@ -31,20 +29,19 @@ argparser.add_argument('--model_type', type=str, default=None)
 argparser.add_argument('--model_file', type=str)
 argparser.add_argument('--experiment_id', type=int)
 argparser.add_argument('--test_id', type=int)
+argparser.add_argument('--n_trials', type=int, default=100, help='Total number of trials')
+argparser.add_argument('--n_jobs', type=int, default=4, help='Number of worker processes')
+argparser.add_argument('--pruner', type=str, default='median', choices=['median', 'halving', 'none'])
+argparser.add_argument('--storage', type=str, default=None, help='Optuna storage shared by the workers (default: sqlite file in the log dir)')
+argparser.add_argument('--study_name', type=str, default=None)
+argparser.add_argument('--fresh', type=str2bool, default=False, help='Start a new study: clear the log dir (and its default study.db) and drop the study from --storage. Otherwise an interrupted study is resumed')
+argparser.add_argument('--mode', type=str, default='optuna', help='optuna or hyperband (multi-fidelity over world sizes)')
+argparser.add_argument('--fidelities', type=float, nargs='+', default=[0.125, 0.25, 0.5, 1.], help='Fractions of the full area for hyperband')
+argparser.add_argument('--eta', type=int, default=3, help='Ratio of candidates dropped per hyperband round')
+argparser.add_argument('--surrogate', type=str2bool, default=True, help='Reject candidates predicted by the Lotka-Volterra surrogate to explode or go extinct')
+argparser.add_argument('--compress_logs', type=str2bool, default=False, help='Write the population logs of the trials with gzip')
 args = argparser.parse_args()
 
-def make_env(env_type, params):
-    if env_type == 'simple_population_dynamics_ga':
-        return SimplePopulationDynamicsGA(params)
-    elif env_type == 'simple_population_dynamics':
-        return SimplePopulationDynamics(params)
-    elif env_type == 'simple_population_dynamics_ga_utility':
-        return SimplePopulationDynamicsGAUtility(params)
-    elif env_type == 'simple_population_dynamics_ga_action':
-        return SimplePopulationDynamicsGAAction(params)
-    elif env_type == 'complex_population_dynamics':
-        return ComplexPopulationDynamics(params)
-
 def load_config(path_prefix):
     if args.model_type == 'Random':
         f = open('configs/random_config.yaml', 'r')
@@ -54,107 +51,111 @@ def load_config(path_prefix):
 
     return AttrDict(params)
 
-global_predator_mse_list = []
-global_prey_mse_list = []
-df = pd.read_csv('./data/hare_lynx_data.csv')
-
-hare = np.array(df['Hare'])*100
-lynx = np.array(df['Lynx'])*100
+hare, lynx = load_targets('./data/hare_lynx_data.csv')
 
 params = load_config(args.path_prefix)
 params.predator_num = 3000
 params.prey_num = 2000
+params.test_id = args.test_id
+params.experiment_id = args.experiment_id
+params.predator_capacity = 25000
+params.prey_capacity = 25000
+params.cpu_cores = 4
+params.batch_size = 1024
+params.multiprocessing = True
 
 log_dir = os.path.join('results', params.env_type, 'exp_{:d}'.format(args.experiment_id), 'test_logs', str(args.test_id))
 
-try:
-    os.makedirs(log_dir)
-except:
+if args.fresh and os.path.exists(log_dir):
     shutil.rmtree(log_dir)
+if not os.path.exists(log_dir):
     os.makedirs(log_dir)
 
 
 
-q_net = torch.load(args.model_file).cuda()
+# Loaded once in the parent on the cpu. The forked workers share it copy-on-write
+# and only move it to the gpu themselves (cuda must not be initialised before fork).
+q_net = torch.load(args.model_file, map_location='cpu')
+
+def make_pruner(name):
+    if name == 'median':
+        return optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=2)
+    elif name == 'halving':
+        return optuna.pruners.SuccessiveHalvingPruner()
+    elif name == 'none':
+        return optuna.pruners.NopPruner()
+    raise ValueError('unknown pruner {}'.format(name))
+
 def objective(trial):
-    predator_mse_list = []
-    prey_mse_list = []
     points = 25
     #T = trial.suggest_discrete_uniform('timestep', 300, 550, 50)
-    T = trial.suggest_discrete_uniform('timestep', 300, 600, 50)
-    predator_increase_rate = trial.suggest_uniform('predator_increase_rate', 0.001, 0.02)
-    prey_increase_rate = trial.suggest_uniform('prey_increase_rate', 0.001, 0.02)
-    health_increase_rate = trial.suggest_int('predator_health_increase_rate', 1, 4)
-    height = trial.suggest_discrete_uniform('height', 500, 1000, 100)
-    width = height
-    params.predator_increase_prob = predator_increase_rate
-    params.prey_increase_prob = prey_increase_rate
-    params.width = int(width)
-    params.height = int(height)
-    params.test_id = args.test_id
-    params.experiment_id = args.experiment_id
-    params.health_increase_rate = health_increase_rate
-    params.predator_capacity = 25000
-    params.prey_capacity = 25000
-    params.cpu_cores = 4
-    params.batch_size = 1024
-    params.multiprocessing = True
-
-    env = make_env(params.env_type, params)
-    env.make_world(wall_prob=params.wall_prob, food_prob=0)
-
-    agent = DRQN(params,
-                env,
-                q_net,
-                nn.MSELoss(),
-                optim.RMSprop)
-
-    step = 0
-    env.reset()
-    bar = tqdm(range(int(points*T)))
-    total_predator_mse = 0
-    total_prey_mse = 0
-
-    point = 0
-
-    log = open(os.path.join(log_dir, 'log_trial_{}.txt'.format(str(trial.number))), 'w')
-
-    for t in range(int(points*T)):
-        agent.one_iteration(t)
-
-        if (t+1)%T == 0:
-            predator_num = agent.env.predator_num
-            prey_num = agent.env.prey_num
-            target_predator_num = lynx[point]
-            target_prey_num = hare[point]
-
-            predator_mse = np.mean((predator_num-target_predator_num)**2)
-            prey_mse = np.mean((prey_num-target_prey_num)**2)
-            total_predator_mse += predator_mse
-            total_prey_mse += prey_mse
-            predator_mse_list.append(predator_mse)
-            prey_mse_list.append(prey_mse)
-            point += 1
-        info = "Step\t{:03d}\tnum_agents\t{:d}\tnum_preys\t{:d}\tnum_predators\t{:d}\tincrease_predators\t{:d}\tincrease_preys\t{:d}".format(t, len(env.agents), len(env.preys), len(env.predators), env.increase_predators, env.increase_preys)
-        log.write(info+'\n')
-        log.flush()
-        bar.update(1)
-
-        if len(agent.env.predators) > 16000 or len(agent.env.preys) > 16000:
-            total_predator_mse = np.inf
-            total_prey_mse = np.inf
-            break
-
-    print('predator_mse: {} prey_mse: {}'.format(total_predator_mse, total_prey_mse))
-    error = total_predator_mse/points+total_prey_mse/points
-
-    log.close()
-    bar.update(0)
-    bar.refresh()
-    bar.close()
+    candidate = {'timestep': trial.suggest_discrete_uniform('timestep', 300, 600, 50),
+                 'predator_increase_rate': trial.suggest_uniform('predator_increase_rate', 0.001, 0.02),
+                 'prey_increase_rate': trial.suggest_uniform('prey_increase_rate', 0.001, 0.02),
+                 'predator_health_increase_rate': trial.suggest_int('predator_health_increase_rate', 1, 4),
+                 'height': trial.suggest_discrete_uniform('height', 500, 1000, 100)}
+
+    if args.surrogate:
+        # refit on the trials completed by every worker of the shared study
+        surrogate = LotkaVolterraSurrogate()
+        for t in trial.study.trials:
+            if 'lv_theta' in t.user_attrs:
+                surrogate.add_theta(t.params, np.array(t.user_attrs['lv_theta']))
+        if not surrogate.screen(candidate, [params.prey_num, params.predator_num], points*candidate['timestep']):
+            trial.set_user_attr('surrogate_rejected', True)
+            raise optuna.exceptions.TrialPruned()
+
+    def report(error, point):
+        trial.report(error, point)
+        if trial.should_prune():
+            raise optuna.exceptions.TrialPruned()
+
+    log_file = os.path.join(log_dir, 'log_trial_{}.txt'.format(str(trial.number)))
+    if args.compress_logs:
+        log_file += '.gz'
+    error, cost, (prey_num, predator_num) = simulate(apply_candidate(params, candidate), q_net, (hare, lynx), int(candidate['timestep']), points=points, log_file=log_file, report=report)
+    theta = lotka_volterra.fit_regression(prey_num, predator_num)
+    if theta is not None:
+        trial.set_user_attr('lv_theta', theta.tolist())
+    print('error: {} seconds: {:.1f}'.format(error, cost['seconds']))
     return error
 
 
-
-study = optuna.create_study()
-study.optimize(objective, n_trials=100)
+def worker(study_name, storage, n_trials):
+    if torch.cuda.is_available():
+        q_net.cuda()
+    study = optuna.load_study(study_name=study_name, storage=storage, pruner=make_pruner(args.pruner))
+    study.optimize(objective, n_trials=n_trials)
+
+
+if __name__ == '__main__' and args.mode == 'hyperband':
+    if torch.cuda.is_available():
+        q_net.cuda()
+    surrogate = LotkaVolterraSurrogate() if args.surrogate else None
+    best, best_error = hyperband(params, q_net, (hare, lynx), log_dir, fidelities=args.fidelities, eta=args.eta, surrogate=surrogate)
+    print('best params: {} error: {}'.format(best, best_error))
+elif __name__ == '__main__':
+    storage = args.storage
+    if storage is None:
+        storage = 'sqlite:///' + os.path.abspath(os.path.join(log_dir, 'study.db'))
+    study_name = args.study_name
+    if study_name is None:
+        study_name = 'exp_{:d}_test_{:d}'.format(args.experiment_id, args.test_id)
+    if args.fresh and args.storage is not None:
+        try:
+            optuna.delete_study(study_name=study_name, storage=storage)
+        except KeyError:
+            pass
+    optuna.create_study(study_name=study_name, storage=storage, pruner=make_pruner(args.pruner), load_if_exists=True)
+
+    n_jobs = max(1, args.n_jobs)
+    trials = [args.n_trials // n_jobs + (1 if i < args.n_trials % n_jobs else 0) for i in range(n_jobs)]
+    ctx = multiprocessing.get_context('fork')
+    processes = [ctx.Process(target=worker, args=(study_name, storage, n)) for n in trials if n > 0]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    study = optuna.load_study(study_name=study_name, storage=storage)
+    print('best params: {} error: {}'.format(study.best_params, study.best_value))
@@ -4,28 +4,20 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import argparse
+from operator import attrgetter
 from cv2 import imread, VideoWriter, resize
 import cv2
 import shutil
+from metrics_log import load_metrics
 
 def plot_cumulative_variation(log_file, st=0, ed=None):
-    random_predators = []
-    trained_predators = []
-    training_predators = []
-
-    random_preys = []
-    trained_preys = []
-    training_preys = []
-
-    with open(log_file) as f:
-        for line in f:
-            line = line.split()
-            random_preys.append(int(line[7]))
-            trained_preys.append(int(line[9]))
-            training_preys.append(int(line[11]))
-            random_predators.append(int(line[13]))
-            trained_predators.append(int(line[15]))
-            training_predators.append(int(line[17]))
+    metrics = load_metrics(log_file)
+    random_preys = metrics['num_random_preys']
+    trained_preys = metrics['num_trained_preys']
+    training_preys = metrics['num_training_preys']
+    random_predators = metrics['num_random_predators']
+    trained_predators = metrics['num_trained_predators']
+    training_predators = metrics['num_training_predators']
 
     if ed is None:
         ed = len(random_predators)
@@ -59,32 +51,17 @@ def plot_cumulative_variation(log_file, st=0, ed=None):
     axs[2].legend(['Predators', 'Preys'])
     axs[2].set_xlabel('Timestep')
     axs[2].set_ylabel('Number of Agents')
-    plt.show()
 
-    plt.savefig(os.path.join(os.path.dirname(log_file),'variation.png'))
+    fig.savefig(os.path.join(os.path.dirname(log_file),'variation.png'))
+    plt.close(fig)
 
 def plot_parameter_var(log_file, st=0):
-    prey = {'health': [], 'attack': [], 'resilience': [], 'speed': []}
-    predator = {'health': [], 'attack': [], 'resilience': [], 'speed': []}
-    with open(log_file)as fin:
-        for line in fin:
-            line = line.split()
-            #if len(line) == 12:
-            #    prey_num.append(int(line[9]))
-            #    predator_num.append(int(line[11]))
-            #elif len(line) == 10:
-            predator['health'].append(float(line[33]))
-            prey['health'].append(float(line[35]))
-            predator['attack'].append(float(line[37]))
-            prey['attack'].append(float(line[39]))
-            predator['resilience'].append(float(line[41]))
-            prey['resilience'].append(float(line[43]))
-            predator['speed'].append(float(line[45]))
-            prey['speed'].append(float(line[47]))
-
-            #elif len(line) == 14:
-            #    prey_num.append(int(line[9]))
-            #    predator_num.append(int(line[11]))
+    metrics = load_metrics(log_file)
+    prey = {}
+    predator = {}
+    for trait in ['health', 'attack', 'resilience', 'speed']:
+        predator[trait] = metrics['var_predator_'+trait]
+        prey[trait] = metrics['var_prey_'+trait]
     ed = len(prey['health'])
 
     x = range(st, ed)
@@ -101,32 +78,17 @@ def plot_parameter_var(log_file, st=0):
     plt.legend(['Predator Attack', 'Prey Attack', 'Predator Resilience', 'Prey Resilience', 'Predator Speed', 'Prey Speed'])
     plt.xlabel('Timestep')
     plt.ylabel('Values')
-    plt.show()
     plt.savefig(os.path.join(os.path.dirname(log_file),'agent_parameter_variance.png'))
+    plt.close()
 
 def plot_parameter(log_file, st=0):
-    prey = {'health': [], 'attack': [], 'resilience': [], 'speed': []}
-    predator = {'health': [], 'attack': [], 'resilience': [], 'speed': []}
-    with open(log_file)as fin:
-        for line in fin:
-            line = line.split()
-            #if len(line) == 12:
-            #    prey_num.append(int(line[9]))
-            #    predator_num.append(int(line[11]))
-            #elif len(line) == 10:
-            predator['health'].append(float(line[17]))
-            prey['health'].append(float(line[19]))
-            predator['attack'].append(float(line[21]))
-            prey['attack'].append(float(line[23]))
-            predator['resilience'].append(float(line[25]))
-            prey['resilience'].append(float(line[27]))
-            if len(line) > 28:
-                predator['speed'].append(float(line[29]))
-                prey['speed'].append(float(line[31]))
-
-            #elif len(line) == 14:
-            #    prey_num.append(int(line[9]))
-            #    predator_num.append(int(line[11]))
+    metrics = load_metrics(log_file)
+    prey = {}
+    predator = {}
+    for trait in ['health', 'attack', 'resilience', 'speed']:
+        predator[trait] = metrics.get('average_predator_'+trait, [])
+        prey[trait] = metrics.get('average_prey_'+trait, [])
+    has_speed = len(predator['speed']) > 0
     ed = len(prey['health'])
 
     x = range(st, ed)
@@ -138,7 +100,7 @@ def plot_parameter(log_file, st=0):
     plt.plot(x, prey['attack'][st:ed])
     plt.plot(x, predator['resilience'][st:ed])
     plt.plot(x, prey['resilience'][st:ed])
-    if len(line) > 28:
+    if has_speed:
         plt.plot(x, predator['speed'][st:ed])
         plt.plot(x, prey['speed'][st:ed])
         plt.legend(['Predator Attack', 'Prey Attack', 'Predator Resilience', 'Prey Resilience', 'Predator Speed', 'Prey Speed'])
@@ -148,143 +110,149 @@ def plot_parameter(log_file, st=0):
         plt.legend(['Predator Attack', 'Prey Attack', 'Predator Resilience', 'Prey Resilience'])
     plt.xlabel('Timestep')
     plt.ylabel('Values')
-    plt.show()
     plt.savefig(os.path.join(os.path.dirname(log_file),'agent_parameter.png'))
+    plt.close()
 
 
-def plot_diversity(predators, preys, prefix_path, step):
-    predator_liking_list = []
-    predator_physical_list = []
-    predator_environmental_condition_list = []
-    prey_liking_list = []
-    prey_physical_list = []
-    prey_environmental_condition_list = []
-
-    dir_name = os.path.join(prefix_path, 'diversity', str(step))
-
-    try:
-        os.makedirs(dir_name)
-    except:
-        shutil.rmtree(dir_name)
-        os.makedirs(dir_name)
-
-    for predator in predators:
-        predator_liking_list.append(predator.liking)
-        predator_physical_list.append(predator.physical)
-        predator_environmental_condition_list.append(predator.environmental_condition)
+DIVERSITY_TRAITS = ['liking', 'physical', 'environmental_condition']
 
-    plt.figure()
-    sns.set_style("darkgrid")
-    plt.scatter(predator_liking_list, predator_physical_list)
-    plt.xlabel('Liking')
-    plt.ylabel('Physical')
-    plt.show()
-    plt.savefig(os.path.join(dir_name, 'predator_diversity_like_vs_physical.png'))
+DIVERSITY_LABELS = {'liking': 'Liking', 'physical': 'Physical', 'environmental_condition': 'Environmental Condition'}
 
-    plt.figure()
-    sns.set_style("darkgrid")
-    plt.scatter(predator_liking_list, predator_environmental_condition_list)
-    plt.xlabel('Liking')
-    plt.ylabel('Environmental Condition')
-    plt.show()
-    plt.savefig(os.path.join(dir_name, 'predator_diversity_like_vs_environmental.png'))
+DIVERSITY_PLOTS = [('liking', 'physical'), ('liking', 'environmental_condition'), ('environmental_condition', 'physical')]
 
-    sns.set_style("darkgrid")
-    plt.figure()
-    plt.scatter(predator_environmental_condition_list, predator_physical_list)
-    plt.xlabel('Environmental Condition')
-    plt.ylabel('Physical')
-    plt.show()
-    plt.savefig(os.path.join(dir_name, 'predator_diversity_environmental_vs_physical.png'))
 
-    for prey in preys:
-        prey_liking_list.append(prey.liking)
-        prey_physical_list.append(prey.physical)
-        prey_environmental_condition_list.append(prey.environmental_condition)
+def diversity_data(predators, preys):
+    '''
+    Traits of the agents as arrays of shape (n, 3), {'predator': ..., 'prey': ...},
+    with the columns in the order of DIVERSITY_TRAITS
+    '''
+    getter = attrgetter(*DIVERSITY_TRAITS)
+    data = {}
+    for species, agents in [('predator', predators), ('prey', preys)]:
+        data[species] = np.array(list(map(getter, agents)), dtype=float).reshape(-1, len(DIVERSITY_TRAITS))
+    return data
 
-    plt.figure()
-    sns.set_style("darkgrid")
-    plt.scatter(prey_liking_list, prey_physical_list)
-    plt.xlabel('Liking')
-    plt.ylabel('Physical')
-    plt.show()
-    plt.savefig(os.path.join(dir_name, 'prey_diversity_like_vs_physical.png'))
 
-    plt.figure()
-    sns.set_style("darkgrid")
-    plt.scatter(prey_liking_list, prey_environmental_condition_list)
-    plt.xlabel('Liking')
-    plt.ylabel('Environmental Condition')
-    plt.show()
-    plt.savefig(os.path.join(dir_name, 'prey_diversity_like_vs_environmental.png'))
+def diversity_file(prefix_path, step):
+    return os.path.join(prefix_path, 'diversity', 'diversity_{:06d}.npz'.format(step))
 
-    plt.figure()
+
+def save_diversity_snapshot(predators, preys, prefix_path, step):
+    '''
+    Save the traits of the agents to diversity/diversity_<step>.npz
+
+    Returns:
+        Path of the snapshot
+    '''
+    path = diversity_file(prefix_path, step)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    np.savez(path, step=step, **diversity_data(predators, preys))
+    return path
+
+
+def load_diversity_snapshot(path):
+    with np.load(path) as f:
+        return {'predator': f['predator'], 'prey': f['prey']}
+
+
+def save_diversity(data, save_path, fig=None, hexbin_above=2000):
+    '''
+    One figure with a panel per pair of traits (columns) and species (rows).
+    Populations larger than hexbin_above are drawn as hexbin densities
+
+    Args:
+        data: Traits returned by diversity_data
+        fig: Figure to clear and reuse
+    '''
+    own = fig is None
+    if own:
+        fig = plt.figure(figsize=(18, 10))
+    fig.clf()
     sns.set_style("darkgrid")
-    plt.scatter(prey_environmental_condition_list, prey_physical_list)
-    plt.xlabel('Environmental Condition')
-    plt.ylabel('Physical')
-    plt.show()
-    plt.savefig(os.path.join(dir_name, 'prey_diversity_environmental_vs_physical.png'))
+    axs = fig.subplots(2, len(DIVERSITY_PLOTS))
+    for row, species in enumerate(['predator', 'prey']):
+        values = data[species]
+        for col, (x, y) in enumerate(DIVERSITY_PLOTS):
+            ax = axs[row, col]
+            vx = values[:, DIVERSITY_TRAITS.index(x)]
+            vy = values[:, DIVERSITY_TRAITS.index(y)]
+            if len(values) > hexbin_above:
+                ax.hexbin(vx, vy, gridsize=40, mincnt=1, cmap='viridis')
+            else:
+                ax.scatter(vx, vy, s=4)
+            ax.set_xlabel(DIVERSITY_LABELS[x])
+            ax.set_ylabel(DIVERSITY_LABELS[y])
+            ax.set_title('{} ({:d})'.format(species.capitalize(), len(values)))
+    fig.tight_layout()
+    fig.savefig(save_path)
+    if own:
+        plt.close(fig)
 
 
-def plot_dynamics(log_file, st):
-    prey_num = []
-    predator_num = []
-    with open(log_file)as fin:
-        for line in fin:
-            line = line.split()
-            #if len(line) == 12:
-            #    prey_num.append(int(line[9]))
-            #    predator_num.append(int(line[11]))
-            #elif len(line) == 10:
-            prey_num.append(int(line[7]))
-            predator_num.append(int(line[9]))
-            #elif len(line) == 14:
-            #    prey_num.append(int(line[9]))
-            #    predator_num.append(int(line[11]))
+def plot_diversity(predators, preys, prefix_path, step):
+    path = save_diversity_snapshot(predators, preys, prefix_path, step)
+    save_diversity(load_diversity_snapshot(path), path[:-len('.npz')]+'.png')
+
+
+def load_populations(log_file):
+    '''
+    Read the number of preys and predators at every step of a log file
+
+    Returns:
+        prey_num, predator_num as numpy arrays
+    '''
+    metrics = load_metrics(log_file)
+    prey_num = metrics.get('num_preys', [])
+    predator_num = metrics.get('num_predators', [])
+    return np.array(prey_num), np.array(predator_num)
+
+def save_dynamics(prey_num, predator_num, st, save_path, fig=None):
+    '''
+    Plot the number of predators and preys from step st. The figure is
+    cleared and reused if given
+    '''
+    own = fig is None
+    if own:
+        fig = plt.figure(figsize=(18, 6))
+    fig.clf()
+    ax = fig.add_subplot(111)
     ed = len(predator_num)
 
     x = range(len(prey_num))
-    plt.figure(figsize=(18, 6))
     sns.set_style("darkgrid")
-    plt.plot(x[st:ed], predator_num[st:ed])
-    plt.plot(x[st:ed], prey_num[st:ed])
-    plt.legend(['Predators', 'Preys'])
-    plt.xlabel('Timestep')
-    plt.ylabel('Number of Agents')
-    plt.show()
-
-    plt.savefig(os.path.join(os.path.dirname(log_file),'agent_num_plot.png'))
+    ax.plot(x[st:ed], predator_num[st:ed])
+    ax.plot(x[st:ed], prey_num[st:ed])
+    ax.legend(['Predators', 'Preys'])
+    ax.set_xlabel('Timestep')
+    ax.set_ylabel('Number of Agents')
 
-def plot_circle(log_file, st):
-    prey_num = []
-    predator_num = []
-    with open(log_file)as fin:
-        for line in fin:
-            line = line.split()
-            prey_num.append(int(line[7]))
-            predator_num.append(int(line[9]))
-
-    predator_num = predator_num[st:]
-    prey_num = prey_num[st:]
-    ed = len(predator_num)
-    x = range(len(predator_num))
-    length = len(predator_num)
+    fig.savefig(save_path)
+    if own:
+        plt.close(fig)
 
-    predator_num_avg = []
-    prey_num_avg = []
+def plot_dynamics(log_file, st):
+    prey_num, predator_num = load_populations(log_file)
+    save_dynamics(prey_num, predator_num, st, os.path.join(os.path.dirname(log_file),'agent_num_plot.png'))
+
+def window_average(values, window):
+    '''
+    Averages over consecutive windows of values. The last window may be
+    shorter and, as in the original loop of plot_circle, its sum is still
+    divided by window
+    '''
+    values = np.asarray(values, dtype=float)
+    n = len(values) // window * window
+    averages = values[:n].reshape(-1, window).mean(1)
+    if n < len(values):
+        averages = np.append(averages, values[n:].sum() / window)
+    return averages
 
-    for i in range(0, length, 10):
-        predator_tot = 0
-        prey_tot = 0
-        for j in range(i, min(i + 10, len(x))):
-            predator_tot += predator_num[j]
-            prey_tot += prey_num[j]
+def plot_circle(log_file, st):
+    prey_num, predator_num = load_populations(log_file)
 
-        predator_tot = 1. * predator_tot / 10.
-        prey_tot = 1. * prey_tot / 10.
-        predator_num_avg.append(predator_tot)
-        prey_num_avg.append(prey_tot)
+    predator_num_avg = window_average(predator_num[st:], 10)
+    prey_num_avg = window_average(prey_num[st:], 10)
 
     plt.figure(figsize=(8, 6))
     sns.set_style("darkgrid")
@@ -295,6 +263,7 @@ def plot_circle(log_file, st):
  #   plt.legend(['predator number', 'prey number'], loc='upper left')
     plt.grid()
     plt.savefig(os.path.join(os.path.dirname(log_file),'circle.png'))
+    plt.close()
 
 def str2bool(v):
     if isinstance(v, bool):
@@ -0,0 +1,347 @@
+import os, sys
+
+import atexit
+import queue
+import random
+import threading
+from copy import deepcopy
+
+import numpy as np
+
+'''
+Compact world-state snapshots
+
+The world (map and other array attributes of the environment, its scalar
+counters and every agent) is stored as flat column arrays: one array per agent
+attribute and species. Snapshots can be kept in memory or written to a
+compressed .npz file, and loaded back into an existing environment in place of
+env.reset().
+
+Everything which is not an array is kept in the 'meta' entry, a pickled object
+array: scalar counters, the other containers of the environment and a
+template per species, with the class of the agents and a copy of their
+attributes that are not stored as columns, taken with the snapshot. Snapshot
+files are therefore loaded
+with allow_pickle=True and must only be read from trusted sources.
+'''
+
+SPECIES = ['predator', 'prey']
+
+
+def _is_scalar(value):
+    return isinstance(value, (bool, int, float, np.number, np.bool_))
+
+
+def _numeric_list(value):
+    if not isinstance(value, list):
+        return None
+    array = np.asarray(value)
+    if array.ndim == 1 and array.dtype.kind in 'biuf':
+        return array
+    return None
+
+
+# rebuilt from the agent columns
+AGENT_DICTS = ['agents', 'predators', 'preys']
+
+
+def _is_container(value):
+    return isinstance(value, (dict, list, set, tuple))
+
+
+def _species_agents(env, species):
+    if species == 'predator':
+        return env.predators
+    return env.preys
+
+
+def agents_to_columns(agents, prefix):
+    '''
+    Convert a dict of agents into column arrays
+
+    Args:
+        agents: Dictionary of id to agent
+        prefix: Prefix of the column names
+
+    Returns:
+        The columns and the template of the agents: their class, the types of
+        the vector columns and a copy of the attributes of the first agent
+        which are not stored as columns, or None if there are no agents
+    '''
+    columns = {}
+    ids = np.fromiter(agents.keys(), dtype=np.int64, count=len(agents))
+    columns[prefix+'/id'] = ids
+    if len(agents) == 0:
+        return columns, None
+
+    values = list(agents.values())
+    first = values[0]
+    # copied now, the agents keep changing after the snapshot
+    template = {'class': type(first), 'attrs': {}, 'vec_types': {}}
+    for name, value in vars(first).items():
+        if _is_scalar(value):
+            columns[prefix+'/attr/'+name] = np.array([getattr(agent, name) for agent in values])
+        elif isinstance(value, (tuple, list, np.ndarray)) and np.asarray(value).dtype.kind in 'biuf' and np.asarray(value).ndim == 1:
+            # positions and other small fixed length vectors
+            columns[prefix+'/vec/'+name] = np.array([getattr(agent, name) for agent in values])
+            template['vec_types'][name] = type(value).__name__
+        else:
+            template['attrs'][name] = deepcopy(value)
+    return columns, template
+
+
+def world_to_columns(env):
+    '''
+    Snapshot of the world as a dictionary of numpy arrays
+    '''
+    columns = {}
+    scalars = {}
+    lists = []
+    objects = {}
+    for name, value in vars(env).items():
+        if name in AGENT_DICTS:
+            continue
+        if isinstance(value, np.ndarray):
+            columns['env/'+name] = value.copy()
+        elif _is_scalar(value) or value is None or isinstance(value, str):
+            scalars[name] = value
+        else:
+            array = _numeric_list(value)
+            if array is not None:
+                columns['env/'+name] = array
+                lists.append(name)
+            elif _is_container(value):
+                objects[name] = deepcopy(value)
+
+    templates = {}
+    for species in SPECIES:
+        agent_columns, template = agents_to_columns(_species_agents(env, species), species)
+        columns.update(agent_columns)
+        if template is not None:
+            templates[species] = template
+
+    meta = np.empty((), dtype=object)
+    meta[()] = {'scalars': scalars,
+                'lists': lists,
+                'objects': objects,
+                'templates': templates}
+    columns['meta'] = meta
+    return columns
+
+
+def columns_to_world(env, columns):
+    '''
+    Load a snapshot created by world_to_columns into env in place
+
+    Containers of env (dicts, lists, sets, tuples) are replaced by the ones of
+    the snapshot, and emptied if the snapshot has none, so no value of the
+    current world is left behind.
+    '''
+    meta = np.asarray(columns['meta']).item()
+    for name, value in meta['scalars'].items():
+        setattr(env, name, value)
+    for name, value in list(vars(env).items()):
+        if name not in AGENT_DICTS and name not in meta['lists'] and _is_container(value):
+            # a snapshot is restored many times, its containers must not be shared with env
+            setattr(env, name, deepcopy(meta['objects'][name]) if name in meta['objects'] else type(value)())
+    for name, value in meta['objects'].items():
+        if name not in vars(env):
+            setattr(env, name, deepcopy(value))
+
+    for key in columns.keys():
+        if key.startswith('env/'):
+            name = key[len('env/'):]
+            if name in meta['lists']:
+                setattr(env, name, np.asarray(columns[key]).tolist())
+            else:
+                setattr(env, name, np.array(columns[key]))
+
+    env.agents = {}
+    for species in SPECIES:
+        agents = {}
+        ids = np.asarray(columns[species+'/id'])
+        template = meta['templates'].get(species)
+        if template is not None and len(ids) > 0:
+            attrs = [(key.split('/')[-1], np.asarray(columns[key]).tolist()) for key in columns.keys() if key.startswith(species+'/attr/')]
+            vecs = [(key.split('/')[-1], np.asarray(columns[key])) for key in columns.keys() if key.startswith(species+'/vec/')]
+            agent_class = template['class']
+            # attributes which are not stored as columns come from the template and must not be shared
+            mutable = [name for name, value in template['attrs'].items() if isinstance(value, (dict, set, list, np.ndarray))]
+            for n, id in enumerate(ids.tolist()):
+                agent = agent_class.__new__(agent_class)
+                agent.__dict__.update(template['attrs'])
+                for name in mutable:
+                    setattr(agent, name, deepcopy(template['attrs'][name]))
+                for name, values in attrs:
+                    setattr(agent, name, values[n])
+                for name, values in vecs:
+                    vec_type = template['vec_types'].get(name)
+                    if vec_type == 'tuple':
+                        setattr(agent, name, tuple(values[n].tolist()))
+                    elif vec_type == 'list':
+                        setattr(agent, name, values[n].tolist())
+                    else:
+                        setattr(agent, name, values[n].copy())
+                agents[id] = agent
+        if species == 'predator':
+            env.predators = agents
+        else:
+            env.preys = agents
+        env.agents.update(agents)
+    return env
+
+
+def write_columns(columns, path):
+    '''
+    Write the columns of a world to a compressed .npz file
+    '''
+    with open(path+'.tmp', 'wb') as f:
+        np.savez_compressed(f, **columns)
+    os.replace(path+'.tmp', path)
+
+
+def read_columns(path):
+    '''
+    Columns of a world written by write_columns. The meta entry is a pickle
+    '''
+    with np.load(path, allow_pickle=True) as f:
+        return {key: f[key] for key in f.files}
+
+
+def save_world(env, path):
+    '''
+    Write the world of env to a compressed .npz file
+    '''
+    write_columns(world_to_columns(env), path)
+
+
+def load_world(env, path):
+    '''
+    Load a world written by save_world into env. The file is unpickled, see the module docstring
+    '''
+    return columns_to_world(env, read_columns(path))
+
+
+def population(env):
+    return len(env.predators), len(env.preys)
+
+
+class HealthyStatePool(object):
+    '''
+    Pool of snapshots of worlds whose populations are within bounds.
+
+    Training restarts from one of these snapshots instead of a cold
+    env.reset(), so the unstable burn-in phase is skipped. The snapshot is
+    taken on the caller thread and, with a pool_dir, written to disk by a
+    background thread.
+
+    Args:
+        size: Maximum number of snapshots kept in the pool
+        min_agents: Minimum number of predators and preys of a healthy world
+        max_ratio: A healthy world has less than max_ratio * capacity agents
+        pool_dir: If set, snapshots are also written to this directory as .npz
+    '''
+    def __init__(self, size=8, min_agents=100, max_ratio=0.8, pool_dir=None):
+        self.size = size
+        self.min_agents = min_agents
+        self.max_ratio = max_ratio
+        self.pool_dir = pool_dir
+        self.states = []
+        self.count = 0
+        self.closed = False
+        self.error = None
+
+        if pool_dir is not None:
+            if not os.path.exists(pool_dir):
+                os.makedirs(pool_dir)
+            for file_name in sorted(os.listdir(pool_dir)):
+                if file_name.endswith('.npz') and len(self.states) < size:
+                    self.states.append(read_columns(os.path.join(pool_dir, file_name)))
+            self.count = len(self.states)
+
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    @classmethod
+    def from_args(cls, args, pool_dir=None):
+        '''
+        Pool configured by the optional state_pool_size, state_pool_min_agents
+        and state_pool_max_ratio entries of a config
+        '''
+        return cls(getattr(args, 'state_pool_size', 8),
+                   min_agents=getattr(args, 'state_pool_min_agents', 100),
+                   max_ratio=getattr(args, 'state_pool_max_ratio', 0.8),
+                   pool_dir=pool_dir)
+
+    def __len__(self):
+        return len(self.states)
+
+    def is_healthy(self, env, predator_capacity, prey_capacity):
+        num_predators, num_preys = population(env)
+        return (self.min_agents <= num_predators < self.max_ratio * predator_capacity and
+                self.min_agents <= num_preys < self.max_ratio * prey_capacity)
+
+    def add(self, env):
+        columns = world_to_columns(env)
+        slot = self.count % self.size
+        if len(self.states) < self.size:
+            self.states.append(columns)
+        else:
+            self.states[slot] = columns
+        if self.pool_dir is not None:
+            self.raise_error()
+            # the columns are not modified once taken, the writer reads them as they are
+            self.queue.put((columns, os.path.join(self.pool_dir, 'state_{:d}.npz'.format(slot))))
+        self.count += 1
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            try:
+                write_columns(*job)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def wait(self):
+        '''
+        Wait until every snapshot is written
+        '''
+        if self.pool_dir is not None:
+            self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.pool_dir is not None:
+            self.queue.put(None)
+            self.thread.join()
+            atexit.unregister(self.close)
+        self.raise_error()
+
+    def maybe_add(self, env, predator_capacity, prey_capacity):
+        if self.is_healthy(env, predator_capacity, prey_capacity):
+            self.add(env)
+            return True
+        return False
+
+    def restore(self, env):
+        '''
+        Load a random healthy snapshot into env. Returns False if the pool is empty
+        '''
+        if len(self.states) == 0:
+            return False
+        columns_to_world(env, random.choice(self.states))
+        return True
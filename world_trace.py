@@ -0,0 +1,280 @@
+import os, sys
+
+import json
+import queue
+import atexit
+import argparse
+import threading
+import multiprocessing
+
+import numpy as np
+import cv2
+from renderer import SpeciesTable, colorize, PALETTE, EMPTY, WALL, PREDATOR
+from make_movie import concatenate
+
+'''
+Compact traces of the world for offline rendering
+
+While the simulation runs, TraceWriter records the cell and species of every
+agent at every trace_every steps (the walls are recorded once). The records
+are written in compressed chunks by a background thread, which is much cheaper
+than rendering frames in the step loop. The renderer at the bottom of this
+file turns a trace into a video afterwards, for any range of steps, region of
+the map, scale and frame rate, using several processes:
+
+    python world_trace.py --trace_dir results/.../logs/0/trace --st 1000 --ed 5000 --rows 0 200 --cols 0 200 --scale 4
+'''
+
+INDEX_NAME = 'trace.json'
+
+
+def read_index(trace_dir):
+    index_file = os.path.join(trace_dir, INDEX_NAME)
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            return json.load(f)
+    return {'shape': None, 'chunks': []}
+
+
+def write_index(trace_dir, index):
+    index_file = os.path.join(trace_dir, INDEX_NAME)
+    with open(index_file+'.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_file+'.tmp', index_file)
+
+
+class TraceWriter(object):
+    '''
+    Records the positions and species of the agents to a trace directory
+
+    Args:
+        trace_dir: Directory of the trace
+        every: Record one step out of every
+        chunk_steps: Number of recorded steps per chunk file
+        append: Keep the existing chunks (when a run is resumed)
+    '''
+    def __init__(self, trace_dir, every=1, chunk_steps=500, append=False):
+        self.trace_dir = trace_dir
+        self.every = max(int(every), 1)
+        self.chunk_steps = chunk_steps
+        if not os.path.exists(trace_dir):
+            os.makedirs(trace_dir)
+        self.index = read_index(trace_dir) if append else {'shape': None, 'chunks': []}
+        if not append:
+            for name in os.listdir(trace_dir):
+                if name.startswith('chunk_') or name == 'walls.npy':
+                    os.remove(os.path.join(trace_dir, name))
+        self.table = SpeciesTable()
+        self.calls = 0
+        self.reset_chunk()
+        self.closed = False
+        self.error = None
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_args(cls, trace_dir, args, mode='w'):
+        '''
+        Writer recording every trace_every steps (optional config entry), or None if it is 0
+        '''
+        every = getattr(args, 'trace_every', 0)
+        if every <= 0:
+            return None
+        return cls(trace_dir, every, append=(mode == 'a'))
+
+    def reset_chunk(self):
+        self.steps = []
+        self.rows = []
+        self.cols = []
+        self.species = []
+
+    def record(self, env, step):
+        if self.closed:
+            raise ValueError('record to the closed trace {}'.format(self.trace_dir))
+        self.calls += 1
+        if (self.calls-1) % self.every != 0:
+            return
+        self.raise_error()
+        codes = self.table.species_map(env)
+        if self.index['shape'] is None:
+            self.index['shape'] = list(codes.shape)
+            # walls do not move, they are stored once
+            np.save(os.path.join(self.trace_dir, 'walls.npy'), np.stack(np.nonzero(codes == WALL), 1).astype(np.int16))
+        rows, cols = np.nonzero(codes >= PREDATOR)
+        self.steps.append(step)
+        self.rows.append(rows.astype(np.int16))
+        self.cols.append(cols.astype(np.int16))
+        self.species.append(codes[rows, cols])
+        if len(self.steps) >= self.chunk_steps:
+            self.flush()
+
+    def flush(self):
+        if len(self.steps) == 0:
+            return
+        counts = np.array([len(rows) for rows in self.rows], dtype=np.int64)
+        chunk = {'steps': np.array(self.steps, dtype=np.int64),
+                 'offsets': np.concatenate([[0], np.cumsum(counts)]),
+                 'rows': np.concatenate(self.rows),
+                 'cols': np.concatenate(self.cols),
+                 'species': np.concatenate(self.species)}
+        self.reset_chunk()
+        self.queue.put(chunk)
+
+    def _run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                self.queue.task_done()
+                break
+            try:
+                file_name = 'chunk_{:06d}.npz'.format(len(self.index['chunks']))
+                path = os.path.join(self.trace_dir, file_name)
+                with open(path+'.tmp', 'wb') as f:
+                    np.savez_compressed(f, **chunk)
+                os.replace(path+'.tmp', path)
+                self.index['chunks'].append({'file': file_name,
+                                             'first': int(chunk['steps'][0]),
+                                             'last': int(chunk['steps'][-1]),
+                                             'steps': len(chunk['steps'])})
+                write_index(self.trace_dir, self.index)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        atexit.unregister(self.close)
+        self.raise_error()
+
+
+class TraceReader(object):
+    '''
+    Species maps of the steps of a trace
+
+    Args:
+        trace_dir: Directory written by TraceWriter
+    '''
+    def __init__(self, trace_dir):
+        self.trace_dir = trace_dir
+        self.index = read_index(trace_dir)
+        self.shape = tuple(self.index['shape'] or (0, 0))
+        walls_file = os.path.join(trace_dir, 'walls.npy')
+        self.walls = np.load(walls_file) if os.path.exists(walls_file) else np.zeros((0, 2), dtype=np.int16)
+        self.cached = None
+
+    def load_chunk(self, k):
+        if self.cached is None or self.cached[0] != k:
+            with np.load(os.path.join(self.trace_dir, self.index['chunks'][k]['file'])) as f:
+                self.cached = (k, {name: f[name] for name in f.files})
+        return self.cached[1]
+
+    def species_map(self, k, j):
+        '''
+        Species codes of the j-th step of chunk k, shape (h, w)
+        '''
+        chunk = self.load_chunk(k)
+        st, ed = chunk['offsets'][j], chunk['offsets'][j+1]
+        codes = np.full(self.shape, EMPTY, dtype=np.uint8)
+        codes[self.walls[:, 0], self.walls[:, 1]] = WALL
+        codes[chunk['rows'][st:ed], chunk['cols'][st:ed]] = chunk['species'][st:ed]
+        return codes
+
+
+def select_steps(reader, st=0, ed=None, every=1):
+    '''
+    (chunk, position in the chunk) of the recorded steps in [st, ed), one out of every.
+    Only the chunks which overlap the range are read
+    '''
+    selected = []
+    for k, chunk in enumerate(reader.index['chunks']):
+        if chunk['last'] < st or (ed is not None and chunk['first'] >= ed):
+            continue
+        numbers = reader.load_chunk(k)['steps']
+        keep = (numbers >= st) & (numbers < (ed if ed is not None else np.inf))
+        selected += [(k, j) for j in np.nonzero(keep)[0]]
+    return selected[::max(int(every), 1)]
+
+
+def _render_part(job):
+    trace_dir, steps, outvid, rows, cols, scale, fps, format = job
+    reader = TraceReader(trace_dir)
+    palette = np.ascontiguousarray(PALETTE[:, ::-1])
+    vid = None
+    for k, j in steps:
+        codes = reader.species_map(k, j)[rows[0]:rows[1], cols[0]:cols[1]]
+        frame = colorize(codes, palette, scale)
+        if vid is None:
+            vid = cv2.VideoWriter(outvid, cv2.VideoWriter_fourcc(*format), float(fps), (frame.shape[1], frame.shape[0]), True)
+        vid.write(frame)
+    if vid is not None:
+        vid.release()
+    return outvid
+
+
+def render_trace(trace_dir, outvid, st=0, ed=None, every=1, rows=(None, None), cols=(None, None),
+                 scale=1., fps=5, format='XVID', workers=1):
+    '''
+    Render a trace to a video
+
+    Args:
+        trace_dir: Directory of the trace
+        outvid: Path of the video
+        st, ed: Range of steps
+        every: Render one recorded step out of every
+        rows, cols: (start, end) of the region of the map
+        scale: Pixels per cell
+        workers: Number of processes, each of them renders consecutive steps
+    '''
+    steps = select_steps(TraceReader(trace_dir), st, ed, every)
+    if len(steps) == 0:
+        raise ValueError('no recorded steps in [{}, {}) in {}'.format(st, ed, trace_dir))
+    workers = max(min(workers, len(steps)), 1)
+    if workers == 1:
+        return _render_part((trace_dir, steps, outvid, rows, cols, scale, fps, format))
+
+    root, ext = os.path.splitext(outvid)
+    bounds = np.linspace(0, len(steps), workers+1).astype(np.int64)
+    jobs = [(trace_dir, steps[a:b], '{}.part{:03d}{}'.format(root, k, ext), rows, cols, scale, fps, format)
+            for k, (a, b) in enumerate(zip(bounds[:-1], bounds[1:]))]
+    with multiprocessing.Pool(workers) as pool:
+        parts = pool.map(_render_part, jobs)
+    try:
+        concatenate(parts, outvid)
+    finally:
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+    return outvid
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--trace_dir', type=str, required=True)
+    argparser.add_argument('--outvid', type=str, default=None, help='video path, video.avi next to the trace by default')
+    argparser.add_argument('--st', type=int, default=0, help='first step')
+    argparser.add_argument('--ed', type=int, default=None, help='step after the last one')
+    argparser.add_argument('--every', type=int, default=1, help='render one recorded step out of every')
+    argparser.add_argument('--rows', type=int, nargs=2, default=[None, None], help='start and end row of the region')
+    argparser.add_argument('--cols', type=int, nargs=2, default=[None, None], help='start and end column of the region')
+    argparser.add_argument('--scale', type=float, default=1., help='pixels per cell')
+    argparser.add_argument('--fps', type=float, default=5)
+    argparser.add_argument('--format', type=str, default='XVID', help='FourCC code of the codec')
+    argparser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of rendering processes')
+    args = argparser.parse_args()
+
+    outvid = args.outvid or os.path.join(os.path.dirname(os.path.abspath(args.trace_dir)), 'video.avi')
+    print(render_trace(args.trace_dir, outvid, args.st, args.ed, args.every, args.rows, args.cols,
+                       args.scale, args.fps, args.format, args.workers))